@@ -0,0 +1,67 @@
+"""
+Fast insertion of rows given as field dicts: COPY on PostgreSQL,
+bulk_create elsewhere. Model save methods and signals are bypassed, the
+auto_now_add dates missing from the rows are set to the loading time.
+"""
+
+import io
+
+from django.core.management.color import no_style
+from django.db import connection
+
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_data(model, rows):
+    """
+    Return the columns and the COPY text data of `rows`
+    """
+    objs = [model(**row) for row in rows]
+    # Every column is written, since Django defaults only exist in Python
+    fields = [f for f in model._meta.concrete_fields
+              if not (f.primary_key and getattr(objs[0], f.attname) is None)]
+    columns = ', '.join(connection.ops.quote_name(f.column) for f in fields)
+    data = io.StringIO()
+    for row, obj in zip(rows, objs):
+        # pre_save fills the auto_now_add dates like save() would, but the
+        # values given by the rows are kept
+        values = []
+        for f in fields:
+            value = getattr(obj, f.attname) if f.attname in row or f.name in row else f.pre_save(obj, True)
+            values.append(f.get_db_prep_save(value, connection))
+        data.write('\t'.join(copy_value(v) for v in values) + '\n')
+    data.seek(0)
+    return columns, data
+
+
+def copy(model, rows):
+    columns, data = copy_data(model, rows)
+    sql = 'COPY %s (%s) FROM STDIN' % (connection.ops.quote_name(model._meta.db_table), columns)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, data)
+
+
+def insert(model, rows, batch_size=5000):
+    if not rows:
+        return
+    if connection.vendor == 'postgresql':
+        copy(model, rows)
+    else:
+        # auto_now_add dates are set to the loading time by bulk_create
+        objs = [model(**row) for row in rows]
+        batch_size = min(batch_size, connection.ops.bulk_batch_size(model._meta.concrete_fields, objs))
+        model.objects.bulk_create(objs, batch_size=max(1, batch_size))
+
+
+def reset_sequences(*models):
+    # Rows inserted with explicit ids, move the id sequences after them
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), list(models)):
+            cursor.execute(sql)
@@ -0,0 +1,179 @@
+"""
+Parsing and transformation of the Book-Crossing (BX) CSV dump.
+
+The dump files use ';' as separator and '"' as quote character, in
+ISO-8859-1. Every function here works on one line at a time so that the
+files can be streamed instead of loaded in memory.
+"""
+
+import csv
+import datetime
+import html
+import string
+from decimal import Decimal
+
+from django.contrib.auth.hashers import PBKDF2PasswordHasher, get_hasher
+
+ENCODING = 'ISO-8859-1'
+
+HOSTS = ["@gmail.com", "@laposte.net", "@yahoo.com", "@hotmail.fr", "@outlook.com"]
+PASSWORD_CHARS = string.ascii_letters + string.digits
+
+FIRST_YEAR = 1901
+UTC = datetime.timezone.utc
+
+
+def read_rows(path, start=0, end=None):
+    """
+    Yield (offset, fields) for every line of `path` starting at byte `start`
+    and stopping before byte `end`. `offset` is the byte offset just after
+    the line, so that reading can resume from it.
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        for raw in f:
+            if end is not None and offset >= end:
+                break
+            offset += len(raw)
+            line = raw.decode(ENCODING).rstrip('\r\n')
+            if not line:
+                continue
+            try:
+                fields = next(csv.reader([line], delimiter=';', escapechar='\\', doublequote=False))
+            except (csv.Error, StopIteration):
+                continue
+            yield offset, fields
+
+
+def read_names(path):
+    with open(path, 'r', encoding=ENCODING) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def format_isbn(raw):
+    """
+    Turn a 10 characters BX ISBN into the X-XXXX-XXXX-X format used by
+    Book, or return None if it cannot be converted.
+    """
+    raw = raw.strip()
+    if len(raw) != 10:
+        return None
+    return raw[0] + "-" + raw[1:5] + "-" + raw[5:9] + "-" + raw[9]
+
+
+def truncate(s, length):
+    if len(s) > length:
+        return s[:length - 3] + "..."
+    return s
+
+
+def random_date(rng, year_min, year_max):
+    return datetime.date(rng.randint(year_min, year_max), rng.randint(1, 12), rng.randint(1, 28))
+
+
+def random_datetime(rng, year_min, year_max):
+    day = random_date(rng, year_min, year_max)
+    return datetime.datetime(
+        day.year, day.month, day.day,
+        rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59),
+        tzinfo=UTC,
+    )
+
+
+def random_password(rng, length=10):
+    return ''.join(rng.choice(PASSWORD_CHARS) for _ in range(length))
+
+
+def hash_passwords(raw_passwords, iterations=None):
+    """
+    Hash a batch of raw passwords with the default hasher, looked up once
+    for the whole batch. `iterations` lowers the cost of PBKDF2 for bulk
+    loads, the hash is upgraded the first time the user logs in.
+    """
+    hasher = get_hasher()
+    kwargs = {}
+    if iterations and isinstance(hasher, PBKDF2PasswordHasher):
+        kwargs['iterations'] = iterations
+    return [hasher.encode(raw, hasher.salt(), **kwargs) for raw in raw_passwords]
+
+
+def transform_user(fields, rng, first_names, last_names):
+    """
+    Return the CustomUser field values built from a BX-Users line, with a
+    raw password that still has to be hashed, or None if the line is invalid.
+    """
+    if len(fields) < 2 or not fields[0].isdigit():
+        return None
+    user_id = int(fields[0])
+    first_name, last_name = rng.choice(first_names), rng.choice(last_names)
+    # The BX id makes the username unique
+    username = (first_name[:2] + last_name).lower().replace(' ', '') + str(user_id)
+
+    age = fields[2] if len(fields) > 2 else ''
+    if age.isdigit() and 5 <= int(age) <= 100:
+        birthday = random_date(rng, 2017 - int(age), 2019 - int(age))
+    else:
+        birthday = random_date(rng, 1950, 2000)
+
+    return {
+        'id': user_id,
+        'password': random_password(rng),
+        'last_login': random_datetime(rng, 2018, 2019),
+        'username': username,
+        'date_joined': random_datetime(rng, 2000, 2017),
+        'first_name': first_name,
+        'last_name': last_name,
+        'address': truncate(html.unescape(fields[1]).replace('|', '-'), 300),
+        'email': username + rng.choice(HOSTS),
+        'birthday': birthday,
+        'balance': Decimal(rng.randint(0, 1000)),
+        'authorization_level': 1,
+        'privacy_level': 0,
+    }
+
+
+def transform_book(fields, rng, category_ids, last_year):
+    """
+    Return the Book field values built from a BX-Books line, or None if the
+    line is invalid.
+    """
+    if len(fields) < 6:
+        return None
+    isbn = format_isbn(fields[0])
+    if isbn is None or not fields[3].strip().isdigit():
+        return None
+    year = min(max(int(fields[3]), FIRST_YEAR), last_year)
+    return {
+        'isbn': isbn,
+        'status': 1,
+        'title': truncate(html.unescape(fields[1]), 100),
+        'author_pseudonym': truncate(html.unescape(fields[2]), 50),
+        'price': Decimal(rng.randint(10, 500)) / 10,
+        'year_of_pub': year,
+        'image_url': fields[5][:1000],
+        'category_id': rng.choice(category_ids),
+    }
+
+
+def transform_rating(fields, rng, isbns, user_ids):
+    """
+    Return the Rating field values built from a BX-Book-Ratings line, or None
+    if the line is invalid, implicit (rated 0) or refers to an unknown book
+    or user.
+    """
+    if len(fields) < 3 or not fields[0].isdigit() or not fields[2].isdigit():
+        return None
+    isbn = format_isbn(fields[1])
+    user_id = int(fields[0])
+    if isbn not in isbns or user_id not in user_ids:
+        return None
+    evaluation = int(fields[2]) // 2
+    if evaluation <= 0:
+        return None
+    return {
+        'date': random_datetime(rng, 2000, 2019),
+        'evaluation': min(evaluation, 5),
+        'user_id': user_id,
+        'book_id': isbn,
+    }
@@ -112,21 +112,22 @@ def add_ratings():
     f = open('BX-Books.csv','r', encoding='ISO-8859-1')
     books = f.readlines()
     f.close()
-    ids = []
+    ids = set()
     for lineb in books:
         data = lineb.replace('|','-').replace('\"','"').replace('"; ','" - ').split('";')
         for i in range(len(data)):
             data[i] = data[i][1:]
         if len(data[0]) == 10:
-            isbn = data[0][0] + "-" + data[0][1:5] + "-" + data[0][5:9]
-            ids += isbn
+            isbn = data[0][0] + "-" + data[0][1:5] + "-" + data[0][5:9] + "-" + data[0][9]
+            ids.add(isbn)
     try:
         for line in ratings:
             data = line.replace('|','-').replace('\"','"').replace('"; ','" - ').split('";')
             for i in range(len(data)):
                 data[i] = data[i][1:]
-            if len(data[1]) == 10:
-                isbn = data[1][0] + "-" + data[1][1:5] + "-" + data[1][5:9] + "-" + data[1][9]
+            if len(data[1]) != 10:
+                continue
+            isbn = data[1][0] + "-" + data[1][1:5] + "-" + data[1][5:9] + "-" + data[1][9]
             if isbn in ids:
                 evaluationInt = int(data[2][:-2])//2
                 if evaluationInt > 0 and len(data[0]) > 1:
@@ -139,4 +140,5 @@ def add_ratings():
         print(line)
         return 1
 
-add_users()
+if __name__ == '__main__':
+    add_users()
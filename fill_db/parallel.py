@@ -0,0 +1,139 @@
+"""
+Sharded, parallel parsing and transformation of the BX dump.
+
+Each input file is cut into byte ranges aligned on line boundaries. The
+shards are parsed and transformed by a multiprocessing pool and handed
+back in file order, so that they can be inserted in order and the loading
+can resume after the last inserted shard. Every shard has its own random
+generator seeded from (seed, stage, shard index): the generated names,
+emails and dates only depend on the seed and the shard size, not on the
+number of processes.
+"""
+
+import multiprocessing
+import os
+import random
+import time
+
+from . import bx
+
+DEFAULT_SHARD_SIZE = 4 * 1024 * 1024
+
+_context = {}
+
+
+def shard_ranges(path, shard_size=DEFAULT_SHARD_SIZE):
+    """
+    Return the (start, end) byte ranges of the shards of `path`. Every range
+    starts at the beginning of a line.
+    """
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, 'rb') as f:
+        position = shard_size
+        while position < size:
+            f.seek(position)
+            f.readline()
+            start = f.tell()
+            if start >= size:
+                break
+            if start > starts[-1]:
+                starts.append(start)
+            position = start + shard_size
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def shard_rng(seed, stage, index):
+    return random.Random('%s-%s-%d' % (seed, stage, index))
+
+
+def init_worker(context):
+    global _context
+    _context = context
+
+
+def transform(stage, fields, rng):
+    c = _context
+    if stage == 'users':
+        return bx.transform_user(fields, rng, c['first_names'], c['last_names'])
+    if stage == 'books':
+        return bx.transform_book(fields, rng, c['category_ids'], c['last_year'])
+    return bx.transform_rating(fields, rng, c['isbns'], c['user_ids'])
+
+
+def process_shard(task):
+    """
+    Parse and transform one shard. Return (index, end, rows, parse_time,
+    transform_time).
+    """
+    stage, path, index, start, end = task
+    rng = shard_rng(_context['seed'], stage, index)
+    rows = []
+    parse_time = transform_time = 0.0
+
+    lines = bx.read_rows(path, start=start, end=end)
+    while True:
+        t0 = time.perf_counter()
+        try:
+            _, fields = next(lines)
+        except StopIteration:
+            parse_time += time.perf_counter() - t0
+            break
+        t1 = time.perf_counter()
+        parse_time += t1 - t0
+        # Header lines are rejected by the transformations
+        row = transform(stage, fields, rng)
+        if row is not None:
+            rows.append(row)
+        transform_time += time.perf_counter() - t1
+
+    if stage == 'users':
+        t0 = time.perf_counter()
+        passwords = bx.hash_passwords([row['password'] for row in rows], _context.get('hash_iterations'))
+        for row, password in zip(rows, passwords):
+            row['password'] = password
+        transform_time += time.perf_counter() - t0
+
+    return index, end, rows, parse_time, transform_time
+
+
+def iter_shards(stage, path, context, workers=1, shard_size=DEFAULT_SHARD_SIZE, start=0):
+    """
+    Yield the result of process_shard for every shard of `path` ending
+    after byte `start`, in file order.
+    """
+    tasks = [(stage, path, i, s, e) for i, (s, e) in enumerate(shard_ranges(path, shard_size)) if e > start]
+    if workers <= 1:
+        init_worker(context)
+        for task in tasks:
+            yield process_shard(task)
+        return
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(context,)) as pool:
+        for result in pool.imap(process_shard, tasks):
+            yield result
+
+
+class StageTimer:
+    """
+    Time spent in each step of a stage. Parse and transform times are summed
+    over the workers, insert time is spent in the main process.
+    """
+
+    def __init__(self, stage, workers):
+        self.stage = stage
+        self.workers = workers
+        self.parse = self.transform = self.insert = 0.0
+        self.rows = 0
+        self.start = time.perf_counter()
+
+    def add_shard(self, parse_time, transform_time, nb_rows):
+        self.parse += parse_time
+        self.transform += transform_time
+        self.rows += nb_rows
+
+    def report(self):
+        wall = max(time.perf_counter() - self.start, 1e-6)
+        return '%s: %d rows in %.1fs (%.0f rows/s) | parse %.1fs, transform %.1fs (cpu, %d worker%s), insert %.1fs' % (
+            self.stage, self.rows, wall, self.rows / wall, self.parse, self.transform,
+            self.workers, 's' if self.workers > 1 else '', self.insert,
+        )
@@ -0,0 +1,189 @@
+"""
+Seeded synthetic dataset: users, books, ratings, purchases, reviews,
+comments, votes, friendships and recommendations at any scale.
+
+Users are generated by chunks, each with its own random generator seeded
+from (seed, chunk index) like the shards of the BX loader, so that a chunk
+only depends on the seed and the scale. Every row gets an explicit id
+following `start`, the ids already used in the database, and only refers
+to rows of the same chunk or to books, so that chunks can be inserted one
+at a time. Book popularity is skewed: a few books get most ratings.
+"""
+
+from decimal import Decimal
+
+from . import bx, parallel
+
+SCALES = {
+    'tiny': {'users': 200, 'books': 500},
+    'small': {'users': 2000, 'books': 10000},
+    'medium': {'users': 20000, 'books': 100000},
+    'large': {'users': 200000, 'books': 1000000},
+}
+
+DEFAULTS = {
+    'ratings_per_user': 20,
+    'review_ratio': 0.2,
+    'comments_per_review': 2,
+    'votes_per_review': 3,
+    'friends_per_user': 5,
+    'recommendations_per_user': 1,
+    'owned_ratio': 0.5,
+    # Exponent of the popularity: a rated book is book int(n * random() ** skew)
+    'skew': 2.5,
+}
+
+FIRST_NAMES = ['Alice', 'Bruno', 'Chloe', 'David', 'Emma', 'Farid', 'Gabriel', 'Hugo', 'Ines', 'Jules',
+               'Karim', 'Lea', 'Manon', 'Nathan', 'Olivia', 'Paul', 'Quentin', 'Rose', 'Sarah', 'Tom']
+LAST_NAMES = ['Bernard', 'Dubois', 'Durand', 'Fontaine', 'Garcia', 'Lambert', 'Laurent', 'Lefebvre',
+              'Leroy', 'Martin', 'Mercier', 'Moreau', 'Petit', 'Richard', 'Robert', 'Roux', 'Simon', 'Thomas']
+WORDS = ['shadow', 'river', 'night', 'empire', 'garden', 'secret', 'winter', 'storm', 'silence',
+         'kingdom', 'letter', 'island', 'memory', 'fire', 'stone', 'dream', 'journey', 'city', 'crown']
+
+LAST_YEAR = 2018
+
+
+def book_isbn(index):
+    # 13 digits ISBNs starting with 999, so that they never collide with
+    # the 10 digits ISBNs of the BX dump
+    digits = '%010d' % index
+    return '999-' + bx.format_isbn(digits)
+
+
+def sentence(rng, nb_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(nb_words)).capitalize()
+
+
+def books(rng, start, end, category_ids, author_ids=()):
+    """
+    Yield the Book field values of books `start` to `end`
+    """
+    for i in range(start, end):
+        yield {
+            'isbn': book_isbn(i),
+            'status': 1,
+            'title': sentence(rng, rng.randint(1, 5))[:100],
+            'author_id': rng.choice(author_ids) if author_ids and rng.random() < 0.1 else None,
+            'author_pseudonym': rng.choice(FIRST_NAMES) + ' ' + rng.choice(LAST_NAMES),
+            'price': Decimal(rng.randint(10, 500)) / 10,
+            'year_of_pub': rng.randint(bx.FIRST_YEAR, LAST_YEAR),
+            'image_url': 'http://images.example.com/%d.jpg' % i,
+            'category_id': rng.choice(category_ids),
+        }
+
+
+class Chunk:
+    """
+    Rows generated for one chunk of users, by model name
+    """
+
+    def __init__(self):
+        self.rows = {name: [] for name in (
+            'users', 'ratings', 'purchases', 'reviews', 'comments', 'votes', 'friendships', 'recommendations',
+        )}
+
+    def __len__(self):
+        return sum(len(rows) for rows in self.rows.values())
+
+
+def chunk(seed, index, user_ids, nb_books, start, password, options):
+    """
+    Generate the users `user_ids` and everything they do. `start` holds the
+    next free id of every model and is advanced by the rows generated.
+    """
+    o = dict(DEFAULTS, **options)
+    rng = parallel.shard_rng(seed, 'synthetic', index)
+    result = Chunk()
+    rows = result.rows
+    first_user, last_user = user_ids[0], user_ids[-1]
+
+    def popular_book():
+        return book_isbn(int(nb_books * rng.random() ** o['skew']))
+
+    for user_id in user_ids:
+        first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        username = (first_name[:2] + last_name).lower() + str(user_id)
+        rows['users'].append({
+            'id': user_id,
+            'password': password,
+            'last_login': bx.random_datetime(rng, 2018, 2019),
+            'username': username,
+            'date_joined': bx.random_datetime(rng, 2000, 2017),
+            'first_name': first_name,
+            'last_name': last_name,
+            'address': '%d rue %s' % (rng.randint(1, 200), rng.choice(LAST_NAMES)),
+            'email': username + rng.choice(bx.HOSTS),
+            'birthday': bx.random_date(rng, 1950, 2000),
+            'balance': Decimal(rng.randint(0, 1000)),
+            'authorization_level': 1,
+            'privacy_level': 0,
+        })
+
+        rated = set()
+        for _ in range(rng.randint(0, 2 * o['ratings_per_user'])):
+            isbn = popular_book()
+            if isbn in rated:
+                continue
+            rated.add(isbn)
+            rating_id = start['ratings']
+            start['ratings'] += 1
+            rows['ratings'].append({
+                'id': rating_id,
+                'date': bx.random_datetime(rng, 2000, 2019),
+                'evaluation': rng.randint(1, 5),
+                'user_id': user_id,
+                'book_id': isbn,
+            })
+            if rng.random() < o['owned_ratio']:
+                rows['purchases'].append({'customuser_id': user_id, 'book_id': isbn})
+            if rng.random() < o['review_ratio']:
+                review_id = start['reviews']
+                start['reviews'] += 1
+                rows['reviews'].append({
+                    'id': review_id,
+                    'date': bx.random_datetime(rng, 2000, 2019),
+                    'content': ' '.join(sentence(rng, rng.randint(5, 15)) + '.' for _ in range(rng.randint(1, 8))),
+                    'summary': sentence(rng, rng.randint(2, 8)),
+                    'associated_rating_id': rating_id,
+                    'book_id': isbn,
+                })
+                # Comments and votes come from the users of the chunk
+                for _ in range(rng.randint(0, 2 * o['comments_per_review'])):
+                    rows['comments'].append({
+                        'id': start['comments'],
+                        'date': bx.random_datetime(rng, 2000, 2019),
+                        'content': sentence(rng, rng.randint(3, 20)),
+                        'parent_review_id': review_id,
+                        'user_id': rng.randint(first_user, last_user),
+                    })
+                    start['comments'] += 1
+                nb_votes = min(rng.randint(0, 2 * o['votes_per_review']), len(user_ids))
+                for voter in rng.sample(user_ids, nb_votes):
+                    rows['votes'].append({
+                        'review_id': review_id,
+                        'user_id': voter,
+                        'value': 1 if rng.random() < 0.7 else -1,
+                        'date': bx.random_datetime(rng, 2000, 2019),
+                    })
+
+        # Friends are chosen among the next users of the chunk, so that a
+        # pair is only generated once
+        candidates = range(user_id + 1, last_user + 1)
+        friends = rng.sample(candidates, min(len(candidates), rng.randint(0, 2 * o['friends_per_user'])))
+        for friend in friends:
+            rows['friendships'].append({
+                'sender_id': user_id,
+                'target_id': friend,
+                'date': bx.random_datetime(rng, 2010, 2019),
+                'status': 1 if rng.random() < 0.9 else 0,
+                'pair_low': user_id,
+                'pair_high': friend,
+            })
+            for _ in range(rng.randint(0, o['recommendations_per_user'])):
+                rows['recommendations'].append({
+                    'sender_id': user_id,
+                    'target_id': friend,
+                    'date': bx.random_datetime(rng, 2010, 2019),
+                    'book_id': popular_book(),
+                })
+    return result
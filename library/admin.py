@@ -12,5 +12,10 @@ admin.site.register(Recommendation)
 admin.site.register(Category)
 admin.site.register(Rating)
 admin.site.register(Review)
+admin.site.register(ReviewVote)
+admin.site.register(ReviewReport)
+admin.site.register(ReportedReview)
 admin.site.register(Comment)
 admin.site.register(Book)
+admin.site.register(BookNeighbour)
+admin.site.register(ModerationCounter)
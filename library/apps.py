@@ -1,5 +1,29 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_migrate
+
+
+def create_search_tables(sender, using, **kwargs):
+    from . import search
+    search.create_tables(using)
+
+
+def unindex_book(sender, instance, **kwargs):
+    from . import search
+    search.unindex_book(instance.pk)
+
+
+def unindex_review(sender, instance, **kwargs):
+    from . import search
+    search.unindex_review(instance.pk)
 
 
 class LibraryConfig(AppConfig):
     name = 'library'
+
+    def ready(self):
+        # The search tables are not models, they are created after migrate
+        post_migrate.connect(create_search_tables, sender=self)
+        # The search documents follow the deletions, including the cascaded
+        # ones which never call Model.delete()
+        post_delete.connect(unindex_book, sender=self.get_model('Book'))
+        post_delete.connect(unindex_review, sender=self.get_model('Review'))
@@ -0,0 +1,243 @@
+"""
+Local proxy of the book covers.
+
+A cover is downloaded from its origin once and stored under COVER_CACHE_DIR
+by the SHA-256 of its content, with a small file mapping the hash of its URL
+to that content hash. Thumbnails of every size are made from the original
+the first time they are asked for, with Pillow when it is installed (the
+original is served otherwise), and stored next to it. The content hash is
+the ETag of the thumbnails, and their URL changes with Book.image_url, so
+that browsers keep them for a year.
+
+At most COVER_MAX_FETCHES downloads run at a time in a process, and a URL is
+only downloaded by one thread at a time. A cover which cannot be downloaded
+is not proxied: the page falls back to the origin URL, and the download is
+not tried again for FAILURE_TIMEOUT seconds, so that dead covers do not
+hold the downloads.
+
+Publishers choose the cover URLs, so the server must not be made to fetch
+internal addresses: every connection, redirects included, checks that the
+host resolves to public addresses only and connects to the address checked.
+COVER_ALLOW_PRIVATE_ADDRESSES lifts the check, for the tests.
+"""
+
+import hashlib
+import http.client
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from io import BytesIO
+
+from django.conf import settings
+
+# Bounding boxes of the thumbnails, twice the size they are displayed at
+SIZES = {
+    'list': (200, 200),
+    'detail': (660, 2000),
+}
+THUMBNAIL_QUALITY = 85
+MAX_BYTES = 5 * 1024 * 1024
+# Cache lifetime of the thumbnails, in seconds
+MAX_AGE = 365 * 24 * 60 * 60
+# Time before a cover which could not be downloaded is tried again
+FAILURE_TIMEOUT = 60 * 60
+
+logger = logging.getLogger(__name__)
+
+_fetches = threading.BoundedSemaphore(getattr(settings, 'COVER_MAX_FETCHES', 4))
+_lock = threading.Lock()
+_url_locks = {}
+
+
+class CoverUnavailable(Exception):
+    pass
+
+
+class CoverBusy(CoverUnavailable):
+    """
+    Too many downloads running, the cover itself may be fine
+    """
+
+
+def url_hash(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _path(*parts):
+    return os.path.join(settings.COVER_CACHE_DIR, *parts)
+
+
+def _write(path, data):
+    # Other processes never see a partly written file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _public_address(host, port):
+    """
+    Return an address of `host` to connect to. Raise CoverUnavailable if
+    one of its addresses is not public.
+    """
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError as e:
+        raise CoverUnavailable('Could not resolve %s: %s' % (host, e))
+    if not getattr(settings, 'COVER_ALLOW_PRIVATE_ADDRESSES', False):
+        for info in infos:
+            address = ipaddress.ip_address(info[4][0])
+            if not address.is_global:
+                raise CoverUnavailable('%s resolves to the non-public address %s' % (host, address))
+    return infos[0][4][0]
+
+
+def _create_connection(address, *args, **kwargs):
+    host, port = address
+    return socket.create_connection((_public_address(host, port), port), *args, **kwargs)
+
+
+class _HTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super(_HTTPConnection, self).__init__(*args, **kwargs)
+        self._create_connection = _create_connection
+
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super(_HTTPSConnection, self).__init__(*args, **kwargs)
+        self._create_connection = _create_connection
+
+
+class _HTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_HTTPConnection, req)
+
+
+class _HTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_HTTPSConnection, req, context=self._context)
+
+
+# No proxy from the environment: the connections must go to the checked
+# addresses. Redirects open new connections through the same handlers.
+_opener = urllib.request.build_opener(urllib.request.ProxyHandler({}), _HTTPHandler, _HTTPSHandler)
+
+
+def _download(url):
+    if '://' not in url:
+        url = 'http://' + url
+    if not url.startswith(('http://', 'https://')):
+        raise CoverUnavailable('%s is not an HTTP URL' % url)
+    timeout = getattr(settings, 'COVER_FETCH_TIMEOUT', 5)
+    if not _fetches.acquire(timeout=timeout):
+        raise CoverBusy('Too many cover downloads')
+    try:
+        with _opener.open(url, timeout=timeout) as response:
+            if not response.headers.get_content_type().startswith('image/'):
+                raise CoverUnavailable('%s is not an image' % url)
+            data = response.read(MAX_BYTES + 1)
+    except (OSError, ValueError) as e:
+        raise CoverUnavailable('Could not download %s: %s' % (url, e))
+    finally:
+        _fetches.release()
+    if len(data) > MAX_BYTES:
+        raise CoverUnavailable('%s is too large' % url)
+    return data
+
+
+def original(url):
+    """
+    Return the content hash of the cover at `url`, downloading it the first
+    time. Raise CoverUnavailable if it cannot be downloaded.
+    """
+    key = url_hash(url)
+    mapping = _path('urls', key)
+    content_hash = _read(mapping)
+    if content_hash is not None:
+        return content_hash.decode()
+    failure = _path('failures', key)
+    try:
+        if time.time() - os.path.getmtime(failure) < FAILURE_TIMEOUT:
+            raise CoverUnavailable('%s could not be downloaded recently' % url)
+    except FileNotFoundError:
+        pass
+    with _lock:
+        url_lock = _url_locks.setdefault(key, threading.Lock())
+    try:
+        with url_lock:
+            # Downloaded by another thread meanwhile
+            content_hash = _read(mapping)
+            if content_hash is None:
+                try:
+                    data = _download(url)
+                except CoverBusy:
+                    raise
+                except CoverUnavailable:
+                    _write(failure, b'')
+                    raise
+                content_hash = hashlib.sha256(data).hexdigest().encode()
+                _write(_path('originals', content_hash.decode()), data)
+                _write(mapping, content_hash)
+    finally:
+        with _lock:
+            _url_locks.pop(key, None)
+    return content_hash.decode()
+
+
+def _content_type(data):
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    return 'image/jpeg'
+
+
+def thumbnail(url, size):
+    """
+    Return (path, content type, content hash) of the thumbnail of the cover
+    at `url` in one of SIZES. Raise CoverUnavailable if the cover cannot be
+    downloaded.
+    """
+    content_hash = original(url)
+    path = _path(size, content_hash + '.jpg')
+    if os.path.exists(path):
+        return path, 'image/jpeg', content_hash
+    source = _path('originals', content_hash)
+    try:
+        from PIL import Image
+    except ImportError:
+        with open(source, 'rb') as f:
+            return source, _content_type(f.read(16)), content_hash
+    try:
+        image = Image.open(source)
+        image.thumbnail(SIZES[size])
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        output = BytesIO()
+        image.save(output, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+    except (OSError, ValueError):
+        # Not an image Pillow can read, served as it is
+        logger.warning('Could not make a thumbnail of %s', url)
+        with open(source, 'rb') as f:
+            return source, _content_type(f.read(16)), content_hash
+    _write(path, output.getvalue())
+    return path, 'image/jpeg', content_hash
@@ -0,0 +1,169 @@
+"""
+Faceted browsing of the catalog by category, decade and price bucket.
+
+The published books are counted in a single grouped query by (category,
+decade, price bucket), a few hundred rows at most, which are cached until
+a book is written. The counts shown next to any combination of filters are
+added up from these rows: each facet counts the books matching the filters
+on the other facets, so that the values of a facet can be switched.
+
+When the cache is local to the process, it would not be invalidated by
+the writes of the other processes: every process keeps its own copy of the
+groups instead, with the catalog version stored in the database (see
+DataVersion) when they were counted, and counts them again when the
+version changed.
+"""
+
+from urllib.parse import urlencode
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, CharField, Count, F, Value, When
+
+from . import pagecache
+
+CACHE_KEY = 'library:facets'
+CACHE_TIMEOUT = 60 * 60
+
+# (catalog version, groups) of this process, without a shared cache
+_local = None
+
+FACETS = ('category', 'decade', 'price')
+# (key, label, lowest price, highest price excluded)
+PRICE_BUCKETS = (
+    ('0-10', 'Under $10', 0, 10),
+    ('10-20', '$10 to $20', 10, 20),
+    ('20-50', '$20 to $50', 20, 50),
+    ('50', '$50 and more', 50, None),
+)
+
+
+def parse(query):
+    """
+    Return the filters of a query string, by facet. Raise ValueError if a
+    value is invalid.
+    """
+    filters = {}
+    for facet in FACETS:
+        value = query.get(facet)
+        if not value:
+            continue
+        if facet == 'price':
+            if value not in dict((b[0], b) for b in PRICE_BUCKETS):
+                raise ValueError('Invalid price bucket')
+            filters[facet] = value
+        else:
+            filters[facet] = int(value)
+            if facet == 'decade' and filters[facet] % 10:
+                raise ValueError('Invalid decade')
+    return filters
+
+
+def filter_books(queryset, filters):
+    if 'category' in filters:
+        queryset = queryset.filter(category_id=filters['category'])
+    if 'decade' in filters:
+        queryset = queryset.filter(year_of_pub__gte=filters['decade'], year_of_pub__lt=filters['decade'] + 10)
+    if 'price' in filters:
+        _, _, low, high = dict((b[0], b) for b in PRICE_BUCKETS)[filters['price']]
+        queryset = queryset.filter(price__gte=low)
+        if high is not None:
+            queryset = queryset.filter(price__lt=high)
+    return queryset
+
+
+def _groups():
+    """
+    Return the (category id, category name, decade, price bucket, number of
+    books) groups of the published books
+    """
+    from .models import DataVersion
+
+    global _local
+    if not pagecache.cache_is_shared():
+        version = DataVersion.get(DataVersion.CATALOG)
+        local = _local
+        if local is None or local[0] != version:
+            local = _local = (version, _count_groups())
+        return local[1]
+    groups = cache.get(CACHE_KEY)
+    if groups is None:
+        groups = _count_groups()
+        cache.set(CACHE_KEY, groups, CACHE_TIMEOUT)
+    return groups
+
+
+def _count_groups():
+    from .models import Book
+
+    bucket = Case(
+        *[When(price__lt=high, then=Value(key)) for key, _, _, high in PRICE_BUCKETS if high is not None],
+        default=Value(PRICE_BUCKETS[-1][0]),
+        output_field=CharField(),
+    )
+    return list(
+        Book.objects.published()
+        .annotate(decade=F('year_of_pub') / 10 * 10, bucket=bucket)
+        .values_list('category', 'category__name', 'decade', 'bucket')
+        .annotate(n=Count('isbn'))
+        .order_by()
+    )
+
+
+def invalidate():
+    """
+    Invalidate the groups, must be called in the transaction writing the
+    books
+    """
+    from .models import DataVersion
+
+    DataVersion.bump(DataVersion.CATALOG)
+    transaction.on_commit(lambda: cache.delete(CACHE_KEY))
+
+
+def query_string(filters, **changes):
+    """
+    Return the query string of `filters` with some facets changed, None
+    removing a facet
+    """
+    filters = dict(filters, **changes)
+    return urlencode([(facet, filters[facet]) for facet in FACETS if filters.get(facet) is not None])
+
+
+def counts(filters):
+    """
+    Return the number of books matching `filters` and the values of every
+    facet as dicts of value, label, number of books, selected and query
+    string toggling the value
+    """
+    labels = {'category': {}, 'decade': {}, 'price': dict((b[0], b[1]) for b in PRICE_BUCKETS)}
+    totals = {facet: {} for facet in FACETS}
+    nb_books = 0
+    for category, name, decade, bucket, n in _groups():
+        values = {'category': category, 'decade': decade, 'price': bucket}
+        labels['category'][category] = name
+        labels['decade'][decade] = '%ds' % decade
+        mismatches = [facet for facet in filters if filters[facet] != values[facet]]
+        if not mismatches:
+            nb_books += n
+        for facet in FACETS:
+            # Every facet is counted with the filters of the other facets
+            if not mismatches or mismatches == [facet]:
+                totals[facet][values[facet]] = totals[facet].get(values[facet], 0) + n
+
+    facets = {}
+    order = {
+        'category': lambda v: labels['category'][v],
+        'decade': lambda v: -v,
+        'price': [b[0] for b in PRICE_BUCKETS].index,
+    }
+    for facet in FACETS:
+        selected = filters.get(facet)
+        facets[facet] = [{
+            'value': value,
+            'label': labels[facet].get(value, value),
+            'count': n,
+            'selected': value == selected,
+            'query': query_string(filters, **{facet: None if value == selected else value}),
+        } for value, n in sorted(totals[facet].items(), key=lambda item: order[facet](item[0]))]
+    return nb_books, facets
@@ -23,6 +23,15 @@ class CustomUserCreationForm(UserCreationForm):
 class BuyBookForm(forms.Form):
     pass
 
+class CheckoutForm(forms.Form):
+    def __init__(self, *args, **kwargs):
+        books_choices = kwargs.pop('books', None)
+        super(CheckoutForm, self).__init__(*args, **kwargs)
+        self.fields['isbns'] = forms.MultipleChoiceField(
+            required=True,
+            choices=books_choices,
+        )
+
 class CreateBookForm(forms.ModelForm):
     class Meta:
         model = Book
@@ -32,10 +41,11 @@ class RecommendBookForm(forms.Form):
     def __init__(self, *args, **kwargs):
         friends_choices = kwargs.pop('friends', None)
         super(RecommendBookForm, self).__init__(*args, **kwargs)
-        self.fields['friend'] = forms.ChoiceField(
+        self.fields['friends'] = forms.MultipleChoiceField(
             required=True,
             label='Who do you want to recommend this book to?',
             choices = friends_choices,
+            widget=forms.CheckboxSelectMultiple,
         )
 
 class WriteReviewForm(forms.Form):
@@ -0,0 +1,180 @@
+"""
+Friendship graph kept in memory for the "people you may know" suggestions.
+
+Every process holds the accepted friendships as one sorted array of friend
+ids per user. Accepting or deleting a friendship writes the change in the
+cache under the next value of a shared version counter; before answering,
+a process applies the changes made since its own version, or rebuilds the
+graph from the database when some of them have expired. Applying a change
+twice gives the same graph, so a change read both from the database and
+from the cache does no harm.
+
+When the cache is local to the process, the changes made by the other
+processes are never seen there: the graph is rebuilt instead whenever the
+friendships version stored in the database (DataVersion), bumped by every
+accepted or deleted friendship, changed.
+"""
+
+import heapq
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from django.core.cache import cache
+from django.db import transaction
+from . import pagecache
+
+VERSION_KEY = 'library:friendgraph:version'
+CHANGE_KEY = 'library:friendgraph:change:%d'
+CHANGE_TIMEOUT = 60 * 60
+# Beyond this number of changes, rebuilding is cheaper than catching up
+MAX_CHANGES = 1000
+
+ADD = 'add'
+REMOVE = 'remove'
+
+_graph = None
+_lock = threading.Lock()
+
+
+class FriendGraph:
+    """
+    Adjacency arrays of the accepted friendships
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.db_version = None
+        self.adjacency = {}
+
+    def add(self, user1, user2):
+        self._insert(user1, user2)
+        self._insert(user2, user1)
+
+    def remove(self, user1, user2):
+        self._discard(user1, user2)
+        self._discard(user2, user1)
+
+    def _insert(self, user, friend):
+        friends = self.adjacency.setdefault(user, array('i'))
+        i = bisect_left(friends, friend)
+        if i == len(friends) or friends[i] != friend:
+            friends.insert(i, friend)
+
+    def _discard(self, user, friend):
+        friends = self.adjacency.get(user)
+        if friends is None:
+            return
+        i = bisect_left(friends, friend)
+        if i < len(friends) and friends[i] == friend:
+            del friends[i]
+            if not friends:
+                del self.adjacency[user]
+
+    def friends(self, user_id):
+        return self.adjacency.get(user_id, ())
+
+    def suggestions(self, user_id, limit, exclude=()):
+        """
+        Return up to `limit` (user id, number of mutual friends) of the
+        friends of the friends of a user, most mutual friends first
+        """
+        friends = self.friends(user_id)
+        known = set(friends)
+        known.update(exclude)
+        known.add(user_id)
+        mutual = {}
+        for friend in friends:
+            for candidate in self.adjacency[friend]:
+                if candidate not in known:
+                    mutual[candidate] = mutual.get(candidate, 0) + 1
+        return heapq.nsmallest(limit, mutual.items(), key=lambda item: (-item[1], item[0]))
+
+    def apply(self, change):
+        op, user1, user2 = change
+        if op == ADD:
+            self.add(user1, user2)
+        else:
+            self.remove(user1, user2)
+
+
+def _build():
+    from .models import Friendship
+
+    # A counter lost by the cache restarts from the current time, so that
+    # no process takes old change entries for new ones
+    cache.add(VERSION_KEY, int(time.time() * 1000), None)
+    graph = FriendGraph(cache.get(VERSION_KEY))
+    pairs = {}
+    for low, high in Friendship.objects.filter(status=1).values_list('pair_low', 'pair_high').order_by().iterator():
+        pairs.setdefault(low, []).append(high)
+        pairs.setdefault(high, []).append(low)
+    graph.adjacency = {user: array('i', sorted(friends)) for user, friends in pairs.items()}
+    return graph
+
+
+def _publish(change):
+    try:
+        version = cache.incr(VERSION_KEY)
+    except ValueError:
+        # Without a counter, every process rebuilds its graph anyway
+        return
+    cache.set(CHANGE_KEY % version, change, CHANGE_TIMEOUT)
+
+
+def record(op, user1, user2):
+    """
+    Publish an accepted (ADD) or deleted (REMOVE) friendship once the
+    transaction is committed
+    """
+    change = (op, user1, user2)
+    transaction.on_commit(lambda: _publish(change))
+
+
+def get_graph():
+    """
+    Return the graph of this process, brought up to date
+    """
+    from .models import DataVersion
+
+    global _graph
+    if not pagecache.cache_is_shared():
+        db_version = DataVersion.get(DataVersion.FRIENDSHIPS)
+        with _lock:
+            if _graph is None or _graph.db_version != db_version:
+                _graph = _build()
+                _graph.db_version = db_version
+            return _graph
+    version = cache.get(VERSION_KEY)
+    with _lock:
+        graph = _graph
+        if graph is None or version is None or not graph.version <= version <= graph.version + MAX_CHANGES:
+            graph = _build()
+        elif version > graph.version:
+            keys = [CHANGE_KEY % v for v in range(graph.version + 1, version + 1)]
+            changes = cache.get_many(keys)
+            if len(changes) < len(keys):
+                graph = _build()
+            else:
+                for key in keys:
+                    graph.apply(changes[key])
+                graph.version = version
+        _graph = graph
+    return graph
+
+
+def people_you_may_know(user, limit=5):
+    """
+    Return up to `limit` (user, number of mutual friends) suggested to a
+    user, leaving out the users with a pending friend request
+    """
+    from .models import CustomUser, Friendship
+
+    pending = Friendship.objects.filter(status=0).filter(sender=user) | Friendship.objects.filter(status=0).filter(target=user)
+    exclude = set()
+    for sender_id, target_id in pending.values_list('sender', 'target'):
+        exclude.update((sender_id, target_id))
+    suggestions = get_graph().suggestions(user.pk, limit, exclude)
+    users = CustomUser.objects.in_bulk([user_id for user_id, _ in suggestions])
+    return [(users[user_id], nb_mutual) for user_id, nb_mutual in suggestions if user_id in users]
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.db.models.functions import Greatest, Least
+
+from library.models import DataVersion, Friendship
+
+
+class Command(BaseCommand):
+    help = 'Fill the ordered user pair of the friendships written before it existed'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            # Both directions of a pair cannot be kept under the unique pair,
+            # the accepted friendship or else the oldest request wins
+            reverse = Friendship.objects.filter(sender=OuterRef('target'), target=OuterRef('sender'))
+            duplicates = (
+                Friendship.objects.annotate(has_reverse=Exists(reverse)).filter(has_reverse=True)
+                .order_by('-status', 'pk').values_list('pk', 'sender', 'target')
+            )
+            kept = set()
+            removed = []
+            for pk, sender, target in duplicates:
+                pair = tuple(sorted((sender, target)))
+                if pair in kept:
+                    removed.append(pk)
+                else:
+                    kept.add(pair)
+            Friendship.objects.filter(pk__in=removed).delete()
+            nb_filled = Friendship.objects.filter(pair_low__isnull=True).update(
+                pair_low=Least('sender', 'target'),
+                pair_high=Greatest('sender', 'target'),
+            )
+            DataVersion.bump(DataVersion.FRIENDSHIPS)
+        self.stdout.write('Removed %d duplicate friendships' % len(removed))
+        self.stdout.write(self.style.SUCCESS('Filled the pair of %d friendships' % nb_filled))
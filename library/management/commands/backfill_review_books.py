@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Subquery
+
+from library import pagecache
+from library.models import Rating, Review
+
+
+class Command(BaseCommand):
+    help = 'Fill the book of the reviews written before it was stored on them'
+
+    def handle(self, *args, **options):
+        book = Rating.objects.filter(pk=OuterRef('associated_rating')).values('book')[:1]
+        with transaction.atomic():
+            book_ids = set(
+                Review.objects.filter(book__isnull=True).values_list('associated_rating__book', flat=True)
+            )
+            nb_filled = Review.objects.filter(book__isnull=True).update(book=Subquery(book))
+            # The cached pages of these books did not show the reviews
+            for book_id in book_ids:
+                pagecache.bump_book(book_id, catalog=False)
+        self.stdout.write(self.style.SUCCESS('Filled the book of %d reviews' % nb_filled))
@@ -0,0 +1,196 @@
+import json
+import platform
+import statistics
+import subprocess
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver, reverse
+
+from library import urls
+from library.models import Book, CustomUser, Friendship, Review
+
+# Views changing data on GET, never benchmarked
+UNSAFE = {
+    'ratebook', 'add_to_cart', 'remove_from_cart', 'delete_book', 'accept_publication', 'reject_publication',
+    'delete_review', 'report_review', 'keep_review', 'vote_review', 'request_publisher', 'send_friend_request',
+    'accept_friend_request', 'reject_friend_request', 'delete_friend', 'incr_balance', 'block_user',
+    'unblock_user', 'accept_publisher_request', 'reject_publisher_request',
+}
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = 'Measure the latency and the number of queries of every view of the library'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Measured requests per URL')
+        parser.add_argument('--warmup', type=int, default=2, help='Unmeasured requests per URL')
+        parser.add_argument('--user', default=None, help='Log in as this user (default: the user with the most friends)')
+        parser.add_argument('--anonymous', action='store_true', help='Do not log in')
+        parser.add_argument('--clear-cache', action='store_true', help='Clear the cache before every request')
+        parser.add_argument('--only', action='append', help='Only benchmark these URL names')
+        parser.add_argument('--output', default=None, help='Write the results to this JSON file')
+        parser.add_argument('--compare', default=None, help='JSON file of a previous run to compare with')
+
+    def handle(self, *args, **options):
+        self.client = Client()
+        user = None
+        if not options['anonymous']:
+            user = self.benchmark_user(options['user'])
+            self.client.force_login(user)
+        samples = self.samples(user)
+
+        results = {}
+        for name, url in self.urls(samples, options['only']):
+            results[name] = self.measure(url, options['repeat'], options['warmup'], options['clear_cache'])
+            r = results[name]
+            self.stdout.write('%-28s %3d  p50 %7.1fms  p90 %7.1fms  p99 %7.1fms  %4d queries' % (
+                name, r['status'], r['p50_ms'], r['p90_ms'], r['p99_ms'], r['queries'],
+            ))
+
+        report = {
+            'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'user': user.username if user else None,
+            'repeat': options['repeat'],
+            'clear_cache': options['clear_cache'],
+            'dataset': {
+                'books': Book.objects.count(),
+                'users': CustomUser.objects.count(),
+                'reviews': Review.objects.count(),
+            },
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS('Results written to %s' % options['output']))
+        if options['compare']:
+            self.compare(options['compare'], results)
+
+    def benchmark_user(self, username):
+        if username:
+            try:
+                return CustomUser.objects.get(username=username)
+            except CustomUser.DoesNotExist:
+                raise CommandError('Unknown user %s' % username)
+        senders = (
+            Friendship.objects.filter(status=1).values('sender')
+            .annotate(n=Count('pk')).order_by('-n').values_list('sender', flat=True)[:1]
+        )
+        user = CustomUser.objects.filter(pk__in=list(senders)).first() or CustomUser.objects.first()
+        if user is None:
+            raise CommandError('No user in the database, run generate_dataset first')
+        return user
+
+    def samples(self, user):
+        """
+        Values of the URL parameters: the most rated book, its most
+        commented review, the benchmark user and a word of the book title
+        to search
+        """
+        book = Book.objects.published().order_by('-rating_count').first()
+        if book is None:
+            raise CommandError('No published book in the database, run generate_dataset first')
+        review = (
+            Review.objects.filter(book=book).annotate(n=Count('comment')).order_by('-n').first()
+            or Review.objects.first()
+        )
+        return {
+            'bookid': review.book_id if review else book.pk,
+            'reviewid': review.pk if review else None,
+            'user': user.username if user else CustomUser.objects.values_list('username', flat=True).first(),
+            'page': 1,
+            'query': book.title.split()[0] if book.title.split() else book.title,
+        }
+
+    def urls(self, samples, only):
+        """
+        Yield (name, url) for every safe URL of library/urls.py
+        """
+        seen = set()
+        for pattern in urls.urlpatterns:
+            if isinstance(pattern, URLResolver) or not isinstance(pattern, URLPattern):
+                continue
+            name = pattern.name
+            params = list(pattern.pattern.regex.groupindex)
+            key = (name, tuple(params))
+            if not name or name in UNSAFE or key in seen or (only and name not in only):
+                continue
+            seen.add(key)
+            if any(samples.get(p) is None for p in params):
+                self.stdout.write('%-28s skipped, no sample for %s' % (name, ', '.join(params)))
+                continue
+            label = name + ''.join('[%s]' % p for p in params if p == 'page')
+            url = reverse('library:' + name, kwargs={p: samples[p] for p in params})
+            if name in ('search', 'search_json'):
+                url += '?' + urlencode({'q': samples['query']})
+            yield label, url
+
+    def measure(self, url, repeat, warmup, clear_cache):
+        for _ in range(warmup):
+            self.client.get(url)
+        times = []
+        queries = []
+        status = None
+        for _ in range(repeat):
+            if clear_cache:
+                cache.clear()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = self.client.get(url)
+                times.append((time.perf_counter() - start) * 1000)
+            queries.append(len(captured))
+            status = response.status_code
+        result = {
+            'url': url,
+            'status': status,
+            'mean_ms': statistics.mean(times),
+            'min_ms': min(times),
+            'max_ms': max(times),
+            'queries': max(queries),
+        }
+        for p in PERCENTILES:
+            result['p%d_ms' % p] = percentile(times, p)
+        return result
+
+    def compare(self, path, results):
+        with open(path) as f:
+            previous = json.load(f)['results']
+        self.stdout.write('Compared with %s:' % path)
+        for name, result in sorted(results.items()):
+            old = previous.get(name)
+            if old is None:
+                continue
+            ratio = result['p50_ms'] / old['p50_ms'] if old['p50_ms'] else float('inf')
+            line = '%-28s p50 %7.1fms -> %7.1fms (x%.2f)  queries %d -> %d' % (
+                name, old['p50_ms'], result['p50_ms'], ratio, old['queries'], result['queries'],
+            )
+            if ratio > 1.2 or result['queries'] > old['queries']:
+                line = self.style.WARNING(line)
+            self.stdout.write(line)
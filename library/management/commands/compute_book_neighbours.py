@@ -0,0 +1,80 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from library import pagecache
+from library.models import Book, BookNeighbour, CustomUser, Rating
+
+# Maximum number of ISBNs in one IN clause
+CHUNK_SIZE = 500
+
+
+def chunks(items):
+    items = list(items)
+    for start in range(0, len(items), CHUNK_SIZE):
+        yield items[start:start + CHUNK_SIZE]
+
+
+def set_stale(isbns, value):
+    for chunk in chunks(isbns):
+        Book.objects.filter(pk__in=chunk).update(neighbours_stale=value)
+
+
+class Command(BaseCommand):
+    help = 'Compute the books most similar to every book from the ratings and the purchases'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=10, help='Number of neighbours stored per book')
+        parser.add_argument('--block-size', type=int, default=256, help='Number of books compared at a time')
+        parser.add_argument('--full', action='store_true', help='Recompute every book, not only the stale ones')
+
+    def handle(self, *args, **options):
+        try:
+            from library import recommender
+        except ImportError:
+            raise CommandError('NumPy and SciPy are required to compute the neighbours')
+
+        stale = Book.objects.all() if options['full'] else Book.objects.filter(neighbours_stale=True)
+        stale = set(stale.values_list('isbn', flat=True))
+        if not options['full']:
+            # The lists containing a stale book change with it
+            for chunk in list(chunks(stale)):
+                stale.update(BookNeighbour.objects.filter(neighbour__in=chunk).values_list('book', flat=True))
+        if not stale:
+            self.stdout.write('No book to refresh')
+            return
+
+        # Cleared before reading the ratings: a rating written during the run
+        # flags its book again for the next run
+        set_stale(stale, False)
+        try:
+            nb_books = self.refresh(recommender, stale, options['top_k'], options['block_size'])
+        except BaseException:
+            set_stale(stale, True)
+            raise
+        self.stdout.write(self.style.SUCCESS('Computed the neighbours of %d books' % nb_books))
+
+    def refresh(self, recommender, stale, k, block_size):
+        ratings = Rating.objects.values_list('user', 'book', 'evaluation').order_by().iterator()
+        purchases = CustomUser.books.through.objects.values_list('customuser', 'book').order_by().iterator()
+        matrix, isbns = recommender.build_matrix(ratings, purchases)
+
+        columns = [j for j, isbn in enumerate(isbns) if isbn in stale]
+        # Books nobody rated nor bought have no neighbour
+        unknown = stale.difference(isbns)
+        for chunk in chunks(unknown):
+            BookNeighbour.objects.filter(book__in=chunk).delete()
+
+        neighbours = recommender.top_neighbours(matrix, columns, k, block_size)
+        for start in range(0, len(columns), block_size):
+            block = [next(neighbours) for _ in columns[start:start + block_size]]
+            with transaction.atomic():
+                BookNeighbour.objects.filter(book__in=[isbns[j] for j, _ in block]).delete()
+                BookNeighbour.objects.bulk_create([
+                    BookNeighbour(book_id=isbns[j], neighbour_id=isbns[n], score=score)
+                    for j, best in block for n, score in best
+                ])
+                for j, _ in block:
+                    pagecache.bump_book(isbns[j], catalog=False)
+        for isbn in unknown:
+            pagecache.bump_book(isbn, catalog=False)
+        return len(stale)
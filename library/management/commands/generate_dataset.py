@@ -0,0 +1,104 @@
+import os
+import random
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from fill_db import bulk, bx, parallel, synthetic
+from library import facets
+from library.models import (
+    Book, Category, Comment, CustomUser, DataVersion, Friendship, Rating, Recommendation, Review, ReviewVote,
+)
+
+MODELS = {
+    'users': CustomUser,
+    'ratings': Rating,
+    'purchases': CustomUser.books.through,
+    'reviews': Review,
+    'comments': Comment,
+    'votes': ReviewVote,
+    'friendships': Friendship,
+    'recommendations': Recommendation,
+}
+# Password of every generated user
+PASSWORD = 'synthetic'
+
+
+class Command(BaseCommand):
+    help = 'Generate a seeded synthetic dataset at a given scale, for benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=sorted(synthetic.SCALES), default='small')
+        parser.add_argument('--users', type=int, default=None, help='Number of users (overrides the scale)')
+        parser.add_argument('--books', type=int, default=None, help='Number of books (overrides the scale)')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of users generated and inserted at a time')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        for name, value in sorted(synthetic.DEFAULTS.items()):
+            parser.add_argument('--' + name.replace('_', '-'), type=type(value), default=value)
+
+    def handle(self, *args, **options):
+        seed = options['seed']
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        self.stdout.write('Using seed %d' % seed)
+        scale = synthetic.SCALES[options['scale']]
+        nb_users = options['users'] or scale['users']
+        nb_books = options['books'] or scale['books']
+        chunk_size = max(1, options['chunk_size'])
+        batch_size = options['batch_size']
+        generation = {name: options[name] for name in synthetic.DEFAULTS}
+        started = time.perf_counter()
+
+        path = os.path.join(settings.BASE_DIR, 'fill_db', 'data_categories.csv')
+        names = bx.read_names(path)
+        existing = set(Category.objects.filter(name__in=names).values_list('name', flat=True))
+        Category.objects.bulk_create([Category(name=n) for n in names if n not in existing])
+        category_ids = list(Category.objects.values_list('pk', flat=True))
+
+        book_start = Book.objects.filter(isbn__startswith='999-').count()
+        for index, start in enumerate(range(0, nb_books, chunk_size * 10)):
+            end = min(nb_books, start + chunk_size * 10)
+            rng = parallel.shard_rng(seed, 'books', index)
+            with transaction.atomic():
+                rows = list(synthetic.books(rng, book_start + start, book_start + end, category_ids))
+                bulk.insert(Book, rows, batch_size)
+        self.stdout.write('books: %d rows' % nb_books)
+
+        # Ids following the ones already used
+        start = {
+            name: (MODELS[name].objects.aggregate(m=Max('id'))['m'] or 0) + 1
+            for name in ('users', 'ratings', 'reviews', 'comments')
+        }
+        password = bx.hash_passwords([PASSWORD], iterations=1)[0]
+        totals = dict.fromkeys(MODELS, 0)
+        first_user = start['users']
+        for index, chunk_start in enumerate(range(0, nb_users, chunk_size)):
+            user_ids = list(range(first_user + chunk_start, first_user + min(nb_users, chunk_start + chunk_size)))
+            chunk = synthetic.chunk(seed, index, user_ids, book_start + nb_books, start, password, generation)
+            with transaction.atomic():
+                for name, model in MODELS.items():
+                    for i in range(0, len(chunk.rows[name]), batch_size):
+                        bulk.insert(model, chunk.rows[name][i:i + batch_size], batch_size)
+                    totals[name] += len(chunk.rows[name])
+            self.stdout.write('users: chunk %d done, %d rows' % (index, len(chunk)))
+        bulk.reset_sequences(CustomUser, Rating, Review, Comment)
+        for name, total in totals.items():
+            self.stdout.write('%s: %d rows' % (name, total))
+
+        # Bulk inserts bypass the save methods, every derived value is rebuilt
+        call_command('rebuild_rating_totals', stdout=self.stdout)
+        call_command('rebuild_vote_totals', stdout=self.stdout)
+        call_command('rebuild_search_index', stdout=self.stdout)
+        call_command('reconcile_moderation_counters', stdout=self.stdout)
+        facets.invalidate()
+        DataVersion.bump(DataVersion.FRIENDSHIPS)
+        self.stdout.write(self.style.SUCCESS(
+            'Generated %d users and %d books in %.1fs (seed %d, password "%s")' % (
+                nb_users, nb_books, time.perf_counter() - started, seed, PASSWORD,
+            )
+        ))
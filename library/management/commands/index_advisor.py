@@ -0,0 +1,134 @@
+import json
+import re
+
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from . import benchmark_views
+
+# Estimated and actual rows differing by more than this factor are reported
+MISESTIMATE_FACTOR = 10
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?$')
+
+
+class Command(benchmark_views.Command):
+    help = 'Explain the queries of every view of the library and report sequential scans and misestimated rows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', default=None, help='Log in as this user (default: the user with the most friends)')
+        parser.add_argument('--anonymous', action='store_true', help='Do not log in')
+        parser.add_argument('--only', action='append', help='Only explain the queries of these URL names')
+        parser.add_argument(
+            '--min-rows', type=int, default=1000,
+            help='Do not report sequential scans of tables with fewer rows',
+        )
+        parser.add_argument('--factor', type=float, default=MISESTIMATE_FACTOR, help='Misestimate factor reported')
+        parser.add_argument('--plans', action='store_true', help='Print the whole plan of every query')
+
+    def handle(self, *args, **options):
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            raise CommandError('index_advisor only supports PostgreSQL and SQLite')
+        self.options = options
+        self.table_sizes = {}
+        self.client = Client()
+        user = None
+        if not options['anonymous']:
+            user = self.benchmark_user(options['user'])
+            self.client.force_login(user)
+        samples = self.samples(user)
+
+        nb_problems = 0
+        for name, url in self.urls(samples, options['only']):
+            with CaptureQueriesContext(connection) as captured:
+                self.client.get(url)
+            queries = []
+            for query in captured.captured_queries:
+                sql = query['sql']
+                if sql.lstrip().upper().startswith('SELECT') and sql not in queries:
+                    queries.append(sql)
+            self.stdout.write(self.style.MIGRATE_HEADING('%s %s (%d queries)' % (name, url, len(queries))))
+            for sql in queries:
+                problems, plan = self.explain(sql)
+                nb_problems += len(problems)
+                if problems or options['plans']:
+                    self.stdout.write('  ' + sql)
+                for problem in problems:
+                    self.stdout.write(self.style.WARNING('    ' + problem))
+                if options['plans']:
+                    self.stdout.write('\n'.join('    | ' + line for line in plan))
+        self.stdout.write(self.style.SUCCESS('%d problems found' % nb_problems))
+
+    def explain(self, sql):
+        """
+        Return the problems found in the plan of a query and the plan as
+        lines of text
+        """
+        # EXPLAIN ANALYZE runs the query, whatever it does is rolled back
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                if connection.vendor == 'postgresql':
+                    cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql)
+                    result = cursor.fetchone()[0]
+                    if isinstance(result, str):
+                        result = json.loads(result)
+                    problems, plan = self.postgres_problems(result[0]['Plan'])
+                else:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                    problems, plan = self.sqlite_problems(cursor.fetchall())
+            transaction.set_rollback(True)
+        return problems, plan
+
+    def postgres_problems(self, node, depth=0):
+        problems = []
+        loops = node.get('Actual Loops', 1)
+        estimated, actual = node['Plan Rows'], node.get('Actual Rows', 0)
+        plan = ['%s%s%s  (estimated %d rows, actual %d rows x %d loops)' % (
+            '  ' * depth, node['Node Type'], ' on ' + node['Relation Name'] if 'Relation Name' in node else '',
+            estimated, actual, loops,
+        )]
+        if node['Node Type'] == 'Seq Scan':
+            size = self.table_size(node['Relation Name'])
+            if size >= self.options['min_rows']:
+                problems.append('sequential scan of %s (%d rows%s)' % (
+                    node['Relation Name'], size, ', filter ' + node['Filter'] if 'Filter' in node else '',
+                ))
+        # Planner estimates are at least one row
+        if max(estimated, 1) > self.options['factor'] * max(actual, 1) or \
+                max(actual, 1) > self.options['factor'] * max(estimated, 1):
+            problems.append('%s%s: estimated %d rows, actual %d' % (
+                node['Node Type'], ' on ' + node['Relation Name'] if 'Relation Name' in node else '',
+                estimated, actual,
+            ))
+        for child in node.get('Plans', ()):
+            child_problems, child_plan = self.postgres_problems(child, depth + 1)
+            problems.extend(child_problems)
+            plan.extend(child_plan)
+        return problems, plan
+
+    def sqlite_problems(self, rows):
+        # SQLite has no estimates to compare, only the scans are reported
+        problems = []
+        plan = []
+        for row in rows:
+            detail = row[-1]
+            plan.append(detail)
+            match = SQLITE_SCAN.match(detail)
+            if match:
+                # Scans of subqueries have no table size and are not reported
+                size = self.table_size(match.group(1))
+                if size is not None and size >= self.options['min_rows']:
+                    problems.append('full scan of %s (%d rows)' % (match.group(1), size))
+        return problems, plan
+
+    def table_size(self, table):
+        if table not in self.table_sizes:
+            if table in connection.introspection.table_names():
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT COUNT(*) FROM ' + connection.ops.quote_name(table))
+                    self.table_sizes[table] = cursor.fetchone()[0]
+            else:
+                # An alias of a subquery
+                self.table_sizes[table] = None
+        return self.table_sizes[table]
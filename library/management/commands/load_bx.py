@@ -0,0 +1,156 @@
+import json
+import os
+import random
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from fill_db import bulk, bx, parallel
+from library import facets, pagecache
+from library.models import Book, Category, CustomUser, Rating
+
+
+STAGES = ('users', 'books', 'ratings')
+FILES = {
+    'users': 'BX-Users.csv',
+    'books': 'BX-Books.csv',
+    'ratings': 'BX-Book-Ratings.csv',
+}
+MODELS = {
+    'users': CustomUser,
+    'books': Book,
+    'ratings': Rating,
+}
+# Nobody knows the generated passwords, hashing them at the full cost of
+# PBKDF2 would make the users stage CPU bound
+BULK_HASH_ITERATIONS = 1000
+
+
+class Command(BaseCommand):
+    help = 'Load the Book-Crossing CSV dump (users, books and ratings) into the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dump_dir', help='Directory containing the BX-*.csv, FirstNames.csv and LastNames.csv files')
+        parser.add_argument('--stage', choices=STAGES, action='append', help='Only load these stages (default: all)')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--workers', type=int, default=1, help='Number of processes parsing and transforming the files')
+        parser.add_argument(
+            '--shard-size', type=int, default=None,
+            help='Size of the shards of the files, in bytes (default: %d, or the one of the checkpoint)' % parallel.DEFAULT_SHARD_SIZE,
+        )
+        parser.add_argument(
+            '--seed', type=int, default=None,
+            help='Seed of the generated names, emails and dates (default: random, or the one of the checkpoint)',
+        )
+        parser.add_argument(
+            '--hash-iterations', type=int, default=BULK_HASH_ITERATIONS,
+            help='PBKDF2 iterations for the generated passwords, 0 for the full cost of the hasher '
+                 '(default: %(default)s, the hash is upgraded when the user logs in)',
+        )
+        parser.add_argument('--checkpoint', default=None, help='Checkpoint file (default: <dump_dir>/.load_bx_checkpoint.json)')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint and load everything again')
+
+    def handle(self, *args, **options):
+        self.dump_dir = options['dump_dir']
+        self.batch_size = options['batch_size']
+        self.workers = max(1, options['workers'])
+        self.checkpoint_path = options['checkpoint'] or os.path.join(self.dump_dir, '.load_bx_checkpoint.json')
+        self.checkpoint = {} if options['restart'] else self.read_checkpoint()
+        # The shards and the values generated for their rows depend on the
+        # seed and the shard size: resuming with others would load some
+        # lines twice or skip them
+        for name in ('seed', 'shard_size') if self.checkpoint else ():
+            option = '--' + name.replace('_', '-')
+            if self.checkpoint.get(name) is None:
+                raise CommandError('The checkpoint %s has no %s, use --restart' % (self.checkpoint_path, option))
+            if options[name] is not None and options[name] != self.checkpoint[name]:
+                raise CommandError(
+                    'The checkpoint %s was written with %s %s, resume with the same value or use --restart'
+                    % (self.checkpoint_path, option, self.checkpoint[name])
+                )
+        seed = self.checkpoint.get('seed', options['seed'])
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+            self.stdout.write('Using seed %d' % seed)
+        self.shard_size = self.checkpoint.get('shard_size', options['shard_size'] or parallel.DEFAULT_SHARD_SIZE)
+        self.checkpoint.update(seed=seed, shard_size=self.shard_size)
+        self.context = {'seed': seed, 'hash_iterations': options['hash_iterations']}
+
+        for stage in STAGES:
+            if options['stage'] and stage not in options['stage']:
+                continue
+            path = os.path.join(self.dump_dir, FILES[stage])
+            if not os.path.exists(path):
+                raise CommandError('%s does not exist' % path)
+            state = self.checkpoint.get(stage, {'offset': 0, 'rows': 0, 'done': False})
+            if state['done']:
+                self.stdout.write('%s: already loaded (%d rows), skipping' % (stage, state['rows']))
+                continue
+            getattr(self, 'prepare_' + stage)()
+            self.load_stage(stage, path, state)
+
+        # Bulk inserts bypass Rating.save, so rating totals are rebuilt once
+        call_command('rebuild_rating_totals', stdout=self.stdout)
+        call_command('rebuild_search_index', stdout=self.stdout)
+        facets.invalidate()
+        pagecache.bump_catalog()
+
+    def read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return {}
+        with open(self.checkpoint_path) as f:
+            return json.load(f)
+
+    def write_checkpoint(self, stage, state):
+        self.checkpoint[stage] = state
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def prepare_users(self):
+        self.context['first_names'] = bx.read_names(os.path.join(self.dump_dir, 'FirstNames.csv'))
+        self.context['last_names'] = bx.read_names(os.path.join(self.dump_dir, 'LastNames.csv'))
+
+    def prepare_books(self):
+        path = os.path.join(settings.BASE_DIR, 'fill_db', 'data_categories.csv')
+        names = bx.read_names(path)
+        existing = set(Category.objects.filter(name__in=names).values_list('name', flat=True))
+        Category.objects.bulk_create([Category(name=n) for n in names if n not in existing])
+        self.context['category_ids'] = list(Category.objects.values_list('pk', flat=True))
+        self.context['last_year'] = Book.YEAR_CHOICES[0][0]
+
+    def prepare_ratings(self):
+        # Hash sets, so that checking a rating line is O(1)
+        self.context['isbns'] = set(Book.objects.values_list('isbn', flat=True))
+        self.context['user_ids'] = set(CustomUser.objects.values_list('pk', flat=True))
+
+    def load_stage(self, stage, path, state):
+        timer = parallel.StageTimer(stage, self.workers)
+        if state['offset']:
+            self.stdout.write('%s: resuming at byte %d (%d rows already loaded)' % (stage, state['offset'], state['rows']))
+        shards = parallel.iter_shards(stage, path, self.context, self.workers, self.shard_size, start=state['offset'])
+        for index, end, rows, parse_time, transform_time in shards:
+            timer.add_shard(parse_time, transform_time, len(rows))
+            t0 = time.perf_counter()
+            # A shard is inserted in a single transaction so that the
+            # checkpoint always falls on a shard boundary
+            with transaction.atomic():
+                for i in range(0, len(rows), self.batch_size):
+                    self.insert(MODELS[stage], rows[i:i + self.batch_size])
+            timer.insert += time.perf_counter() - t0
+            state['offset'] = end
+            state['rows'] += len(rows)
+            self.write_checkpoint(stage, state)
+            self.stdout.write('%s: shard %d done, %d rows loaded' % (stage, index, state['rows']))
+        state['done'] = True
+        self.write_checkpoint(stage, state)
+        if stage == 'users':
+            bulk.reset_sequences(CustomUser)
+        self.stdout.write(timer.report())
+
+    def insert(self, model, rows):
+        bulk.insert(model, rows, self.batch_size)
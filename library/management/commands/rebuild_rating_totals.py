@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from library.models import Book, Rating
+
+
+class Command(BaseCommand):
+    help = 'Recompute the rating count and rating sum stored on every book'
+
+    def handle(self, *args, **options):
+        ratings = Rating.objects.filter(book=OuterRef('pk')).order_by().values('book')
+        count = ratings.annotate(c=Count('pk')).values('c')
+        total = ratings.annotate(s=Sum('evaluation')).values('s')
+        with transaction.atomic():
+            nb_books = Book.objects.update(
+                rating_count=Coalesce(Subquery(count, output_field=IntegerField()), 0),
+                rating_sum=Coalesce(Subquery(total, output_field=IntegerField()), 0),
+            )
+        self.stdout.write(self.style.SUCCESS('Rebuilt rating totals of %d books' % nb_books))
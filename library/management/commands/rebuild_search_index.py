@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from library import search
+from library.models import Book, Review
+
+
+class Command(BaseCommand):
+    help = 'Recreate the full-text search index of the books and reviews'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            search.drop_tables()
+            search.create_tables()
+            nb_books = 0
+            for book in Book.objects.select_related('category').iterator():
+                search.index_book(book)
+                nb_books += 1
+            nb_reviews = 0
+            for review in Review.objects.iterator():
+                search.index_review(review, review.book_id)
+                nb_reviews += 1
+        self.stdout.write(self.style.SUCCESS('Indexed %d books and %d reviews' % (nb_books, nb_reviews)))
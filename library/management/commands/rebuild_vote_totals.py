@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from library import votebuffer
+from library.models import Review, ReviewVote
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the like and dislike totals stored on every review from the votes. '
+        'Run it while the web processes are stopped, the totals they buffer would be counted twice.'
+    )
+
+    def handle(self, *args, **options):
+        votebuffer.flush()
+        votes = ReviewVote.objects.filter(review=OuterRef('pk')).order_by().values('review')
+        likes = votes.filter(value=1).annotate(c=Count('pk')).values('c')
+        dislikes = votes.filter(value=-1).annotate(c=Count('pk')).values('c')
+        with transaction.atomic():
+            nb_reviews = Review.objects.update(
+                nb_likes=Coalesce(Subquery(likes, output_field=IntegerField()), 0),
+                nb_dislikes=Coalesce(Subquery(dislikes, output_field=IntegerField()), 0),
+            )
+        self.stdout.write(self.style.SUCCESS('Rebuilt vote totals of %d reviews' % nb_reviews))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from library.models import ModerationCounter, ReportedReview, Review
+
+
+class Command(BaseCommand):
+    help = 'Recount the pending moderation requests and fix the stored counters'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--fill-queue', action='store_true',
+            help='Queue the reviews over the report threshold that are not in the moderation queue',
+        )
+
+    def handle(self, *args, **options):
+        if options['fill_queue']:
+            reviews = Review.objects.filter(
+                nb_reports__gte=Review.REPORTS_THRESHOLD, reportedreview__isnull=True
+            ).values_list('pk', flat=True)
+            queued = ReportedReview.objects.bulk_create([ReportedReview(review_id=pk) for pk in reviews])
+            self.stdout.write('Queued %d reported reviews' % len(queued))
+        drift = ModerationCounter.reconcile()
+        for name, delta in sorted(drift.items()):
+            if delta:
+                self.stdout.write(self.style.WARNING('%s: corrected by %+d' % (name, delta)))
+            else:
+                self.stdout.write('%s: ok' % name)
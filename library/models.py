@@ -1,6 +1,9 @@
 import datetime
 
-from django.db import models
+from django.core.cache import cache
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 from django.core.validators import RegexValidator, MinValueValidator
@@ -8,6 +11,8 @@ from django.core.exceptions import ValidationError
 from django.contrib.auth.models import AbstractUser
 from django.urls import reverse, reverse_lazy
 
+from . import covers, facets, friendgraph, pagecache, search, votebuffer
+
 
 
 class CustomUser(AbstractUser):
@@ -54,6 +59,39 @@ class CustomUser(AbstractUser):
     def get_absolute_url(self):
         return reverse('library:profile', kwargs={'user':self.username})
 
+    # Results of a purchase
+    NOT_ENOUGH_MONEY = 0
+    ALREADY_OWNED = 1
+    BOUGHT = 2
+
+    def buy(self, isbns):
+        """
+        Buy the published books of `isbns` not owned yet, in one transaction
+        with a single balance update. Return (result, bought books).
+        """
+        owned = CustomUser.books.through.objects.filter(customuser_id=self.pk, book_id=OuterRef('pk'))
+        with transaction.atomic():
+            # Purchases of the same user run one after the other, so the
+            # books cannot be bought twice
+            CustomUser.objects.select_for_update().filter(pk=self.pk).values_list('pk').get()
+            books = list(
+                Book.objects.published().filter(pk__in=isbns)
+                .annotate(owned=Exists(owned)).filter(owned=False)
+            )
+            if not books:
+                return CustomUser.ALREADY_OWNED, []
+            total = sum(book.price for book in books)
+            if not CustomUser.objects.filter(pk=self.pk, balance__gte=total).update(balance=F('balance') - total):
+                return CustomUser.NOT_ENOUGH_MONEY, []
+            CustomUser.books.through.objects.bulk_create([
+                CustomUser.books.through(customuser_id=self.pk, book_id=book.pk) for book in books
+            ])
+            Book.objects.filter(pk__in=[book.pk for book in books]).update(neighbours_stale=True)
+            for book in books:
+                pagecache.bump_book(book.pk, catalog=False)
+        self.balance -= total
+        return CustomUser.BOUGHT, books
+
 
 class Friendship(models.Model):
     def clean(self):
@@ -62,8 +100,27 @@ class Friendship(models.Model):
             raise ValidationError("A user cannot be friend with himself.")
 
     def save(self, *args, **kwargs):
+        self.pair_low, self.pair_high = sorted((self.sender_id, self.target_id))
         self.full_clean()
-        return super(Friendship, self).save(*args, **kwargs)
+        with transaction.atomic():
+            result = super(Friendship, self).save(*args, **kwargs)
+            Friendship.invalidate_friends(self.sender_id, self.target_id)
+            if self.status == 1:
+                friendgraph.record(friendgraph.ADD, self.sender_id, self.target_id)
+                DataVersion.bump(DataVersion.FRIENDSHIPS)
+        return result
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            result = super(Friendship, self).delete(*args, **kwargs)
+            Friendship.invalidate_friends(self.sender_id, self.target_id)
+            if self.status == 1:
+                friendgraph.record(friendgraph.REMOVE, self.sender_id, self.target_id)
+                DataVersion.bump(DataVersion.FRIENDSHIPS)
+        return result
+
+    FRIENDS_CACHE_KEY = 'library:friends:%d'
+    FRIENDS_CACHE_TIMEOUT = 60 * 60
 
     FRIEND_STATUS_CHOICES = (
         (0, 'Waiting for approval'),
@@ -74,9 +131,46 @@ class Friendship(models.Model):
     target = models.ForeignKey('CustomUser', related_name='target', on_delete=models.CASCADE)
     date = models.DateTimeField(auto_now_add=True)
     status = models.IntegerField(choices=FRIEND_STATUS_CHOICES, default=0)
+    # The two users ordered by id, so that a pair of users has a single
+    # friendship whatever its direction. Null only in the rows written before
+    # these columns existed, until backfill_friendship_pairs is run
+    pair_low = models.IntegerField(null=True, editable=False)
+    pair_high = models.IntegerField(null=True, editable=False)
 
     class Meta:
-        unique_together = ('sender', 'target')
+        unique_together = (('sender', 'target'), ('pair_low', 'pair_high'))
+        # Friend requests received, accepted friends of the target side
+        indexes = [models.Index(fields=['target', 'status'])]
+
+    @staticmethod
+    def between(user1, user2):
+        """
+        Return the friendship between two users, in any direction, or None
+        """
+        low, high = sorted((user1.pk, user2.pk))
+        return Friendship.objects.filter(pair_low=low, pair_high=high).first()
+
+    @staticmethod
+    def friend_ids(user):
+        """
+        Return the set of ids of the accepted friends of a user
+        """
+        # A process-local cache would not see the friendships changed by the
+        # other processes
+        shared = pagecache.cache_is_shared()
+        key = Friendship.FRIENDS_CACHE_KEY % user.pk
+        ids = cache.get(key) if shared else None
+        if ids is None:
+            ids = set(Friendship.objects.filter(sender=user, status=1).values_list('target', flat=True))
+            ids.update(Friendship.objects.filter(target=user, status=1).values_list('sender', flat=True))
+            if shared:
+                cache.set(key, ids, Friendship.FRIENDS_CACHE_TIMEOUT)
+        return ids
+
+    @staticmethod
+    def invalidate_friends(*user_ids):
+        keys = [Friendship.FRIENDS_CACHE_KEY % i for i in user_ids]
+        transaction.on_commit(lambda: cache.delete_many(keys))
 
     def __str__(self):
         if self.status == 0:
@@ -93,6 +187,27 @@ class Recommendation(models.Model):
     book = models.ForeignKey('Book', on_delete=models.CASCADE)
     # TODO add a message with the recommendation
 
+    class Meta:
+        # Recommendations received, and whether a book was already
+        # recommended to a friend in candidates()
+        indexes = [models.Index(fields=['target', 'sender', 'book'])]
+
+    @staticmethod
+    def candidates(sender, book):
+        """
+        Friends of `sender` who do not own `book` and to whom `sender` has
+        not recommended it yet, in a single query
+        """
+        owns = CustomUser.books.through.objects.filter(customuser=OuterRef('pk'), book=book)
+        recommended = Recommendation.objects.filter(sender=sender, target=OuterRef('pk'), book=book)
+        friends = Q(pk__in=Friendship.objects.filter(sender=sender, status=1).values('target')) | \
+                  Q(pk__in=Friendship.objects.filter(target=sender, status=1).values('sender'))
+        return CustomUser.objects.filter(friends).annotate(
+            owns_book=Exists(owns), already_recommended=Exists(recommended)
+        ).filter(
+            owns_book=False, already_recommended=False
+        ).order_by('username')
+
     def __str__(self):
         return str(self.sender) + " -> " + str(self.target) + " | " + str(self.book)
 
@@ -125,32 +240,211 @@ class Rating(models.Model):
     class Meta:
         unique_together = ('user', 'book')
 
+    def save(self, *args, **kwargs):
+        # Keep the rating totals stored on Book in sync with this rating
+        with transaction.atomic():
+            previous = None
+            if self.pk is not None:
+                previous = Rating.objects.filter(pk=self.pk).values_list('book', 'evaluation').first()
+            super(Rating, self).save(*args, **kwargs)
+            if previous is not None:
+                Book.update_rating_totals(previous[0], -1, -previous[1])
+            Book.update_rating_totals(self.book_id, 1, self.evaluation)
+            pagecache.bump_book(self.book_id)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            book_id, evaluation = self.book_id, self.evaluation
+            result = super(Rating, self).delete(*args, **kwargs)
+            Book.update_rating_totals(book_id, -1, -evaluation)
+            pagecache.bump_book(book_id)
+        return result
+
     def __str__(self):
         return str(self.user) + " | " + str(self.book) + " | " + str(self.evaluation) + "/5"
 
 
 
 
+class ReviewQuerySet(models.QuerySet):
+    def for_listing(self):
+        # The author, the rating and the number of comments of every review
+        # come with the review itself
+        comments = Comment.objects.filter(parent_review=OuterRef('pk')).order_by().values('parent_review')
+        return self.select_related('associated_rating__user').annotate(
+            nb_comments=Coalesce(Subquery(comments.annotate(c=Count('pk')).values('c'), output_field=models.IntegerField()), 0)
+        )
+
+
 class Review(models.Model):
     """
     Review model
     """
 
+    objects = ReviewQuerySet.as_manager()
+
+    # Number of reports after which a review is shown to the moderators
+    REPORTS_THRESHOLD = 5
+
     date = models.DateTimeField(auto_now_add=True)
     content = models.TextField('review', blank=False, max_length=5000)
     summary = models.CharField(blank=True, max_length=140)
     nb_likes = models.PositiveIntegerField('likes', default=0)
     nb_dislikes = models.PositiveIntegerField('dislikes', default=0)
     nb_reports = models.PositiveIntegerField('reports', default=0)
-    voters = models.ManyToManyField('CustomUser')
     associated_rating = models.OneToOneField('Rating', on_delete=models.CASCADE)
+    # Book of the rating, so that the reviews of a book are sorted by index.
+    # Null only in the reviews written before this column existed, until
+    # backfill_review_books is run
+    book = models.ForeignKey('Book', on_delete=models.CASCADE, null=True, editable=False, related_name='reviews')
+
+    # Written with F() updates only, never by saving a loaded review
+    COUNTER_FIELDS = ('nb_likes', 'nb_dislikes', 'nb_reports')
+    # Sort modes of the reviews of a book, each ends with the primary key
+    # so that keyset pagination has a distinct position for every review
+    ORDERINGS = {
+        'newest': ('-date', '-id'),
+        'liked': ('-nb_likes', '-id'),
+    }
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['book', '-date', '-id']),
+            models.Index(fields=['book', '-nb_likes', '-id']),
+            # Reviews to moderate among all the reviews, see
+            # reconcile_moderation_counters --fill-queue
+            models.Index(fields=['nb_reports'], condition=Q(nb_reports__gt=0), name='library_review_reported'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.book_id is None:
+            self.book_id = self.associated_rating.book_id
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in Review.COUNTER_FIELDS
+            ]
+        with transaction.atomic():
+            super(Review, self).save(*args, **kwargs)
+            search.index_review(self, self.book_id)
+            pagecache.bump_book(self.book_id, catalog=False)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            review_id, book_id = self.pk, self.book_id
+            result = super(Review, self).delete(*args, **kwargs)
+            pagecache.bump_book(book_id, catalog=False)
+        return result
 
     def __str__(self):
         return str(self.associated_rating) + " | likes/dislikes: " + str(self.nb_likes) + "/" + str(self.nb_dislikes) + " | Review (" + str(len(self.content)) + " chars), summary: " + self.summary
 
 
+class ReviewVote(models.Model):
+    """
+    Vote of a user for a review, a user votes once for a review
+    """
+
+    VOTE_CHOICES = (
+        (1, 'Like'),
+        (-1, 'Dislike'),
+    )
+
+    review = models.ForeignKey('Review', on_delete=models.CASCADE, related_name='votes')
+    user = models.ForeignKey('CustomUser', on_delete=models.CASCADE)
+    value = models.SmallIntegerField(choices=VOTE_CHOICES)
+    date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('review', 'user')
+
+    @staticmethod
+    def vote(review, user, value):
+        """
+        Record the vote of a user, or switch their vote to the other value.
+        Return False if they had already voted the same. The totals of the
+        review are updated by the vote buffer.
+        """
+        try:
+            with transaction.atomic():
+                ReviewVote.objects.create(review=review, user=user, value=value)
+            likes, dislikes = int(value > 0), int(value < 0)
+        except IntegrityError:
+            # Only one of concurrent switches to the same value updates the row
+            if not ReviewVote.objects.filter(review=review, user=user).exclude(value=value).update(value=value):
+                return False
+            likes, dislikes = value, -value
+        transaction.on_commit(lambda: votebuffer.add(review.pk, review.book_id, likes=likes, dislikes=dislikes))
+        return True
+
+    def __str__(self):
+        return str(self.user) + " -> review " + str(self.review_id) + " | " + self.get_value_display()
+
+
+
+
+
+
+class ReviewReport(models.Model):
+    """
+    Report of a review by a user, a user reports a review once
+    """
+
+    review = models.ForeignKey('Review', on_delete=models.CASCADE, related_name='reports')
+    user = models.ForeignKey('CustomUser', on_delete=models.CASCADE)
+    date = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('review', 'user')
+
+    @staticmethod
+    def report(review, user):
+        """
+        Record the report of a user, return False if they had already
+        reported the review. The review joins the moderation queue when it
+        reaches Review.REPORTS_THRESHOLD reports.
+        """
+        try:
+            with transaction.atomic():
+                ReviewReport.objects.create(review=review, user=user)
+                # The update locks the review until the end of the
+                # transaction, so every report reads a different total
+                Review.objects.filter(pk=review.pk).update(nb_reports=F('nb_reports') + 1)
+                nb_reports = Review.objects.filter(pk=review.pk).values_list('nb_reports', flat=True).get()
+                if nb_reports == Review.REPORTS_THRESHOLD:
+                    ReportedReview.objects.create(review=review)
+                    ModerationCounter.add(ModerationCounter.REPORTED_REVIEWS, 1)
+        except IntegrityError:
+            return False
+        review.nb_reports = nb_reports
+        return True
+
+    def __str__(self):
+        return str(self.user) + " reported review " + str(self.review_id)
+
+
+class ReportedReview(models.Model):
+    """
+    Moderation queue of the reviews reported too many times, an entry is
+    removed when a moderator deletes or keeps the review
+    """
+
+    review = models.OneToOneField('Review', on_delete=models.CASCADE, primary_key=True)
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
 
+    @staticmethod
+    def resolve(review):
+        """
+        Remove a review from the queue, must be called in the transaction
+        resolving it
+        """
+        removed, _ = ReportedReview.objects.filter(review=review).delete()
+        if removed:
+            ModerationCounter.add(ModerationCounter.REPORTED_REVIEWS, -1)
+        return bool(removed)
 
+    def __str__(self):
+        return "Reported: " + str(self.review)
 
 
 class Comment(models.Model):
@@ -163,21 +457,54 @@ class Comment(models.Model):
     parent_review = models.ForeignKey('Review', on_delete=models.CASCADE)
     user = models.ForeignKey('CustomUser', on_delete=models.CASCADE)
 
+    # Order of a thread, the id makes the position of every comment unique
+    THREAD_ORDERING = ('date', 'id')
+
+    class Meta:
+        indexes = [models.Index(fields=['parent_review', 'date', 'id'])]
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super(Comment, self).save(*args, **kwargs)
+            pagecache.bump_book(self.parent_review.book_id, catalog=False)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            book_id = self.parent_review.book_id
+            result = super(Comment, self).delete(*args, **kwargs)
+            pagecache.bump_book(book_id, catalog=False)
+        return result
+
     def __str__(self):
         return str(self.user) + " | likes/dislikes: " + str(self.nb_likes) + "/" + str(self.nb_dislikes) + " | " + self.content
 
 
 
+class BookQuerySet(models.QuerySet):
+    def published(self):
+        return self.filter(status=1)
+
+    def for_listing(self):
+        # Everything a book list displays comes from a single query: the
+        # rating aggregates are stored on the book row itself
+        return self.select_related('category', 'author')
+
+
 class Book(models.Model):
     """
     Book model
     """
 
+    objects = BookQuerySet.as_manager()
+
     BOOK_STATUS_CHOICES = (
         (0, 'Waiting for approval'),
         (1, 'Published'),
         (2, 'Removed'),
     )
+    # Order of the catalog, the ISBN makes the position of every book unique
+    CATALOG_ORDERING = ('-year_of_pub', '-isbn')
+
     YEAR_CHOICES = []
     for y in range(datetime.datetime.now().year, 1900, -1):
         YEAR_CHOICES.append((y, y))
@@ -217,6 +544,173 @@ class Book(models.Model):
         validators=[IMAGE_URL_VALIDATOR]
     )
     category = models.ForeignKey('Category', on_delete=models.PROTECT)
+    rating_count = models.PositiveIntegerField('number of ratings', default=0)
+    rating_sum = models.PositiveIntegerField('sum of ratings', default=0)
+    # Set when the ratings or the owners change, until the neighbours of the
+    # book are computed again by compute_book_neighbours
+    neighbours_stale = models.BooleanField(default=True, db_index=True)
+
+    class Meta:
+        # The catalog: published books in CATALOG_ORDERING, also filtered by
+        # decade, by category or by price
+        indexes = [
+            models.Index(fields=['status', '-year_of_pub', '-isbn']),
+            models.Index(fields=['status', 'category', '-year_of_pub', '-isbn']),
+            models.Index(fields=['status', 'price']),
+        ]
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super(Book, self).save(*args, **kwargs)
+            search.index_book(self)
+            pagecache.bump_book(self.pk)
+            facets.invalidate()
+
+    def cover_url(self, size):
+        # The URL changes with the cover, whose thumbnails are cached for a year
+        url = reverse('library:cover', kwargs={'bookid': self.pk, 'size': size})
+        return url + '?v=' + covers.url_hash(self.image_url)[:12]
+
+    @property
+    def list_cover_url(self):
+        return self.cover_url('list')
+
+    @property
+    def detail_cover_url(self):
+        return self.cover_url('detail')
+
+    @property
+    def avg_rating(self):
+        if self.rating_count == 0:
+            return 0
+        return self.rating_sum / self.rating_count
+
+    @staticmethod
+    def update_rating_totals(book_id, count_delta, sum_delta):
+        Book.objects.filter(pk=book_id).update(
+            rating_count=F('rating_count') + count_delta,
+            rating_sum=F('rating_sum') + sum_delta,
+            neighbours_stale=True,
+        )
 
     def __str__(self):
         return self.title + " (" + self.category.name + ") by " + self.author_pseudonym + " (" + str(self.year_of_pub) + ") - $" + str(self.price)
+
+
+class BookNeighbour(models.Model):
+    """
+    One of the books most often liked by the readers of a book, computed by
+    compute_book_neighbours
+    """
+
+    book = models.ForeignKey('Book', on_delete=models.CASCADE, related_name='neighbours')
+    neighbour = models.ForeignKey('Book', on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ('book', 'neighbour')
+        indexes = [models.Index(fields=['book', '-score'])]
+
+    def __str__(self):
+        return self.book_id + " -> " + self.neighbour_id + " (" + str(round(self.score, 3)) + ")"
+
+
+class ModerationCounter(models.Model):
+    """
+    Number of pending moderation requests of each kind, updated by the views
+    with the requests themselves instead of being counted on every profile view
+    """
+
+    PUBLICATION_REQUESTS = 'publication_requests'
+    PUBLISHER_REQUESTS = 'publisher_requests'
+    REPORTED_REVIEWS = 'reported_reviews'
+    NAME_CHOICES = (
+        (PUBLICATION_REQUESTS, 'Books waiting for approval'),
+        (PUBLISHER_REQUESTS, 'Publishers waiting for approval'),
+        (REPORTED_REVIEWS, 'Reported reviews'),
+    )
+
+    name = models.CharField(max_length=30, unique=True, choices=NAME_CHOICES)
+    value = models.IntegerField(default=0)
+
+    def __str__(self):
+        return self.name + ": " + str(self.value)
+
+    @staticmethod
+    def pending(name):
+        """
+        Queryset of the pending requests counted by counter `name`
+        """
+        if name == ModerationCounter.PUBLICATION_REQUESTS:
+            return Book.objects.filter(status=0)
+        if name == ModerationCounter.PUBLISHER_REQUESTS:
+            return CustomUser.objects.filter(authorization_level=2)
+        return ReportedReview.objects.all()
+
+    @staticmethod
+    def add(name, delta):
+        """
+        Change a counter, must be called after the change it counts, in
+        the same transaction
+        """
+        updated = ModerationCounter.objects.filter(name=name).update(value=F('value') + delta)
+        if not updated:
+            ModerationCounter.reconcile([name])
+
+    @staticmethod
+    def values():
+        values = dict.fromkeys([n for n, _ in ModerationCounter.NAME_CHOICES], 0)
+        values.update(ModerationCounter.objects.values_list('name', 'value'))
+        return values
+
+    @staticmethod
+    def reconcile(names=None):
+        """
+        Recount the pending requests. Return the drift of every counter.
+        """
+        if names is None:
+            names = [n for n, _ in ModerationCounter.NAME_CHOICES]
+        drift = dict()
+        with transaction.atomic():
+            for name in names:
+                value = ModerationCounter.pending(name).count()
+                counter, created = ModerationCounter.objects.select_for_update().get_or_create(
+                    name=name, defaults={'value': value}
+                )
+                drift[name] = value - counter.value
+                if counter.value != value:
+                    counter.value = value
+                    counter.save()
+        return drift
+
+
+class DataVersion(models.Model):
+    """
+    Version of data kept in the memory of every process, bumped in the
+    transaction writing the data, so that a process finds out its copy is
+    stale with a single-row query
+    """
+
+    CATALOG = 'catalog'
+    FRIENDSHIPS = 'friendships'
+
+    name = models.CharField(max_length=30, primary_key=True)
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return self.name + ": " + str(self.value)
+
+    @staticmethod
+    def get(name):
+        return DataVersion.objects.filter(name=name).values_list('value', flat=True).first() or 0
+
+    @staticmethod
+    def bump(name):
+        if DataVersion.objects.filter(name=name).update(value=F('value') + 1):
+            return
+        try:
+            with transaction.atomic():
+                DataVersion.objects.create(name=name, value=1)
+        except IntegrityError:
+            # Created by a concurrent transaction meanwhile
+            DataVersion.objects.filter(name=name).update(value=F('value') + 1)
@@ -0,0 +1,182 @@
+"""
+Full-page cache of the most visited pages, the catalog and the book details.
+
+Pages are cached under keys containing version counters: one for the whole
+catalog and one per book. Writing anything shown on a page bumps the
+counters of that page, so that old entries are never read again and simply
+expire. Anonymous visitors share one entry per page and are served without
+touching the database; logged-in visitors get their own entries since the
+pages show their rating and purchases.
+
+The counters must be shared by all the server processes, or a write handled
+by one process would not invalidate the pages cached by the others: the
+pages are not cached when the default cache is local to the process, unless
+the PAGE_CACHE setting says otherwise.
+"""
+
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+PAGE_TIMEOUT = 60 * 60
+CATALOG_VERSION_KEY = 'library:version:catalog'
+BOOK_VERSION_KEY = 'library:version:book:%s'
+STATS_KEY = 'library:pagecache:%s:%s'
+PROCESS_LOCAL_BACKENDS = (
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+def cache_is_shared():
+    """
+    Return whether the default cache is shared by all the server processes
+    """
+    return settings.CACHES['default']['BACKEND'] not in PROCESS_LOCAL_BACKENDS
+
+
+def enabled():
+    forced = getattr(settings, 'PAGE_CACHE', None)
+    if forced is not None:
+        return forced
+    return cache_is_shared()
+
+
+def _initial_version():
+    # A counter lost by the cache restarts from the current time, so it
+    # cannot go back to a value used by entries still cached
+    return int(time.time() * 1000)
+
+
+def _get_versions(keys):
+    versions = cache.get_many(keys)
+    missing = {k: _initial_version() for k in keys if k not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return [versions[k] for k in keys]
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _initial_version(), None)
+
+
+def bump_catalog():
+    transaction.on_commit(lambda: _bump(CATALOG_VERSION_KEY))
+
+
+def bump_book(isbn, catalog=True):
+    """
+    Invalidate the cached pages of a book, and the catalog pages too unless
+    the change is not shown in the catalog.
+    """
+    transaction.on_commit(lambda: _bump(BOOK_VERSION_KEY % isbn))
+    if catalog:
+        bump_catalog()
+
+
+def _count(name, event):
+    key = STATS_KEY % (name, event)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+def stats(names):
+    """
+    Return the number of hits and misses and the hit ratio of every page
+    """
+    result = {}
+    for name in names:
+        hits = cache.get(STATS_KEY % (name, 'hits'), 0)
+        misses = cache.get(STATS_KEY % (name, 'misses'), 0)
+        total = hits + misses
+        result[name] = {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / total if total else 0,
+        }
+    return result
+
+
+def versioned_page(name, version_keys):
+    """
+    Cache the GET responses of a view. `version_keys(**kwargs)` returns the
+    keys of the version counters the page depends on.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET' or not enabled():
+                return view(request, *args, **kwargs)
+            # No query for anonymous visitors: without a session cookie
+            # the session is never loaded
+            if request.user.is_authenticated:
+                # The forms of the page carry a CSRF token, only valid
+                # with the CSRF cookie it was rendered for
+                csrf_cookie = request.META.get('CSRF_COOKIE')
+                if not csrf_cookie:
+                    return view(request, *args, **kwargs)
+                visitor = 'user%d:%s' % (request.user.pk, hashlib.md5(csrf_cookie.encode()).hexdigest())
+            else:
+                visitor = 'anonymous'
+            versions = _get_versions(version_keys(**kwargs))
+            path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+            key = 'library:page:%s:%s:%s:%s' % (name, visitor, '.'.join(str(v) for v in versions), path)
+            content = cache.get(key)
+            if content is not None:
+                _count(name, 'hits')
+                return HttpResponse(content)
+            _count(name, 'misses')
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200 and not response.streaming:
+                cache.set(key, response.content, PAGE_TIMEOUT)
+            return response
+        return wrapper
+    return decorator
+
+
+def conditional_page(version_keys):
+    """
+    Answer the conditional GETs of a view from the version counters of the
+    page: its strong ETag only changes with them and the URL, so a request
+    carrying the current ETag gets a 304 without the view running. Clients
+    and proxies are told to revalidate every time.
+    """
+    def etag(request, *args, **kwargs):
+        versions = _get_versions(version_keys(**kwargs))
+        data = '%s:%s' % ('.'.join(str(v) for v in versions), request.get_full_path())
+        return hashlib.md5(data.encode()).hexdigest()
+
+    def decorator(view):
+        conditional_view = condition(etag_func=etag)(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not enabled():
+                return view(request, *args, **kwargs)
+            response = conditional_view(request, *args, **kwargs)
+            patch_cache_control(response, public=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
+
+
+def catalog_keys(**kwargs):
+    return [CATALOG_VERSION_KEY]
+
+
+def book_keys(bookid, **kwargs):
+    return [BOOK_VERSION_KEY % bookid]
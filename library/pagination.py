@@ -0,0 +1,135 @@
+import base64
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+
+
+class KeysetPage:
+    """
+    One page of a keyset (cursor) paginated queryset
+    """
+
+    def __init__(self, items, next_cursor, prev_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(direction, values):
+    values = [v.isoformat() if hasattr(v, 'isoformat') else v for v in values]
+    data = json.dumps([direction] + values, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Return (direction, values) for a token built by encode_cursor.
+    Raise ValueError if the token is malformed.
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(data.decode())
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(data, list) or len(data) < 2 or data[0] not in ('n', 'p'):
+        raise ValueError('Invalid cursor')
+    return data[0], data[1:]
+
+
+def _field_name(order):
+    return order.lstrip('-')
+
+
+def _invert(order):
+    if order.startswith('-'):
+        return order[1:]
+    return '-' + order
+
+
+def _clean_values(model, ordering, values):
+    # The values of a cursor come from the client, every one must be valid
+    # for its field before reaching the query
+    cleaned = []
+    for order, value in zip(ordering, values):
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise ValueError('Invalid cursor')
+        try:
+            field = model._meta.get_field(_field_name(order))
+        except FieldDoesNotExist:
+            cleaned.append(value)
+            continue
+        try:
+            cleaned.append(field.to_python(value))
+        except (TypeError, ValidationError):
+            raise ValueError('Invalid cursor')
+    return cleaned
+
+
+def _after(ordering, values):
+    # Rows strictly after `values` in `ordering`:
+    # (a > x) OR (a = x AND b > y) OR ...
+    condition = Q()
+    equal = Q()
+    for order, value in zip(ordering, values):
+        lookup = '__lt' if order.startswith('-') else '__gt'
+        condition |= equal & Q(**{_field_name(order) + lookup: value})
+        equal &= Q(**{_field_name(order): value})
+    return condition
+
+
+def keyset_page(queryset, ordering, cursor=None, per_page=15, offset=0):
+    """
+    Return a KeysetPage of `queryset` sorted by `ordering`, which must end
+    with a unique field so that every row has a distinct position.
+    Without a cursor, the page starts at `offset` (only meant for the first
+    few pages). Raise ValueError if the cursor is invalid.
+    """
+    backwards = False
+    values = None
+    if cursor:
+        direction, values = decode_cursor(cursor)
+        if len(values) != len(ordering):
+            raise ValueError('Invalid cursor')
+        values = _clean_values(queryset.model, ordering, values)
+        backwards = (direction == 'p')
+        offset = 0
+
+    if backwards:
+        ordering_used = [_invert(o) for o in ordering]
+    else:
+        ordering_used = list(ordering)
+    queryset = queryset.order_by(*ordering_used)
+    if values is not None:
+        queryset = queryset.filter(_after(ordering_used, values))
+
+    items = list(queryset[offset:offset + per_page + 1])
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+        has_next, has_prev = True, more
+    else:
+        has_next, has_prev = more, values is not None or offset > 0
+
+    def key(item):
+        return [getattr(item, _field_name(o)) for o in ordering]
+
+    next_cursor = prev_cursor = None
+    if items and has_next:
+        next_cursor = encode_cursor('n', key(items[-1]))
+    if items and has_prev:
+        prev_cursor = encode_cursor('p', key(items[0]))
+    return KeysetPage(items, next_cursor, prev_cursor)
@@ -0,0 +1,92 @@
+"""
+Item-item collaborative filtering: "readers also liked".
+
+Books are compared by the cosine similarity of their columns in a sparse
+user x book matrix built from the ratings and the purchases. Similarities
+are computed for a block of books at a time, so that memory stays bounded
+by the block size whatever the size of the catalog.
+
+NumPy and SciPy are only needed by the batch job, they are imported when
+it runs.
+"""
+
+# Value of a purchased book that the user has not rated
+OWNED_WEIGHT = 3.0
+
+
+def _coo(entries, users, books, value=None):
+    """
+    Read (user_id, isbn[, value]) entries into three compact arrays
+    """
+    from array import array
+
+    rows, cols, data = array('i'), array('i'), array('f')
+    for entry in entries:
+        rows.append(users.setdefault(entry[0], len(users)))
+        cols.append(books.setdefault(entry[1], len(books)))
+        data.append(value if value is not None else entry[2])
+    return rows, cols, data
+
+
+def build_matrix(ratings, purchases):
+    """
+    Build the normalized user x book matrix. `ratings` yields
+    (user_id, isbn, evaluation) and `purchases` (user_id, isbn); a rating
+    replaces the purchase of the same book.
+    Return (matrix, isbns) where isbns[j] is the book of column j.
+    """
+    import numpy as np
+    from scipy import sparse
+
+    users = dict()
+    books = dict()
+    rated = _coo(ratings, users, books)
+    owned = _coo(purchases, users, books, OWNED_WEIGHT)
+    shape = (len(users), len(books))
+
+    def to_matrix(coo):
+        rows, cols, data = coo
+        return sparse.csc_matrix(
+            (np.frombuffer(data, dtype=np.float32), (np.frombuffer(rows, dtype=np.int32), np.frombuffer(cols, dtype=np.int32))),
+            shape=shape, dtype=np.float32
+        )
+
+    rated, owned = to_matrix(rated), to_matrix(owned)
+    rated_mask = rated.copy()
+    rated_mask.data[:] = 1
+    matrix = rated + owned - owned.multiply(rated_mask)
+    del rated, owned, rated_mask
+
+    # Unit columns, so that a dot product of two columns is their cosine
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0))).ravel()
+    norms[norms == 0] = 1
+    matrix = matrix @ sparse.diags(1 / norms)
+
+    isbns = [None] * len(books)
+    for isbn, j in books.items():
+        isbns[j] = isbn
+    return matrix.tocsc(), isbns
+
+
+def top_neighbours(matrix, columns, k, block_size=256):
+    """
+    Yield (column, [(neighbour column, score), ...]) with the k most
+    similar columns of every column in `columns`, best first.
+    """
+    import numpy as np
+
+    transposed = matrix.T.tocsr()
+    for start in range(0, len(columns), block_size):
+        block = columns[start:start + block_size]
+        similarities = (transposed[block] @ matrix).tocsr()
+        for i, column in enumerate(block):
+            row = similarities.getrow(i)
+            scores = row.data
+            neighbours = row.indices
+            keep = (neighbours != column) & (scores > 0)
+            scores, neighbours = scores[keep], neighbours[keep]
+            if len(scores) > k:
+                best = np.argpartition(-scores, k)[:k]
+                scores, neighbours = scores[best], neighbours[best]
+            order = np.argsort(-scores, kind='stable')
+            yield column, [(int(neighbours[j]), float(scores[j])) for j in order]
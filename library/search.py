@@ -0,0 +1,244 @@
+"""
+Full-text search over the books and their reviews.
+
+Every book has one search document (title, author pseudonym and category)
+and every review one more (summary and content), so that writing a review
+only indexes that review. Results are grouped by book and ranked by the
+sum of the ranks of their documents.
+
+On PostgreSQL the documents are stored in a tsvector column with a GIN
+index, on SQLite in an FTS5 table. Other databases fall back to a slow
+unranked LIKE search. The common English words are left out of the queries
+on every database, as PostgreSQL does, so a query made of them only finds
+nothing.
+
+The documents of the books and reviews deleted, directly or by cascade, are
+removed by the post_delete handlers connected in apps.py.
+"""
+
+import re
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+
+SEARCH_TABLE = 'library_search_document'
+FTS_TABLE = 'library_search_fts'
+
+# Weights of title, author, category, review summary and review content
+WEIGHTS = (10.0, 10.0, 5.0, 2.0, 1.0)
+
+
+# Common words of the PostgreSQL english configuration, which never match
+STOPWORDS = frozenset(
+    'a about above after again against all am an and any are as at be because been before being below '
+    'between both but by can did do does doing down during each few for from further had has have having '
+    'he her here hers herself him himself his how i if in into is it its itself just me more most my '
+    'myself no nor not now of off on once only or other our ours ourselves out over own same she should '
+    'so some such than that the their theirs them themselves then there these they this those through to '
+    'too under until up very was we were what when where which while who whom why will with you your '
+    'yours yourself yourselves'.split()
+)
+
+
+def _terms(query):
+    return [t for t in re.findall(r'\w+', query.lower()) if t not in STOPWORDS][:10]
+
+
+def _backend(conn=connection):
+    if conn.vendor == 'postgresql':
+        return PostgresBackend
+    if conn.vendor == 'sqlite':
+        return SQLiteBackend
+    return LikeBackend
+
+
+class PostgresBackend:
+    DOCUMENT = (
+        "setweight(to_tsvector('english', %s), 'A') || "
+        "setweight(to_tsvector('english', %s), 'A') || "
+        "setweight(to_tsvector('english', %s), 'B') || "
+        "setweight(to_tsvector('english', %s), 'C') || "
+        "setweight(to_tsvector('english', %s), 'D')"
+    )
+
+    @staticmethod
+    def create_tables(cursor):
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS " + SEARCH_TABLE + " ("
+            "id serial PRIMARY KEY, "
+            "book_id varchar(17) NOT NULL, "
+            "review_id integer NULL, "
+            "document tsvector NOT NULL)"
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS " + SEARCH_TABLE + "_document ON " + SEARCH_TABLE + " USING GIN (document)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS " + SEARCH_TABLE + "_book ON " + SEARCH_TABLE + " (book_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS " + SEARCH_TABLE + "_review ON " + SEARCH_TABLE + " (review_id)")
+
+    @staticmethod
+    def drop_tables(cursor):
+        cursor.execute("DROP TABLE IF EXISTS " + SEARCH_TABLE)
+
+    @staticmethod
+    def insert(cursor, book_id, review_id, fields):
+        cursor.execute(
+            "INSERT INTO " + SEARCH_TABLE + " (book_id, review_id, document) VALUES (%s, %s, " + PostgresBackend.DOCUMENT + ")",
+            [book_id, review_id] + list(fields)
+        )
+
+    @staticmethod
+    def delete(cursor, where, params):
+        cursor.execute("DELETE FROM " + SEARCH_TABLE + " WHERE " + where, params)
+
+    @staticmethod
+    def search(cursor, terms, limit, offset):
+        query = ' & '.join(t + ':*' for t in terms)
+        cursor.execute(
+            "SELECT d.book_id, SUM(ts_rank(d.document, q)) AS rank "
+            "FROM " + SEARCH_TABLE + " d "
+            "JOIN library_book b ON b.isbn = d.book_id, "
+            "to_tsquery('english', %s) q "
+            "WHERE d.document @@ q AND b.status = 1 "
+            "GROUP BY d.book_id ORDER BY rank DESC, d.book_id LIMIT %s OFFSET %s",
+            [query, limit, offset]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class SQLiteBackend:
+    # The FTS5 table only holds the text, its rowid is the id of the row of
+    # the document table, which is indexed on book_id and review_id
+
+    @staticmethod
+    def create_tables(cursor):
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS " + SEARCH_TABLE + " ("
+            "id integer PRIMARY KEY AUTOINCREMENT, "
+            "book_id varchar(17) NOT NULL, "
+            "review_id integer NULL)"
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS " + SEARCH_TABLE + "_book ON " + SEARCH_TABLE + " (book_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS " + SEARCH_TABLE + "_review ON " + SEARCH_TABLE + " (review_id)")
+        cursor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS " + FTS_TABLE + " USING fts5("
+            "title, author, category, summary, content, "
+            "tokenize = 'porter unicode61')"
+        )
+
+    @staticmethod
+    def drop_tables(cursor):
+        cursor.execute("DROP TABLE IF EXISTS " + FTS_TABLE)
+        cursor.execute("DROP TABLE IF EXISTS " + SEARCH_TABLE)
+
+    @staticmethod
+    def insert(cursor, book_id, review_id, fields):
+        cursor.execute("INSERT INTO " + SEARCH_TABLE + " (book_id, review_id) VALUES (%s, %s)", [book_id, review_id])
+        cursor.execute(
+            "INSERT INTO " + FTS_TABLE + " (rowid, title, author, category, summary, content) "
+            "VALUES (%s, %s, %s, %s, %s, %s)",
+            [cursor.lastrowid] + list(fields)
+        )
+
+    @staticmethod
+    def delete(cursor, where, params):
+        cursor.execute(
+            "DELETE FROM " + FTS_TABLE + " WHERE rowid IN (SELECT id FROM " + SEARCH_TABLE + " WHERE " + where + ")",
+            params
+        )
+        cursor.execute("DELETE FROM " + SEARCH_TABLE + " WHERE " + where, params)
+
+    @staticmethod
+    def search(cursor, terms, limit, offset):
+        query = ' '.join('"%s"*' % t for t in terms)
+        weights = ', '.join(str(w) for w in WEIGHTS)
+        # OFFSET 0 stops SQLite from flattening the subquery, bm25() can
+        # only be called directly in the full-text query
+        cursor.execute(
+            "SELECT d.book_id, SUM(m.rank) AS total FROM ("
+            "SELECT rowid AS id, bm25(" + FTS_TABLE + ", " + weights + ") AS rank "
+            "FROM " + FTS_TABLE + " WHERE " + FTS_TABLE + " MATCH %s LIMIT -1 OFFSET 0"
+            ") m JOIN " + SEARCH_TABLE + " d ON d.id = m.id "
+            "JOIN library_book b ON b.isbn = d.book_id "
+            "WHERE b.status = 1 "
+            "GROUP BY d.book_id ORDER BY total, d.book_id LIMIT %s OFFSET %s",
+            [query, limit, offset]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+class LikeBackend:
+    @staticmethod
+    def create_tables(cursor):
+        pass
+
+    @staticmethod
+    def drop_tables(cursor):
+        pass
+
+    @staticmethod
+    def insert(cursor, book_id, review_id, fields):
+        pass
+
+    @staticmethod
+    def delete(cursor, where, params):
+        pass
+
+    @staticmethod
+    def search(cursor, terms, limit, offset):
+        from django.db.models import Q
+        from .models import Book
+
+        books = Book.objects.published()
+        for t in terms:
+            books = books.filter(
+                Q(title__icontains=t) | Q(author_pseudonym__icontains=t) | Q(category__name__icontains=t) |
+                Q(rating__review__summary__icontains=t) | Q(rating__review__content__icontains=t)
+            )
+        books = books.order_by('title', 'isbn').values_list('isbn', flat=True).distinct()
+        return list(books[offset:offset + limit])
+
+
+def create_tables(using=DEFAULT_DB_ALIAS):
+    conn = connections[using]
+    with conn.cursor() as cursor:
+        _backend(conn).create_tables(cursor)
+
+
+def drop_tables(using=DEFAULT_DB_ALIAS):
+    conn = connections[using]
+    with conn.cursor() as cursor:
+        _backend(conn).drop_tables(cursor)
+
+
+def index_book(book):
+    with connection.cursor() as cursor:
+        backend = _backend()
+        backend.delete(cursor, "book_id = %s AND review_id IS NULL", [book.pk])
+        backend.insert(cursor, book.pk, None, (book.title, book.author_pseudonym, book.category.name, '', ''))
+
+
+def index_review(review, book_id):
+    with connection.cursor() as cursor:
+        backend = _backend()
+        backend.delete(cursor, "review_id = %s", [review.pk])
+        backend.insert(cursor, book_id, review.pk, ('', '', '', review.summary, review.content))
+
+
+def unindex_review(review_id):
+    with connection.cursor() as cursor:
+        _backend().delete(cursor, "review_id = %s", [review_id])
+
+
+def unindex_book(book_id):
+    with connection.cursor() as cursor:
+        _backend().delete(cursor, "book_id = %s", [book_id])
+
+
+def search_books(query, limit=15, offset=0):
+    """
+    Return the ISBNs of the published books matching `query`, best match
+    first.
+    """
+    terms = _terms(query)
+    if not terms:
+        return []
+    with connection.cursor() as cursor:
+        return _backend().search(cursor, terms, limit, offset)
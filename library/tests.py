@@ -1,3 +1,1029 @@
-from django.test import TestCase
+import base64
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import threading
+from io import StringIO
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.http import Http404, HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from fill_db import bulk, parallel
+from online_library import instrumentation, replicas, staticfiles
+from . import facets, friendgraph, pagecache, search, votebuffer
+from .friendgraph import FriendGraph
+from .management.commands import index_advisor, load_bx
+from .pagination import encode_cursor, keyset_page
+from .models import *
+
+
+class BookListingQueriesTests(TestCase):
+    """
+    The book lists must run a constant number of queries whatever the
+    number of books displayed
+    """
+
+    def setUp(self):
+        cache.clear()
+        # The catalog version starts over with every test
+        facets._local = None
+        self.category = Category.objects.create(name='Fantasy')
+        self.author = CustomUser.objects.create(username='author', birthday=datetime.date(1990, 1, 1), authorization_level=3)
+        self.reader = CustomUser.objects.create(username='reader', birthday=datetime.date(1990, 1, 1))
+
+    def add_books(self, nb_books):
+        start = Book.objects.count()
+        for i in range(start, start + nb_books):
+            book = Book.objects.create(
+                isbn='1-0000-0000-%d' % i,
+                status=1,
+                title='Book %d' % i,
+                author=self.author,
+                author_pseudonym='Author',
+                price=10,
+                year_of_pub=2000 + i % 10,
+                image_url='http://example.com/cover.jpg',
+                category=self.category,
+            )
+            self.reader.books.add(book)
+            Rating.objects.create(user=self.reader, book=book, evaluation=i % 5 + 1)
+
+    def assertConstantQueries(self, url, nb_queries):
+        for nb_books in (2, 20):
+            self.add_books(nb_books)
+            cache.clear()
+            with self.assertNumQueries(nb_queries):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+    def test_index(self):
+        # catalog version + facet groups, which also give the number of
+        # books + page
+        self.assertConstantQueries(reverse('library:index'), 3)
+        # The groups of the current version are kept by the process
+        with self.assertNumQueries(2):
+            self.client.get(reverse('library:index'))
+
+    def test_index_facets(self):
+        # catalog version + facet groups + page, each facet counted with the
+        # other filters
+        self.add_books(20)
+        cache.clear()
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('library:index'), {'decade': 2000, 'price': '10-20'})
+        self.assertEqual(response.context['nb_books'], 20)
+        decades = {v['value']: v['count'] for v in response.context['facets']['decade']}
+        self.assertEqual(decades, {2000: 20})
+        response = self.client.get(reverse('library:index'), {'decade': 1990})
+        self.assertEqual(response.context['nb_books'], 0)
+        self.assertEqual(response.context['facets']['decade'][0]['count'], 20)
+        # A book written counts the groups again
+        self.add_books(1)
+        self.assertEqual(self.client.get(reverse('library:index')).context['nb_books'], 21)
+
+    def test_user_books(self):
+        # user + books
+        self.assertConstantQueries(reverse('library:user_books', kwargs={'user': 'reader'}), 2)
+
+    def test_user_published_books(self):
+        # user + books
+        self.assertConstantQueries(reverse('library:user_published_books', kwargs={'user': 'author'}), 2)
+
+
+    def test_book_reviews(self):
+        # book + owners + review count + review page + user rating + neighbours
+        book = Book.objects.create(
+            isbn='2-0000-0000-0', status=1, title='Reviewed', author_pseudonym='Author', price=10,
+            year_of_pub=2000, image_url='http://example.com/cover.jpg', category=self.category,
+        )
+        for nb_reviews in (2, 20):
+            start = Review.objects.count()
+            for i in range(start, start + nb_reviews):
+                user = CustomUser.objects.create(username='reviewer%d' % i, birthday=datetime.date(1990, 1, 1))
+                rating = Rating.objects.create(user=user, book=book, evaluation=i % 5 + 1)
+                review = Review.objects.create(content='Content', summary='Summary', associated_rating=rating)
+                Comment.objects.create(content='Comment', parent_review=review, user=user)
+            cache.clear()
+            with self.assertNumQueries(6):
+                response = self.client.get(reverse('library:bookdetails', kwargs={'bookid': book.pk}))
+            self.assertEqual(response.status_code, 200)
+
+class KeysetPaginationTests(TestCase):
+    """
+    Cursors walk the pages both ways, and a tampered cursor is refused
+    """
+
+    def setUp(self):
+        category = Category.objects.create(name='Fantasy')
+        self.book = Book.objects.create(
+            isbn='9-0000-0000-0', status=1, title='Paged', author_pseudonym='Author', price=10, year_of_pub=2000,
+            image_url='http://example.com/cover.jpg', category=category,
+        )
+        for i in range(1, 7):
+            Book.objects.create(
+                isbn='9-0000-0000-%d' % i, status=1, title='Book %d' % i, author_pseudonym='Author', price=10,
+                year_of_pub=2000 + i % 3, image_url='http://example.com/cover.jpg', category=category,
+            )
+
+    def test_navigation(self):
+        expected = list(Book.objects.order_by(*Book.CATALOG_ORDERING))
+        pages = [keyset_page(Book.objects.all(), Book.CATALOG_ORDERING, per_page=3)]
+        while pages[-1].has_next():
+            pages.append(keyset_page(Book.objects.all(), Book.CATALOG_ORDERING, cursor=pages[-1].next_cursor, per_page=3))
+        self.assertEqual([book for page in pages for book in page], expected)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertFalse(pages[0].has_previous())
+        previous = keyset_page(Book.objects.all(), Book.CATALOG_ORDERING, cursor=pages[-1].prev_cursor, per_page=3)
+        self.assertEqual(previous.items, pages[1].items)
+        self.assertTrue(previous.has_previous() and previous.has_next())
+
+    def test_malformed_cursors(self):
+        for cursor in ('garbage', encode_cursor('x', [2000, 'a']), encode_cursor('n', [2000]),
+                       encode_cursor('n', [{'a': 1}, 'a']), encode_cursor('n', ['year', 'a'])):
+            with self.assertRaises(ValueError):
+                keyset_page(Book.objects.all(), Book.CATALOG_ORDERING, cursor=cursor)
+        self.assertEqual(self.client.get(reverse('library:index'), {'cursor': encode_cursor('n', [[1], 'a'])}).status_code, 404)
+        url = reverse('library:book_reviews_json', kwargs={'bookid': self.book.pk})
+        self.assertEqual(self.client.get(url, {'cursor': encode_cursor('n', ['not a date', 1])}).status_code, 404)
+
+
+class CommentPaginationTests(TestCase):
+    """
+    The comments of a review are shown oldest first, one page at a time
+    """
+
+    def test_pages(self):
+        book = Book.objects.create(
+            isbn='13-0000-0000-0', status=1, title='Commented', author_pseudonym='Author', price=10, year_of_pub=2000,
+            image_url='http://example.com/cover.jpg', category=Category.objects.create(name='Fantasy'),
+        )
+        user = CustomUser.objects.create(username='reader', birthday=datetime.date(1990, 1, 1))
+        reviews = [
+            Review.objects.create(
+                content='Content', summary='Summary',
+                associated_rating=Rating.objects.create(user=author, book=book, evaluation=3),
+            )
+            for author in [user, CustomUser.objects.create(username='other', birthday=datetime.date(1990, 1, 1))]
+        ]
+        for i in range(45):
+            for review in reviews:
+                Comment.objects.create(content='Comment %d' % i, parent_review=review, user=user)
+        url = reverse('library:review_details', kwargs={'bookid': book.pk, 'reviewid': reviews[0].pk})
+        pages = []
+        response = self.client.get(url)
+        self.assertIsNone(response.context['prev_cursor'])
+        while True:
+            pages.append([comment.content for comment in response.context['comments']])
+            if response.context['next_cursor'] is None:
+                break
+            response = self.client.get(url, {'cursor': response.context['next_cursor']})
+        self.assertEqual([len(page) for page in pages], [20, 20, 5])
+        self.assertEqual(sum(pages, []), ['Comment %d' % i for i in range(45)])
+        response = self.client.get(url, {'cursor': response.context['prev_cursor']})
+        self.assertEqual([comment.content for comment in response.context['comments']], pages[1])
+        self.assertEqual(self.client.get(url, {'cursor': 'garbage'}).status_code, 404)
+
+
+class SearchTests(TestCase):
+    """
+    Full-text search on the SQLite test database: ranking, prefixes,
+    stopwords and the upkeep of the documents
+    """
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Fantasy')
+        self.user = CustomUser.objects.create(username='reader', birthday=datetime.date(1990, 1, 1))
+        self.titled = self.add_book('10-0000-0000-0', 'The Dragon Reborn')
+        self.reviewed = self.add_book('10-0000-0000-1', 'Northern Lights')
+        rating = Rating.objects.create(user=self.user, book=self.reviewed, evaluation=5)
+        self.review = Review.objects.create(content='A dragon appears at the end', summary='Great', associated_rating=rating)
+
+    def add_book(self, isbn, title):
+        return Book.objects.create(
+            isbn=isbn, status=1, title=title, author_pseudonym='Author', price=10, year_of_pub=2000,
+            image_url='http://example.com/cover.jpg', category=self.category,
+        )
+
+    def test_ranking(self):
+        # A title weighs more than a review
+        self.assertEqual(search.search_books('dragon'), [self.titled.pk, self.reviewed.pk])
+        self.assertEqual(search.search_books('drag'), [self.titled.pk, self.reviewed.pk])
+        self.assertEqual(search.search_books('dragon reborn'), [self.titled.pk])
+        self.assertEqual(search.search_books('the of'), [])
+        self.assertEqual(search.search_books('the northern'), [self.reviewed.pk])
+
+    def test_index_maintenance(self):
+        self.titled.title = 'Wizard'
+        self.titled.save()
+        self.assertEqual(search.search_books('dragon'), [self.reviewed.pk])
+        self.assertEqual(search.search_books('wizard'), [self.titled.pk])
+        self.titled.status = 2
+        self.titled.save()
+        self.assertEqual(search.search_books('wizard'), [])
+        self.review.delete()
+        self.assertEqual(search.search_books('dragon'), [])
+        # Deleting the rating deletes its review by cascade
+        self.titled.status = 1
+        self.titled.save()
+        rating = Rating.objects.create(user=self.user, book=self.titled, evaluation=1)
+        Review.objects.create(content='Unicorns', summary='', associated_rating=rating)
+        self.assertEqual(search.search_books('unicorns'), [self.titled.pk])
+        rating.delete()
+        self.assertEqual(search.search_books('unicorns'), [])
+        self.reviewed.delete()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM ' + search.SEARCH_TABLE + ' WHERE book_id = %s', [self.reviewed.pk])
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+
+class RatingTotalsTests(TestCase):
+    """
+    The rating count and sum stored on a book follow its ratings
+    """
+
+    def test_totals(self):
+        book = Book.objects.create(
+            isbn='5-0000-0000-0', status=1, title='Rated', author_pseudonym='Author', price=10, year_of_pub=2000,
+            image_url='http://example.com/cover.jpg', category=Category.objects.create(name='Fantasy'),
+        )
+        users = [CustomUser.objects.create(username='rater%d' % i, birthday=datetime.date(1990, 1, 1)) for i in range(2)]
+
+        def totals():
+            book.refresh_from_db(fields=['rating_count', 'rating_sum'])
+            return book.rating_count, book.rating_sum
+
+        rating = Rating.objects.create(user=users[0], book=book, evaluation=4)
+        Rating.objects.create(user=users[1], book=book, evaluation=2)
+        self.assertEqual(totals(), (2, 6))
+        rating.evaluation = 1
+        rating.save()
+        self.assertEqual(totals(), (2, 3))
+        rating.delete()
+        self.assertEqual(totals(), (1, 2))
+        self.assertEqual(book.avg_rating, 2)
+
+
+class PurchaseTests(TestCase):
+    """
+    A purchase charges the published books not owned yet, all or nothing
+    """
+
+    def setUp(self):
+        category = Category.objects.create(name='Fantasy')
+        self.user = CustomUser.objects.create(username='buyer', birthday=datetime.date(1990, 1, 1), balance=30)
+        self.books = [
+            Book.objects.create(
+                isbn='4-0000-0000-%d' % i, status=1 if i < 3 else 0, title='Book %d' % i,
+                author_pseudonym='Author', price=10, year_of_pub=2000,
+                image_url='http://example.com/cover.jpg', category=category,
+            )
+            for i in range(4)
+        ]
+
+    def assertLibrary(self, balance, books):
+        user = CustomUser.objects.get(pk=self.user.pk)
+        self.assertEqual(user.balance, balance)
+        self.assertEqual(set(user.books.all()), set(books))
+
+    def test_not_enough_money(self):
+        self.user.books.add(self.books[0])
+        CustomUser.objects.filter(pk=self.user.pk).update(balance=15)
+        status, bought = self.user.buy([b.pk for b in self.books[:3]])
+        self.assertEqual((status, bought), (CustomUser.NOT_ENOUGH_MONEY, []))
+        self.assertLibrary(15, self.books[:1])
+
+    def test_already_owned(self):
+        self.user.books.add(*self.books[:2])
+        status, bought = self.user.buy([b.pk for b in self.books[:2]])
+        self.assertEqual((status, bought), (CustomUser.ALREADY_OWNED, []))
+        self.assertLibrary(30, self.books[:2])
+
+    def test_mixed_cart(self):
+        # Owned and unpublished books are neither bought nor charged
+        self.user.books.add(self.books[0])
+        status, bought = self.user.buy([b.pk for b in self.books])
+        self.assertEqual(status, CustomUser.BOUGHT)
+        self.assertEqual(set(bought), set(self.books[1:3]))
+        self.assertEqual(self.user.balance, 10)
+        self.assertLibrary(10, self.books[:3])
+
+    def test_cart(self):
+        self.client.force_login(self.user)
+        add_url = reverse('library:add_to_cart', kwargs={'bookid': self.books[1].pk})
+        self.assertEqual(self.client.get(add_url).status_code, 405)
+        self.client.post(add_url)
+        # Unpublished books never reach the cart
+        self.assertEqual(self.client.post(reverse('library:add_to_cart', kwargs={'bookid': self.books[3].pk})).status_code, 404)
+        self.assertEqual(self.client.session['cart'], [self.books[1].pk])
+        self.client.post(reverse('library:cart'), {'isbns': [self.books[1].pk]})
+        self.assertLibrary(20, self.books[1:2])
+        self.assertEqual(self.client.session['cart'], [])
+
+
+class ReviewVoteTests(TestCase):
+    """
+    A user votes once for a review, and the buffered totals are written by
+    the flush
+    """
+
+    def setUp(self):
+        book = Book.objects.create(
+            isbn='6-0000-0000-0', status=1, title='Reviewed', author_pseudonym='Author', price=10, year_of_pub=2000,
+            image_url='http://example.com/cover.jpg', category=Category.objects.create(name='Fantasy'),
+        )
+        author = CustomUser.objects.create(username='reviewer', birthday=datetime.date(1990, 1, 1))
+        rating = Rating.objects.create(user=author, book=book, evaluation=4)
+        self.review = Review.objects.create(content='Content', summary='Summary', associated_rating=rating)
+        self.voters = [CustomUser.objects.create(username='voter%d' % i, birthday=datetime.date(1990, 1, 1)) for i in range(2)]
+        # The totals reach the buffer on commit, and only the test flushes it
+        for patcher in (mock.patch('django.db.transaction.on_commit', lambda func: func()),
+                        mock.patch('library.votebuffer._start')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        votebuffer.flush()
+
+    def assertTotals(self, likes, dislikes):
+        votebuffer.flush()
+        self.review.refresh_from_db(fields=['nb_likes', 'nb_dislikes'])
+        self.assertEqual((self.review.nb_likes, self.review.nb_dislikes), (likes, dislikes))
+
+    def test_vote(self):
+        self.assertTrue(ReviewVote.vote(self.review, self.voters[0], 1))
+        self.assertTrue(ReviewVote.vote(self.review, self.voters[1], 1))
+        self.assertFalse(ReviewVote.vote(self.review, self.voters[0], 1))
+        self.assertTotals(2, 0)
+        self.assertTrue(ReviewVote.vote(self.review, self.voters[0], -1))
+        self.assertFalse(ReviewVote.vote(self.review, self.voters[0], -1))
+        self.assertTotals(1, 1)
+        self.assertEqual(ReviewVote.objects.filter(review=self.review).count(), 2)
+
+    def test_failed_flush(self):
+        # A total going negative is dropped, the others are written
+        ReviewVote.vote(self.review, self.voters[0], 1)
+        votebuffer.add(self.review.pk, None, dislikes=-1)
+        with self.assertLogs('library.votebuffer', 'ERROR'):
+            self.assertEqual(votebuffer.flush(), 1)
+        self.assertEqual(votebuffer._pending, {})
+        self.assertTotals(1, 0)
+
+
+class ReviewReportTests(TestCase):
+    """
+    A review joins the moderation queue once, at the report threshold
+    """
+
+    def test_reports(self):
+        book = Book.objects.create(
+            isbn='7-0000-0000-0', status=1, title='Reported', author_pseudonym='Author', price=10, year_of_pub=2000,
+            image_url='http://example.com/cover.jpg', category=Category.objects.create(name='Fantasy'),
+        )
+        author = CustomUser.objects.create(username='reviewer', birthday=datetime.date(1990, 1, 1))
+        review = Review.objects.create(
+            content='Content', summary='Summary',
+            associated_rating=Rating.objects.create(user=author, book=book, evaluation=1),
+        )
+        users = [
+            CustomUser.objects.create(username='reporter%d' % i, birthday=datetime.date(1990, 1, 1))
+            for i in range(Review.REPORTS_THRESHOLD + 1)
+        ]
+        self.assertTrue(ReviewReport.report(review, users[0]))
+        self.assertFalse(ReviewReport.report(review, users[0]))
+        for user in users[1:Review.REPORTS_THRESHOLD - 1]:
+            ReviewReport.report(review, user)
+        self.assertFalse(ReportedReview.objects.exists())
+        ReviewReport.report(review, users[Review.REPORTS_THRESHOLD - 1])
+        ReviewReport.report(review, users[Review.REPORTS_THRESHOLD])
+        self.assertEqual(ReportedReview.objects.filter(review=review).count(), 1)
+        self.assertEqual(ModerationCounter.values()[ModerationCounter.REPORTED_REVIEWS], 1)
+        self.assertEqual(Review.objects.get(pk=review.pk).nb_reports, Review.REPORTS_THRESHOLD + 1)
+
+        moderator = CustomUser.objects.create(username='moderator', birthday=datetime.date(1990, 1, 1), authorization_level=4)
+        self.client.force_login(moderator)
+        self.client.get(reverse('library:keep_review', kwargs={'bookid': book.pk, 'reviewid': review.pk}))
+        self.assertFalse(ReportedReview.objects.exists())
+        self.assertEqual(ModerationCounter.values()[ModerationCounter.REPORTED_REVIEWS], 0)
+        self.assertEqual(Review.objects.get(pk=review.pk).nb_reports, 0)
+
+
+@override_settings(PAGE_CACHE=True)
+class PageCacheTests(TestCase):
+    """
+    The cached pages of a book and of the catalog are invalidated by the
+    writes shown on them, and visitors never get each other's pages
+    """
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('django.db.transaction.on_commit', lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.book = Book.objects.create(
+            isbn='11-0000-0000-0', status=1, title='Cached', author_pseudonym='Author', price=10, year_of_pub=2000,
+            image_url='http://example.com/cover.jpg', category=Category.objects.create(name='Fantasy'),
+        )
+        self.user = CustomUser.objects.create(username='reader', birthday=datetime.date(1990, 1, 1), balance=100)
+        self.book_url = reverse('library:bookdetails', kwargs={'bookid': self.book.pk})
+        self.index_url = reverse('library:index')
+
+    def get(self, url):
+        """
+        Return (content, whether the page came from the cache)
+        """
+        name = 'index' if url == self.index_url else 'bookdetails'
+        hits = pagecache.stats([name])[name]['hits']
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.content, pagecache.stats([name])[name]['hits'] > hits
+
+    def assertInvalidated(self, write, urls):
+        for url in urls:
+            self.get(url)
+            self.assertTrue(self.get(url)[1])
+        write()
+        for url in urls:
+            self.assertFalse(self.get(url)[1], url)
+
+    def test_invalidation(self):
+        rating = Rating.objects.create(user=self.user, book=self.book, evaluation=3)
+        self.assertInvalidated(
+            lambda: Rating.objects.filter(pk=rating.pk).first().save(), [self.book_url, self.index_url]
+        )
+        review = Review.objects.create(content='Content', summary='Summary', associated_rating=rating)
+        self.assertInvalidated(
+            lambda: Comment.objects.create(content='Comment', parent_review=review, user=self.user), [self.book_url]
+        )
+        self.assertInvalidated(lambda: self.user.buy([self.book.pk]), [self.book_url])
+        self.assertInvalidated(lambda: Review.objects.get(pk=review.pk).delete(), [self.book_url])
+        # Reviews are not shown in the catalog
+        self.assertTrue(self.get(self.index_url)[1])
+
+    def test_visitors(self):
+        anonymous, _ = self.get(self.book_url)
+        self.client.force_login(self.user)
+        # Cached once the CSRF cookie of the forms of the page is set
+        logged_in, cached = self.get(self.book_url)
+        self.assertFalse(cached)
+        self.assertNotEqual(logged_in, anonymous)
+        self.assertFalse(self.get(self.book_url)[1])
+        self.assertTrue(self.get(self.book_url)[1])
+        self.client.logout()
+        content, cached = self.get(self.book_url)
+        self.assertTrue(cached)
+        self.assertEqual(content, anonymous)
+
+
+@override_settings(PAGE_CACHE=True)
+class ConditionalGetTests(TestCase):
+    """
+    The JSON pages answer 304 while their version counters are unchanged
+    """
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch('django.db.transaction.on_commit', lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_etag(self):
+        book = Book.objects.create(
+            isbn='8-0000-0000-0', status=1, title='Cached', author_pseudonym='Author', price=10, year_of_pub=2000,
+            image_url='http://example.com/cover.jpg', category=Category.objects.create(name='Fantasy'),
+        )
+        url = reverse('library:bookdetails_json', kwargs={'bookid': book.pk})
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        user = CustomUser.objects.create(username='rater', birthday=datetime.date(1990, 1, 1))
+        Rating.objects.create(user=user, book=book, evaluation=5)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['rating_count'], 1)
+
+
+class FriendshipPairTests(TestCase):
+    """
+    A pair of users has a single friendship whatever its direction
+    """
+
+    def setUp(self):
+        self.users = [CustomUser.objects.create(username='pair%d' % i, birthday=datetime.date(1990, 1, 1)) for i in range(4)]
+
+    def test_between(self):
+        friendship = Friendship.objects.create(sender=self.users[1], target=self.users[0])
+        self.assertEqual(Friendship.between(self.users[0], self.users[1]), friendship)
+        self.assertEqual(Friendship.between(self.users[1], self.users[0]), friendship)
+        self.assertIsNone(Friendship.between(self.users[0], self.users[2]))
+        with self.assertRaises(ValidationError):
+            Friendship.objects.create(sender=self.users[0], target=self.users[1])
+
+    def test_backfill(self):
+        # Rows written before the pair columns existed, in both directions
+        users = self.users
+        Friendship.objects.bulk_create([
+            Friendship(sender=users[0], target=users[1], status=0),
+            Friendship(sender=users[1], target=users[0], status=1),
+            Friendship(sender=users[2], target=users[3], status=0),
+            Friendship(sender=users[3], target=users[2], status=0),
+            Friendship(sender=users[2], target=users[0], status=1),
+        ])
+        call_command('backfill_friendship_pairs', stdout=StringIO())
+        self.assertEqual(Friendship.objects.count(), 3)
+        self.assertFalse(Friendship.objects.filter(pair_low__isnull=True).exists())
+        # The accepted friendship or else the oldest request is kept
+        self.assertEqual(Friendship.between(users[0], users[1]).sender, users[1])
+        self.assertEqual(Friendship.between(users[2], users[3]).sender, users[2])
+        self.assertEqual(Friendship.between(users[0], users[2]).status, 1)
+
+
+class RecommendationTests(TestCase):
+    """
+    A book can be recommended once to each accepted friend who does not own it
+    """
+
+    def setUp(self):
+        self.book = Book.objects.create(
+            isbn='12-0000-0000-0', status=1, title='Recommended', author_pseudonym='Author', price=10, year_of_pub=2000,
+            image_url='http://example.com/cover.jpg', category=Category.objects.create(name='Fantasy'),
+        )
+        self.sender = CustomUser.objects.create(username='sender', birthday=datetime.date(1990, 1, 1))
+        self.sender.books.add(self.book)
+        self.users = [CustomUser.objects.create(username='friend%d' % i, birthday=datetime.date(1990, 1, 1)) for i in range(5)]
+        for i, user in enumerate(self.users):
+            # Friends in both directions, the last one still waiting for approval
+            if i % 2:
+                Friendship.objects.create(sender=self.sender, target=user, status=1 if i < 4 else 0)
+            else:
+                Friendship.objects.create(sender=user, target=self.sender, status=1 if i < 4 else 0)
+        self.users[2].books.add(self.book)
+        Recommendation.objects.create(sender=self.sender, target=self.users[3], book=self.book)
+        CustomUser.objects.create(username='stranger', birthday=datetime.date(1990, 1, 1))
+
+    def test_candidates(self):
+        self.assertEqual(list(Recommendation.candidates(self.sender, self.book)), self.users[:2])
+        # The sender owns the book
+        self.assertEqual(list(Recommendation.candidates(self.users[0], self.book)), [])
+
+    def test_recommend(self):
+        self.client.force_login(self.sender)
+        url = reverse('library:recommend_book', kwargs={'bookid': self.book.pk})
+        response = self.client.post(url, {'friends': [self.users[4].pk]})
+        self.assertEqual(response.context['status'], 2)
+        response = self.client.post(url, {'friends': [user.pk for user in self.users[:2]]})
+        self.assertEqual(response.context['status'], 1)
+        self.assertEqual(
+            set(Recommendation.objects.filter(sender=self.sender).values_list('target', flat=True)),
+            {self.users[0].pk, self.users[1].pk, self.users[3].pk},
+        )
+        self.assertEqual(self.client.get(url).context['status'], 3)
+
+
+class FriendGraphTests(SimpleTestCase):
+    """
+    Suggestions are ranked by number of mutual friends and kept up to date
+    by the incremental changes
+    """
+
+    def test_suggestions(self):
+        graph = FriendGraph(0)
+        for user1, user2 in [(1, 2), (1, 3), (2, 4), (3, 4), (2, 5)]:
+            graph.add(user1, user2)
+        self.assertEqual(graph.suggestions(1, 5), [(4, 2), (5, 1)])
+        self.assertEqual(graph.suggestions(1, 5, exclude=[4]), [(5, 1)])
+        graph.add(3, 5)
+        graph.add(3, 5)
+        graph.remove(2, 4)
+        self.assertEqual(graph.suggestions(1, 5), [(5, 2), (4, 1)])
+
+
+class FriendSuggestionTests(TestCase):
+    """
+    Without a shared cache, the graph of a process follows the friendships
+    version stored in the database
+    """
+
+    def setUp(self):
+        # The versions start over with every test
+        friendgraph._graph = None
+
+    def test_people_you_may_know(self):
+        users = [CustomUser.objects.create(username='user%d' % i, birthday=datetime.date(1990, 1, 1)) for i in range(4)]
+
+        def befriend(sender, target):
+            friendship = Friendship.objects.create(sender=sender, target=target)
+            friendship.status = 1
+            friendship.save()
+            return friendship
+
+        befriend(users[0], users[1])
+        befriend(users[1], users[2])
+        self.assertEqual(friendgraph.people_you_may_know(users[0]), [(users[2], 1)])
+        with self.assertNumQueries(3):
+            # version, pending requests, users
+            friendgraph.people_you_may_know(users[0])
+        last = befriend(users[3], users[1])
+        self.assertEqual(friendgraph.people_you_may_know(users[0]), [(users[2], 1), (users[3], 1)])
+        last.delete()
+        self.assertEqual(friendgraph.people_you_may_know(users[0]), [(users[2], 1)])
+
+
+class BulkCopyTests(SimpleTestCase):
+    """
+    The COPY data of the bulk loaders fills the columns that save() would
+    """
+
+    def test_auto_now_add(self):
+        date = datetime.datetime(2010, 1, 1, tzinfo=datetime.timezone.utc)
+        columns, data = bulk.copy_data(ReviewVote, [
+            {'review_id': 1, 'user_id': 2, 'value': 1},
+            {'review_id': 1, 'user_id': 3, 'value': -1, 'date': date},
+        ])
+        columns = [c.strip('"') for c in columns.split(', ')]
+        rows = [dict(zip(columns, line.split('\t'))) for line in data.getvalue().splitlines()]
+        self.assertNotEqual(rows[0]['date'], '\\N')
+        self.assertTrue(rows[1]['date'].startswith('2010-01-01'))
+        self.assertEqual(rows[1]['value'], '-1')
+
+
+class LoadBXTests(TestCase):
+    """
+    An interrupted load of the BX dump resumes after its last inserted shard
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        files = {
+            'FirstNames.csv': ['Alice', 'Bob'],
+            'LastNames.csv': ['Martin', 'Durand'],
+            'BX-Users.csv': ['"User-ID";"Location";"Age"'] + ['"%d";"city %d, france";"30"' % (i, i) for i in range(1, 31)],
+            'BX-Books.csv': [
+                '"ISBN";"Book-Title";"Book-Author";"Year-Of-Publication";"Publisher";"Image-URL-S";"Image-URL-M";"Image-URL-L"',
+                '"0195153448";"Classical Mythology";"Mark P. O. Morford";"2002";"Oxford";"http://example.com/s.jpg";"m";"l"',
+            ],
+            'BX-Book-Ratings.csv': ['"User-ID";"ISBN";"Book-Rating"'] + ['"%d";"0195153448";"8"' % i for i in range(1, 31)],
+        }
+        for name, lines in files.items():
+            with open(os.path.join(self.root, name), 'w', encoding='latin-1') as f:
+                f.write('\n'.join(lines) + '\n')
+
+    def test_resume(self):
+        insert = load_bx.Command.insert
+        calls = []
+
+        def interrupted(command, model, rows):
+            calls.append(model)
+            if model is Rating and calls.count(Rating) == 2:
+                raise KeyboardInterrupt
+            insert(command, model, rows)
+
+        with mock.patch.object(load_bx.Command, 'insert', interrupted), self.assertRaises(KeyboardInterrupt):
+            call_command('load_bx', self.root, seed=1, shard_size=200, stdout=StringIO())
+        nb_ratings = Rating.objects.count()
+        self.assertTrue(0 < nb_ratings < 30)
+        with self.assertRaises(CommandError):
+            call_command('load_bx', self.root, seed=2, stdout=StringIO())
+        out = StringIO()
+        call_command('load_bx', self.root, stdout=out)
+        self.assertIn('users: already loaded (30 rows), skipping', out.getvalue())
+        self.assertIn('ratings: resuming at byte', out.getvalue())
+        self.assertEqual(CustomUser.objects.count(), 30)
+        self.assertEqual(Rating.objects.count(), 30)
+        self.assertEqual(Book.objects.get().rating_count, 30)
+        self.assertTrue(CustomUser.objects.first().password.startswith('pbkdf2_sha256$%d$' % load_bx.BULK_HASH_ITERATIONS))
+
+
+class ShardTests(SimpleTestCase):
+    """
+    The shards of the BX files start at line boundaries and their rows only
+    depend on the seed and the shard size
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'BX-Users.csv')
+        with open(self.path, 'w', encoding='latin-1') as f:
+            f.write('"User-ID";"Location";"Age"\n')
+            for i in range(1, 41):
+                f.write('"%d";"city %d, france";"%s"\n' % (i, i, 'NULL' if i % 3 else 20 + i))
+        self.context = {
+            'seed': 1, 'first_names': ['Alice', 'Bob'], 'last_names': ['Martin', 'Durand'],
+            'hash_iterations': load_bx.BULK_HASH_ITERATIONS,
+        }
+
+    def test_shard_ranges(self):
+        ranges = parallel.shard_ranges(self.path, 100)
+        self.assertGreater(len(ranges), 5)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], len(data))
+        for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(end, next_start)
+            self.assertEqual(data[next_start - 1:next_start], b'\n')
+
+    def test_resume(self):
+        def rows(start=0):
+            return {
+                index: [dict(row, password=None) for row in shard_rows]
+                for index, _, shard_rows, _, _ in parallel.iter_shards('users', self.path, self.context, shard_size=100, start=start)
+            }
+
+        shards = list(parallel.iter_shards('users', self.path, self.context, shard_size=100))
+        self.assertEqual([row['id'] for shard in shards for row in shard[2]], list(range(1, 41)))
+        self.assertTrue(shards[0][2][0]['password'].startswith('pbkdf2_sha256$%d$' % load_bx.BULK_HASH_ITERATIONS))
+        all_rows = rows()
+        resumed = rows(start=shards[2][1])
+        self.assertEqual(sorted(resumed), list(range(3, len(shards))))
+        self.assertEqual(resumed, {index: all_rows[index] for index in resumed})
+
+
+@override_settings(REPLICA_DATABASES=['replica'])
+class ReplicaRoutingTests(SimpleTestCase):
+    """
+    Safe requests read from the replica, unless the client wrote recently or
+    the replica lags behind
+    """
+
+    def setUp(self):
+        replicas._lags.clear()
+        self.router = replicas.ReplicaRouter()
+        self.factory = RequestFactory()
+
+    def view(self, request):
+        if request.GET.get('write'):
+            self.router.db_for_write(Book)
+        self.read = self.router.db_for_read(Book)
+        return HttpResponse()
+
+    def test_read_your_writes(self):
+        middleware = replicas.ReplicaMiddleware(self.view)
+        with mock.patch.object(replicas, 'replica_lag', return_value=0):
+            response = middleware(self.factory.get('/'))
+            self.assertEqual(self.read, 'replica')
+            self.assertNotIn(replicas.PRIMARY_COOKIE, response.cookies)
+            response = middleware(self.factory.get('/', {'write': 1}))
+            self.assertEqual(self.read, 'default')
+            request = self.factory.get('/')
+            request.COOKIES[replicas.PRIMARY_COOKIE] = response.cookies[replicas.PRIMARY_COOKIE].value
+            middleware(request)
+            self.assertEqual(self.read, 'default')
+            middleware(self.factory.post('/'))
+            self.assertEqual(self.read, 'default')
+
+    def test_lagging_replica(self):
+        middleware = replicas.ReplicaMiddleware(self.view)
+        with mock.patch.object(replicas, 'replica_lag', return_value=60):
+            middleware(self.factory.get('/'))
+        self.assertEqual(self.read, 'default')
+
+
+# A 1x1 PNG image
+COVER = base64.b64decode(
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8DwHwAFBQIAX8jx0gAAAABJRU5ErkJggg=='
+)
+
+
+class IndexAdvisorTests(TestCase):
+    """
+    The scans of large tables and the misestimated rows of the plans of the
+    queries of the views are reported
+    """
+
+    def test_command(self):
+        Book.objects.create(
+            isbn='14-0000-0000-0', status=1, title='Advised', author_pseudonym='Author', price=10, year_of_pub=2000,
+            image_url='http://example.com/cover.jpg', category=Category.objects.create(name='Fantasy'),
+        )
+        out = StringIO()
+        call_command('index_advisor', anonymous=True, only=['index'], min_rows=0, plans=True, stdout=out)
+        self.assertIn('index /library/ (3 queries)', out.getvalue())
+        self.assertIn('    | SEARCH library_book USING INDEX', out.getvalue())
+        self.assertIn('0 problems found', out.getvalue())
+
+    def test_sqlite_plan(self):
+        command = index_advisor.Command()
+        command.options = {'min_rows': 1000}
+        command.table_sizes = {'library_book': 5000, 'library_category': 10, 'subquery': None}
+        problems, plan = command.sqlite_problems([
+            (2, 0, 0, 'SCAN library_book'),
+            (3, 0, 0, 'SCAN TABLE library_category AS c'),
+            (4, 0, 0, 'SCAN subquery'),
+            (5, 0, 0, 'SEARCH library_book USING INDEX library_boo_status_282233_idx (status=?)'),
+        ])
+        self.assertEqual(problems, ['full scan of library_book (5000 rows)'])
+        self.assertEqual(len(plan), 4)
+
+    def test_postgres_plan(self):
+        command = index_advisor.Command()
+        command.options = {'min_rows': 1000, 'factor': 10}
+        command.table_sizes = {'library_book': 5000, 'library_category': 10}
+        problems, plan = command.postgres_problems({
+            'Node Type': 'Hash Join', 'Plan Rows': 50, 'Actual Rows': 40, 'Plans': [
+                {'Node Type': 'Seq Scan', 'Relation Name': 'library_book', 'Filter': '(status = 1)',
+                 'Plan Rows': 5000, 'Actual Rows': 40},
+                {'Node Type': 'Seq Scan', 'Relation Name': 'library_category', 'Plan Rows': 10, 'Actual Rows': 10},
+            ],
+        })
+        self.assertEqual(problems, [
+            'sequential scan of library_book (5000 rows, filter (status = 1))',
+            'Seq Scan on library_book: estimated 5000 rows, actual 40',
+        ])
+        self.assertEqual(len(plan), 3)
+        self.assertTrue(plan[1].startswith('  Seq Scan on library_book'))
+
+
+class CoverOrigin(BaseHTTPRequestHandler):
+    requests = 0
+
+    def do_GET(self):
+        CoverOrigin.requests += 1
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(COVER)))
+        self.end_headers()
+        self.wfile.write(COVER)
+
+    def log_message(self, *args):
+        pass
+
+
+class CoverProxyTests(TestCase):
+    """
+    Covers are downloaded from their origin once, then served from the disk
+    with long-lived cache headers
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super(CoverProxyTests, cls).setUpClass()
+        cls.origin = HTTPServer(('127.0.0.1', 0), CoverOrigin)
+        threading.Thread(target=cls.origin.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.origin.shutdown()
+        cls.origin.server_close()
+        super(CoverProxyTests, cls).tearDownClass()
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        # The origin of the tests runs on the loopback address
+        cover_settings = override_settings(COVER_CACHE_DIR=directory, COVER_ALLOW_PRIVATE_ADDRESSES=True)
+        cover_settings.enable()
+        self.addCleanup(cover_settings.disable)
+        CoverOrigin.requests = 0
+
+    def add_book(self, status=1):
+        return Book.objects.create(
+            isbn='3-0000-0000-%d' % status, status=status, title='Covered', author_pseudonym='Author', price=10,
+            year_of_pub=2000, image_url='http://127.0.0.1:%d/cover.png' % self.origin.server_port,
+            category=Category.objects.get_or_create(name='Fantasy')[0],
+        )
+
+    def test_cover(self):
+        book = self.add_book()
+        response = self.client.get(book.list_cover_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertIn(response['Content-Type'], ('image/png', 'image/jpeg'))
+        response = self.client.get(book.detail_cover_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(book.list_cover_url, HTTP_IF_NONE_MATCH=response['ETag'].replace('detail', 'list'))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(CoverOrigin.requests, 1)
+
+    def test_private_origin(self):
+        # Non-public addresses are never fetched, and a failed download is
+        # not tried again for a while
+        book = self.add_book()
+        with override_settings(COVER_ALLOW_PRIVATE_ADDRESSES=False):
+            response = self.client.get(book.list_cover_url)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.client.get(book.list_cover_url).status_code, 302)
+        self.assertEqual(CoverOrigin.requests, 0)
+
+    def test_unpublished(self):
+        # Only the author and the moderators see the covers of the books
+        # waiting for publication
+        book = self.add_book(status=0)
+        book.author = CustomUser.objects.create(username='author', birthday=datetime.date(1990, 1, 1))
+        book.save()
+        self.assertEqual(self.client.get(book.list_cover_url).status_code, 404)
+        self.client.force_login(CustomUser.objects.create(username='reader', birthday=datetime.date(1990, 1, 1)))
+        self.assertEqual(self.client.get(book.list_cover_url).status_code, 404)
+        self.client.force_login(book.author)
+        response = self.client.get(book.list_cover_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+
+
+@override_settings(REQUEST_METRICS=True)
+class RequestMetricsTests(TestCase):
+    """
+    The same query run REPEATED_QUERY_THRESHOLD times in a request is
+    reported as an N+1 pattern
+    """
+
+    def run_queries(self, nb_queries):
+        def view(request):
+            for _ in range(nb_queries):
+                list(Category.objects.filter(name='Fantasy'))
+            return HttpResponse()
+
+        def get_response(request):
+            middleware.process_view(request, view, (), {})
+            return view(request)
+
+        middleware = instrumentation.RequestMetricsMiddleware(get_response)
+        with mock.patch.dict(instrumentation._views, clear=True):
+            middleware(RequestFactory().get('/'))
+            return instrumentation._views['unresolved']
+
+    def test_repeated_queries(self):
+        metrics = self.run_queries(instrumentation.REPEATED_QUERY_THRESHOLD - 1)
+        self.assertEqual(metrics.repeated_queries, 0)
+        self.assertEqual(metrics.queries.sum, instrumentation.REPEATED_QUERY_THRESHOLD - 1)
+        with self.assertLogs('online_library.instrumentation', 'WARNING'):
+            metrics = self.run_queries(instrumentation.REPEATED_QUERY_THRESHOLD)
+        self.assertEqual(metrics.repeated_queries, 1)
+        self.assertEqual(sum(metrics.view_time.counts), 1)
+
+    def test_prometheus_families(self):
+        # Every sample follows the TYPE line of its own family
+        with mock.patch.dict(instrumentation._views, clear=True):
+            for name in ('a', 'b'):
+                instrumentation._views[name] = instrumentation.ViewMetrics()
+            request = RequestFactory().get('/metrics/')
+            request.user = mock.Mock(is_staff=True)
+            text = instrumentation.metrics(request).content.decode()
+        family = None
+        seen = set()
+        for line in text.splitlines():
+            if line.startswith('# TYPE '):
+                family = line.split()[2]
+                self.assertNotIn(family, seen)
+                seen.add(family)
+            else:
+                sample = line.split('{')[0]
+                self.assertIn(sample, (family, family + '_bucket', family + '_sum', family + '_count'))
+        self.assertIn('library_requests_total', seen)
+
+
+class StaticFilesTests(SimpleTestCase):
+    """
+    Collected files are served with the precompressed copy accepted by the
+    client, and the hashed ones are cached for good
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.css = b'body { color: black; }\n' * 100
+        for name, data in [('app.css', self.css), ('tiny.js', b'x'), ('logo.png', b'\x89PNG' * 100)]:
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(data)
+        self.storage = staticfiles.CompressedManifestStorage(location=self.root)
+
+    def test_compress(self):
+        with mock.patch.object(staticfiles, '_brotli', return_value=None):
+            self.storage.compress(['app.css', 'tiny.js', 'logo.png'])
+        self.assertEqual(sorted(os.listdir(self.root)), ['app.css', 'app.css.gz', 'logo.png', 'tiny.js'])
+        with open(os.path.join(self.root, 'app.css.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), self.css)
+        # Not collected yet, the names are not hashed
+        self.assertEqual(self.storage.stored_name('app.css'), 'app.css')
+
+    def test_serve(self):
+        with mock.patch.object(staticfiles, '_brotli', return_value=None):
+            self.storage.compress(['app.css'])
+        factory = RequestFactory()
+        with override_settings(STATIC_ROOT=self.root):
+            response = staticfiles.serve(factory.get('/', HTTP_ACCEPT_ENCODING='br, gzip'), 'app.css')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Content-Type'], 'text/css')
+            self.assertEqual(response['Vary'], 'Accept-Encoding')
+            self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), self.css)
+            self.assertIn('max-age=60', response['Cache-Control'])
+            response = staticfiles.serve(factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0'), 'app.css')
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(b''.join(response.streaming_content), self.css)
+            with mock.patch.object(staticfiles, 'staticfiles_storage', mock.Mock(hashed_files={'app.css': 'app.css'})):
+                response = staticfiles.serve(factory.get('/'), 'app.css')
+            self.assertIn('immutable', response['Cache-Control'])
+            self.assertIn('max-age=%d' % staticfiles.MAX_AGE, response['Cache-Control'])
+            for path in ('../etc/passwd', 'missing.css'):
+                with self.assertRaises(Http404):
+                    staticfiles.serve(factory.get('/'), path)
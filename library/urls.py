@@ -7,16 +7,26 @@ urlpatterns = [
     path('', views.index, name='index'),
     path('library/', views.index, name='index'),
     path('library/<int:page>/', views.index, name='index'),
+    path('library/search/', views.search, name='search'),
+    path('library/search/json/', views.search_json, name='search_json'),
+    path('library/json/', views.index_json, name='index_json'),
     path('library/book-<bookid>/', views.bookdetails, name='bookdetails'),
+    path('library/book-<bookid>/cover/<size>/', views.cover, name='cover'),
+    path('library/book-<bookid>/json/', views.bookdetails_json, name='bookdetails_json'),
+    path('library/book-<bookid>/reviews/json/', views.book_reviews_json, name='book_reviews_json'),
     path('library/book-<bookid>/review/write', views.write_review, name='writereview'),
     path('library/book-<bookid>/rate/<int:rating>/', views.ratebook, name='ratebook'),
     path('library/book-<bookid>/buy/', views.buy_book, name='buy_book'),
+    path('library/book-<bookid>/cart/', views.add_to_cart, name='add_to_cart'),
+    path('library/book-<bookid>/cart/remove/', views.remove_from_cart, name='remove_from_cart'),
+    path('library/cart/', views.cart, name='cart'),
     path('library/book-<bookid>/recommend/', views.recommend_book, name='recommend_book'),
     path('library/book-<bookid>/delete/', views.delete_book, name='delete_book'),
     path('library/book-<bookid>/acceptpublication/', views.accept_publication, name='accept_publication'),
     path('library/book-<bookid>/rejectpublication/', views.reject_publication, name='reject_publication'),
     path('library/book-<bookid>/review-<int:reviewid>/delete/', views.delete_review, name='delete_review'),
     path('library/book-<bookid>/review-<int:reviewid>/report/', views.report_review, name='report_review'),
+    path('library/book-<bookid>/review-<int:reviewid>/keep/', views.keep_review, name='keep_review'),
     path('library/book-<bookid>/review-<int:reviewid>/vote/<vote>/', views.vote_review, name='vote_review'),
     path('library/book-<bookid>/review-<int:reviewid>/comment/', views.comment_review, name='comment_review'),
     path('library/book-<bookid>/review-<int:reviewid>/', views.review_details, name='review_details'),
@@ -24,6 +34,7 @@ urlpatterns = [
     path('account/moderation/requests/publisher/', views.modo_publisher_requests, name='publisher_requests'),
     path('account/moderation/requests/publication/', views.modo_publication_requests, name='publication_requests'),
     path('account/moderation/requests/report/', views.modo_review_reports, name='review_reports'),
+    path('account/moderation/cache/', views.modo_cache_stats, name='cache_stats'),
     path('account/signup/', views.SignUp.as_view(), name='signup'),
     path('account/profile/<user>/', views.profile, name='profile'),
     path('account/profile/<user>/update/', views.CustomUserUpdate.as_view(), name='update_profile'),
@@ -1,61 +1,225 @@
 from django.shortcuts import get_object_or_404, render
-from django.http import HttpResponseRedirect, Http404
+from django.http import FileResponse, HttpResponseNotModified, HttpResponseRedirect, Http404, JsonResponse
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
 from django.contrib.auth import authenticate, login as auth_login, logout as auth_logout
 from django.contrib.auth.decorators import login_required
-from django.utils.http import is_safe_url
+from django.utils.cache import patch_cache_control
+from django.utils.http import is_safe_url, parse_etags, quote_etag
 from django.views import generic
+from django.views.decorators.http import require_POST
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef
 from django.views.generic.edit import UpdateView
 
 from .models import *
 from .forms import *
+from .pagination import keyset_page
+from .pagecache import versioned_page, conditional_page, catalog_keys, book_keys
+from . import covers, facets, friendgraph, pagecache
+from .search import search_books
 
 import math
 
 
+@versioned_page('index', catalog_keys)
 def index(request, page=1):
     book_per_page = 15
-    nb_books = Book.objects.count()
-    first = (page - 1) * book_per_page
-    last = min(first + book_per_page, nb_books)
+    max_numbered_page = 10
+    try:
+        filters = facets.parse(request.GET)
+    except ValueError:
+        raise Http404
+    nb_books, book_facets = facets.counts(filters)
     nb_pages = max(1, math.ceil(nb_books / book_per_page))
-    min_next_page = max(1, page - 5)
-    max_next_page = min(nb_pages, page + 5)
-    if min_next_page == 1:
-        max_next_page = min(nb_pages, 10)
-    if max_next_page == nb_pages:
-        min_next_page = max(1, nb_pages - 10)
-
-    if page >= 1 and page <= nb_pages:
-        latest_books_list = Book.objects.filter(status=1).order_by('-year_of_pub')[first:last]
-
-        ratings = list()
-        nb_ratings = list()
-        for book in latest_books_list:
-            rts = book.rating_set.all()
-            if rts.count() == 0: avg_rating = 0
-            else: avg_rating = sum([r.evaluation for r in rts]) / rts.count()
-            ratings = ratings + [avg_rating]
-            nb_ratings = nb_ratings + [rts.count()]
+    cursor = request.GET.get('cursor')
+    if cursor:
+        page = None
+    elif page < 1 or page > min(nb_pages, max_numbered_page):
+        raise Http404
 
-        context = {
-            'nb_books': nb_books,
-            'nb_books_displayed': last - first,
-            'page': page,
-            'nb_pages': nb_pages,
-            'page_range': range(min_next_page, max_next_page + 1),
-            'latest_books_list': zip(latest_books_list, ratings, nb_ratings),
-            'prev_page': page - 1,
-            'next_page': page + 1,
-            'first_displayed': min(first + 1, last),
-            'last_displayed': last,
-        }
-        return render(request, 'library/index.html', context)
+    try:
+        books = keyset_page(
+            facets.filter_books(Book.objects.published().for_listing(), filters),
+            Book.CATALOG_ORDERING,
+            cursor=cursor,
+            per_page=book_per_page,
+            offset=((page or 1) - 1) * book_per_page,
+        )
+    except ValueError:
+        raise Http404
+
+    context = {
+        'nb_books': nb_books,
+        'nb_books_displayed': len(books),
+        'page': page,
+        'page_range': range(1, min(nb_pages, max_numbered_page) + 1),
+        'latest_books_list': books.items,
+        'first_displayed': ((page or 1) - 1) * book_per_page + min(1, len(books)),
+        'last_displayed': ((page or 1) - 1) * book_per_page + len(books),
+        'next_cursor': books.next_cursor,
+        'prev_cursor': books.prev_cursor,
+        'facets': book_facets,
+        'filters': filters,
+        'filter_query': facets.query_string(filters),
+    }
+    return render(request, 'library/index.html', context)
+
+def search_page(request, book_per_page=15):
+    """
+    Return (query, page, books, has_next) for the search parameters of the request
+    """
+    query = request.GET.get('q', '').strip()
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        raise Http404
+    if page < 1:
+        raise Http404
+    isbns = search_books(query, limit=book_per_page + 1, offset=(page - 1) * book_per_page)
+    found = Book.objects.for_listing().in_bulk(isbns[:book_per_page])
+    books = [found[isbn] for isbn in isbns[:book_per_page] if isbn in found]
+    return query, page, books, len(isbns) > book_per_page
+
+def search(request):
+    query, page, books, has_next = search_page(request)
+    context = {
+        'query': query,
+        'page': page,
+        'books': books,
+        'prev_page': page - 1,
+        'next_page': page + 1 if has_next else 0,
+    }
+    return render(request, 'library/search.html', context)
+
+def book_json(book):
+    return {
+        'isbn': book.isbn,
+        'title': book.title,
+        'author_pseudonym': book.author_pseudonym,
+        'category': book.category.name,
+        'year_of_pub': book.year_of_pub,
+        'price': str(book.price),
+        'image_url': book.image_url,
+        'cover_url': book.list_cover_url,
+        'avg_rating': book.avg_rating,
+        'rating_count': book.rating_count,
+        'url': reverse('library:bookdetails', kwargs={'bookid':book.pk}),
+    }
+
+def review_json(review):
+    return {
+        'id': review.pk,
+        'author': review.associated_rating.user.username,
+        'evaluation': review.associated_rating.evaluation,
+        'date': review.date.isoformat(),
+        'summary': review.summary,
+        'content': review.content,
+        'nb_likes': review.nb_likes,
+        'nb_dislikes': review.nb_dislikes,
+        'nb_comments': review.nb_comments,
+        'url': reverse('library:review_details', kwargs={'bookid':review.book_id, 'reviewid':review.pk}),
+    }
 
+def search_json(request):
+    query, page, books, has_next = search_page(request)
+    return JsonResponse({
+        'query': query,
+        'page': page,
+        'next_page': page + 1 if has_next else None,
+        'results': [book_json(book) for book in books],
+    })
+
+@conditional_page(catalog_keys)
+def index_json(request, book_per_page=15):
+    try:
+        filters = facets.parse(request.GET)
+        books = keyset_page(
+            facets.filter_books(Book.objects.published().for_listing(), filters),
+            Book.CATALOG_ORDERING,
+            cursor=request.GET.get('cursor'),
+            per_page=book_per_page,
+        )
+    except ValueError:
+        raise Http404
+    nb_books, book_facets = facets.counts(filters)
+    return JsonResponse({
+        'nb_books': nb_books,
+        'facets': {
+            facet: [{k: v[k] for k in ('value', 'label', 'count', 'selected')} for v in values]
+            for facet, values in book_facets.items()
+        },
+        'next_cursor': books.next_cursor,
+        'prev_cursor': books.prev_cursor,
+        'results': [book_json(book) for book in books],
+    })
+
+def cover(request, bookid, size):
+    """
+    Thumbnail of the cover of a book, downloaded from its origin the first
+    time. Its URL changes with the cover, so browsers keep it for a year.
+    The covers of the books not published are only shown to their author
+    and to the moderators.
+    """
+    if size not in covers.SIZES:
+        raise Http404
+    book = get_object_or_404(Book.objects.only('image_url', 'status', 'author_id'), pk=bookid)
+    usr = request.user
+    published = book.status == 1
+    if not published and not (usr.is_authenticated and (usr.pk == book.author_id or usr.authorization_level == 4)):
+        raise Http404
+    try:
+        path, content_type, content_hash = covers.thumbnail(book.image_url, size)
+    except covers.CoverUnavailable:
+        url = book.image_url if '://' in book.image_url else 'http://' + book.image_url
+        response = HttpResponseRedirect(url)
+        patch_cache_control(response, max_age=60)
+        return response
+    etag = quote_etag(content_hash + '-' + size)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+    response['ETag'] = etag
+    if published:
+        patch_cache_control(response, public=True, max_age=covers.MAX_AGE, immutable=True)
     else:
+        patch_cache_control(response, private=True, max_age=covers.MAX_AGE)
+    return response
+
+@conditional_page(book_keys)
+def bookdetails_json(request, bookid):
+    book = get_object_or_404(Book.objects.for_listing(), pk=bookid, status=1)
+    data = book_json(book)
+    data.update({
+        'nb_times_bought': book.customuser_set.count(),
+        'nb_reviews': Review.objects.filter(book=book).count(),
+        'reviews_url': reverse('library:book_reviews_json', kwargs={'bookid':book.pk}),
+    })
+    return JsonResponse(data)
+
+@conditional_page(book_keys)
+def book_reviews_json(request, bookid, review_per_page=10):
+    book = get_object_or_404(Book, pk=bookid, status=1)
+    review_sort = request.GET.get('sort', 'newest')
+    if review_sort not in Review.ORDERINGS:
         raise Http404
+    try:
+        reviews = keyset_page(
+            Review.objects.filter(book=book).for_listing(),
+            Review.ORDERINGS[review_sort],
+            cursor=request.GET.get('cursor'),
+            per_page=review_per_page,
+        )
+    except ValueError:
+        raise Http404
+    return JsonResponse({
+        'sort': review_sort,
+        'next_cursor': reviews.next_cursor,
+        'prev_cursor': reviews.prev_cursor,
+        'results': [review_json(review) for review in reviews],
+    })
 
 class SignUp(generic.CreateView):
     form_class = CustomUserCreationForm
@@ -66,27 +230,22 @@ def profile(request, user):
     usr = get_object_or_404(CustomUser, username=user)
     own_profile = (user == request.user.username)
     if request.user.is_authenticated and not own_profile:
-        friends1 = Friendship.objects.filter(sender=request.user).all()
-        friends2 = Friendship.objects.filter(target=request.user).all()
-        if len(friends1) > 0:
-            if friends1[0].status == 1: friend_status = 1
-            else: friend_status = 2
-        elif len(friends2) > 0:
-            if friends2[0].status == 1: friend_status = 1
-            else: friend_status = 3
-        else:
-            friend_status = 4
+        friendship = Friendship.between(request.user, usr)
+        if friendship is None: friend_status = 4
+        elif friendship.status == 1: friend_status = 1
+        elif friendship.sender_id == request.user.pk: friend_status = 2
+        else: friend_status = 3
     else:
         friend_status = 0
 
     if own_profile:
-        requests = Friendship.objects.filter(target=request.user, status=0).all()
-        nb_friend_requests = len(requests)
-        recommendations = Recommendation.objects.filter(target=request.user).all()
-        nb_recommendations = len(recommendations)
+        nb_friend_requests = Friendship.objects.filter(target=request.user, status=0).count()
+        nb_recommendations = Recommendation.objects.filter(target=request.user).count()
+        suggestions = friendgraph.people_you_may_know(request.user)
     else:
         nb_friend_requests = 0
         nb_recommendations = 0
+        suggestions = []
 
     context = {
         'usr': usr,
@@ -94,10 +253,13 @@ def profile(request, user):
         'friend_status': friend_status,
         'nb_friend_requests': nb_friend_requests,
         'nb_recommendations': nb_recommendations,
-        'nb_publication_req': Book.objects.filter(status=0).count(),
-        'nb_publisher_req': CustomUser.objects.filter(authorization_level=2).count(),
-        'nb_reports': Review.objects.filter(nb_reports__gte=5).count(),
+        'suggestions': suggestions,
     }
+    if own_profile and request.user.authorization_level == 4:
+        counters = ModerationCounter.values()
+        context['nb_publication_req'] = counters[ModerationCounter.PUBLICATION_REQUESTS]
+        context['nb_publisher_req'] = counters[ModerationCounter.PUBLISHER_REQUESTS]
+        context['nb_reports'] = counters[ModerationCounter.REPORTED_REVIEWS]
     return render(request, 'library/profile.html', context)
 
 class CustomUserUpdate(UpdateView):
@@ -136,7 +298,9 @@ def modo_publication_requests(request):
 def modo_review_reports(request):
     if request.user.authorization_level == 4:
         context = {
-            'requests': Review.objects.filter(nb_reports__gte=5).all(),
+            'requests': ReportedReview.objects.select_related(
+                'review__associated_rating__user', 'review__associated_rating__book__category'
+            ).order_by('date'),
         }
         return render(request, 'library/modo_review_reports.html', context)
     else:
@@ -144,42 +308,59 @@ def modo_review_reports(request):
             reverse('library:profile', kwargs={'user':request.user.username})
         )
 
+@login_required(redirect_field_name=None)
+def modo_cache_stats(request):
+    if request.user.authorization_level == 4:
+        return JsonResponse(pagecache.stats(['index', 'bookdetails']))
+    else:
+        return HttpResponseRedirect(
+            reverse('library:profile', kwargs={'user':request.user.username})
+        )
+
 @login_required(redirect_field_name=None)
 def incr_balance(request, user):
     usr = request.user
     if usr.username == user:
-        usr.balance += 100
-        usr.save()
+        CustomUser.objects.filter(pk=usr.pk).update(balance=F('balance') + 100)
     return HttpResponseRedirect(
         reverse('library:profile', kwargs={'user':user})
     )
 
-def bookdetails(request, bookid):
-    book = get_object_or_404(Book, pk=bookid, status=1)
+@versioned_page('bookdetails', book_keys)
+def bookdetails(request, bookid, nb_also_liked=5, review_per_page=10):
+    book = get_object_or_404(Book.objects.for_listing(), pk=bookid, status=1)
     owners = book.customuser_set.all()
-    ratings = book.rating_set.all()
-    nb_ratings = ratings.count()
-    if nb_ratings == 0: avg_rating = 0
-    else: avg_rating = sum([r.evaluation for r in ratings]) / nb_ratings
+    review_sort = request.GET.get('reviews', 'newest')
+    if review_sort not in Review.ORDERINGS:
+        raise Http404
+    nb_reviews = Review.objects.filter(book=book).count()
     try:
-        reviews = Review.objects.filter(associated_rating__book__pk=bookid).order_by('date')
-        nb_reviews = reviews.count()
-    except ObjectDoesNotExist:
-        nb_reviews = 0
+        reviews = keyset_page(
+            Review.objects.filter(book=book).for_listing(),
+            Review.ORDERINGS[review_sort],
+            cursor=request.GET.get('cursor'),
+            per_page=review_per_page,
+        )
+    except ValueError:
+        raise Http404
     usr = request.user
     try:
-        usr_rating = Rating.objects.get(user__username=usr.username,book__pk=bookid).evaluation
+        usr_rating = Rating.objects.get(user_id=usr.pk, book_id=bookid).evaluation
     except ObjectDoesNotExist:
         usr_rating = 0
     context = {
         'book': book,
         'nb_times_bought': owners.count(),
-        'nb_ratings': nb_ratings,
-        'avg_rating': avg_rating,
+        'nb_ratings': book.rating_count,
+        'avg_rating': book.avg_rating,
         'nb_reviews': nb_reviews,
         'usr_rating': usr_rating,
-        'reviews': reviews,
-        'owns_book': usr.is_authenticated and book in usr.books.all(),
+        'reviews': reviews.items,
+        'review_sort': review_sort,
+        'next_cursor': reviews.next_cursor,
+        'prev_cursor': reviews.prev_cursor,
+        'owns_book': usr.is_authenticated and usr.books.filter(pk=book.pk).exists(),
+        'also_liked': BookNeighbour.objects.filter(book=book, neighbour__status=1).select_related('neighbour').order_by('-score')[:nb_also_liked],
     }
     return render(request, 'library/book.html', context)
 
@@ -189,7 +370,7 @@ def ratebook(request, bookid, rating):
     if rating >= 1 and rating <= 5:
         usr = request.user
         try:
-            usr_rating = Rating.objects.get(user__username=usr.username,book__pk=bookid)
+            usr_rating = Rating.objects.get(user_id=usr.pk, book_id=bookid)
             usr_rating.evaluation = rating
             usr_rating.save()
         except ObjectDoesNotExist:
@@ -205,18 +386,16 @@ def buy_book(request, bookid):
     usr = request.user
     if request.method == 'POST':
         form = BuyBookForm(request.POST)
-        if form.is_valid() and usr.balance >= book.price and book not in usr.books.all():
-            usr.balance -= book.price
-            usr.books.add(book)
-            usr.save()
+        if form.is_valid():
+            usr.buy([book.pk])
         return HttpResponseRedirect(reverse('library:bookdetails', kwargs={'bookid':bookid}))
     else:
-        if usr.balance < book.price:
-            status = 0
-        elif book in usr.books.all():
-            status = 1
+        if usr.books.filter(pk=book.pk).exists():
+            status = CustomUser.ALREADY_OWNED
+        elif usr.balance < book.price:
+            status = CustomUser.NOT_ENOUGH_MONEY
         else:
-            status = 2
+            status = CustomUser.BOUGHT
         form = BuyBookForm()
     context = {
         'status': status,
@@ -225,29 +404,61 @@ def buy_book(request, bookid):
     }
     return render(request, 'library/buy_book.html', context)
 
+@require_POST
+@login_required(redirect_field_name=None)
+def add_to_cart(request, bookid):
+    book = get_object_or_404(Book, pk=bookid, status=1)
+    cart = request.session.get('cart', [])
+    if book.pk not in cart:
+        request.session['cart'] = cart + [book.pk]
+    return HttpResponseRedirect(reverse('library:cart'))
+
+@require_POST
+@login_required(redirect_field_name=None)
+def remove_from_cart(request, bookid):
+    request.session['cart'] = [isbn for isbn in request.session.get('cart', []) if isbn != bookid]
+    return HttpResponseRedirect(reverse('library:cart'))
+
+@login_required(redirect_field_name=None)
+def cart(request):
+    usr = request.user
+    status = None
+    bought = []
+    if request.method == 'POST':
+        form = CheckoutForm(request.POST, books=[(isbn, isbn) for isbn in request.session.get('cart', [])])
+        if form.is_valid():
+            status, bought = usr.buy(form.cleaned_data['isbns'])
+            if status != CustomUser.NOT_ENOUGH_MONEY:
+                request.session['cart'] = [isbn for isbn in request.session.get('cart', []) if isbn not in form.cleaned_data['isbns']]
+    owned = CustomUser.books.through.objects.filter(customuser_id=usr.pk, book_id=OuterRef('pk'))
+    books = (
+        Book.objects.published().filter(pk__in=request.session.get('cart', []))
+        .annotate(owned=Exists(owned)).order_by('title')
+    )
+    context = {
+        'books': books,
+        'total': sum(book.price for book in books if not book.owned),
+        'status': status,
+        'bought': bought,
+    }
+    return render(request, 'library/cart.html', context)
+
 @login_required(redirect_field_name=None)
 def recommend_book(request, bookid):
     book = get_object_or_404(Book, pk=bookid, status=1)
     usr = request.user
     status = 0
 
-    friends1_q = Friendship.objects.filter(sender=usr, status=1)
-    friends2_q = Friendship.objects.filter(target=usr, status=1)
-    friends_choices = list()
-    for friend in friends1_q | friends2_q:
-        if friend.sender == usr: candidate = friend.target
-        else: candidate = friend.sender
-        if book not in candidate.books.all():
-            if Recommendation.objects.filter(sender=usr, target=candidate, book=book).count() == 0:
-                friends_choices += [(candidate.pk, candidate)]
+    friends_choices = [(candidate.pk, candidate) for candidate in Recommendation.candidates(usr, book)]
 
     if request.method == 'POST':
         form = RecommendBookForm(request.POST, friends=friends_choices)
-        if form.is_valid() and book in usr.books.all():
+        if form.is_valid() and usr.books.filter(pk=book.pk).exists():
             status = 1
-            target = get_object_or_404(CustomUser, pk=form.cleaned_data['friend'])
-            recommendation = Recommendation(sender=usr, target=target, book=book)
-            recommendation.save()
+            Recommendation.objects.bulk_create([
+                Recommendation(sender=usr, target_id=int(pk), book=book)
+                for pk in form.cleaned_data['friends']
+            ])
         else:
             status = 2
     else:
@@ -264,20 +475,11 @@ def recommend_book(request, bookid):
 def user_books(request, user):
     usr = get_object_or_404(CustomUser, username=user)
     if usr.privacy_level == 0 or (request.user.is_authenticated and usr.privacy_level == 1) or request.user.authorization_level == 4:
-        books = usr.books.filter(status=1)
-
-        ratings = list()
-        nb_ratings = list()
-        for book in books:
-            rts = book.rating_set.all()
-            if rts.count() == 0: avg_rating = 0
-            else: avg_rating = sum([r.evaluation for r in rts]) / rts.count()
-            ratings = ratings + [avg_rating]
-            nb_ratings = nb_ratings + [rts.count()]
+        books = usr.books.published().for_listing()
 
         context = {
             'usr': usr,
-            'books': zip(books, ratings, nb_ratings),
+            'books': books,
         }
         return render(request, 'library/user_books.html', context)
     else:
@@ -301,20 +503,11 @@ def user_recommendations(request, user):
 def user_published_books(request, user):
     usr = get_object_or_404(CustomUser, username=user)
     if usr.privacy_level == 0 or (request.user.is_authenticated and usr.privacy_level == 1) or request.user.authorization_level == 4:
-        books = Book.objects.filter(author=usr)
-
-        ratings = list()
-        nb_ratings = list()
-        for book in books:
-            rts = book.rating_set.all()
-            if rts.count() == 0: avg_rating = 0
-            else: avg_rating = sum([r.evaluation for r in rts]) / rts.count()
-            ratings = ratings + [avg_rating]
-            nb_ratings = nb_ratings + [rts.count()]
+        books = Book.objects.filter(author=usr).for_listing()
 
         context = {
             'usr': usr,
-            'books': zip(books, ratings, nb_ratings),
+            'books': books,
             'own_profile': (usr == request.user),
         }
         return render(request, 'library/user_published_books.html', context)
@@ -325,9 +518,7 @@ def user_published_books(request, user):
 @login_required(redirect_field_name=None)
 def send_friend_request(request, user):
     usr = get_object_or_404(CustomUser, username=user)
-    friends1 = Friendship.objects.filter(sender=usr, target=request.user)
-    friends2 = Friendship.objects.filter(target=usr, sender=request.user)
-    if usr != request.user and (friends1 | friends2).count() == 0:
+    if usr != request.user and Friendship.between(usr, request.user) is None:
         request = Friendship(sender=request.user, target=usr)
         request.save()
     return HttpResponseRedirect(reverse('library:profile', kwargs={'user':user}))
@@ -335,11 +526,9 @@ def send_friend_request(request, user):
 @login_required(redirect_field_name=None)
 def delete_friend(request, user):
     usr = get_object_or_404(CustomUser, username=user)
-    friends1 = Friendship.objects.filter(sender=usr, target=request.user, status=1)
-    friends2 = Friendship.objects.filter(target=usr, sender=request.user, status=1)
-    friends = friends1 | friends2
-    if friends.count() > 0:
-        friends[0].delete()
+    friendship = Friendship.between(usr, request.user)
+    if friendship is not None and friendship.status == 1:
+        friendship.delete()
     return HttpResponseRedirect(reverse('library:profile', kwargs={'user':user}))
 
 @login_required(redirect_field_name=None)
@@ -365,23 +554,20 @@ def reject_friend_request(request, user):
 
 
 @login_required(redirect_field_name=None)
-def user_friends(request, user):
+def user_friends(request, user, nb_suggestions=20):
     if request.user.username == user:
         usr = get_object_or_404(CustomUser, username=user)
-        friends1_q = Friendship.objects.filter(sender=usr, status=1)
-        friends2_q = Friendship.objects.filter(target=usr, status=1)
-        requests_q = Friendship.objects.filter(target=usr, status=0)
-
-        friends = list()
-        for friend in friends1_q | friends2_q:
-            if friend.sender == usr: friends = friends + [friend.target]
-            else: friends = friends + [friend.sender]
+        requests_q = Friendship.objects.filter(target=usr, status=0).select_related('sender')
+
+        friend_ids = Friendship.friend_ids(usr)
+        friends = CustomUser.objects.filter(pk__in=friend_ids).order_by('username')
         requests = [u.sender for u in requests_q]
 
         context = {
             'requests': requests,
             'friends': friends,
-            'nb_friends': len(friends),
+            'nb_friends': len(friend_ids),
+            'suggestions': friendgraph.people_you_may_know(usr, limit=nb_suggestions),
         }
         return render(request, 'library/user_friends.html', context)
     else:
@@ -404,7 +590,9 @@ def publish_book(request, user):
                     image_url = form.cleaned_data['image_url'],
                     category = form.cleaned_data['category'],
                 )
-                b.save()
+                with transaction.atomic():
+                    b.save()
+                    ModerationCounter.add(ModerationCounter.PUBLICATION_REQUESTS, 1)
             return HttpResponseRedirect(reverse('library:user_published_books', kwargs={'user':user}))
         else:
             form = CreateBookForm()
@@ -418,15 +606,21 @@ def request_publisher(request, user):
     usr = request.user
     if user == usr.username and usr.authorization_level == 1:
         usr.authorization_level = 2
-        usr.save()
+        with transaction.atomic():
+            usr.save()
+            ModerationCounter.add(ModerationCounter.PUBLISHER_REQUESTS, 1)
     return HttpResponseRedirect(reverse('library:profile', kwargs={'user':user}))
 
 @login_required(redirect_field_name=None)
 def block_user(request, user):
     usr = get_object_or_404(CustomUser, username=user)
     if request.user.authorization_level == 4 and usr.authorization_level < 4:
+        was_requesting = (usr.authorization_level == 2)
         usr.authorization_level = 0
-        usr.save()
+        with transaction.atomic():
+            usr.save()
+            if was_requesting:
+                ModerationCounter.add(ModerationCounter.PUBLISHER_REQUESTS, -1)
     return HttpResponseRedirect(reverse('library:profile', kwargs={'user':user}))
 
 @login_required(redirect_field_name=None)
@@ -442,7 +636,9 @@ def accept_publisher_request(request, user):
     usr = get_object_or_404(CustomUser, username=user)
     if request.user.authorization_level == 4 and usr.authorization_level == 2:
         usr.authorization_level = 3
-        usr.save()
+        with transaction.atomic():
+            usr.save()
+            ModerationCounter.add(ModerationCounter.PUBLISHER_REQUESTS, -1)
     return HttpResponseRedirect(reverse('library:profile', kwargs={'user':user}))
 
 @login_required(redirect_field_name=None)
@@ -450,7 +646,9 @@ def reject_publisher_request(request, user):
     usr = get_object_or_404(CustomUser, username=user)
     if request.user.authorization_level == 4 and usr.authorization_level == 2:
         usr.authorization_level = 1
-        usr.save()
+        with transaction.atomic():
+            usr.save()
+            ModerationCounter.add(ModerationCounter.PUBLISHER_REQUESTS, -1)
     return HttpResponseRedirect(reverse('library:profile', kwargs={'user':user}))
 
 @login_required(redirect_field_name=None)
@@ -458,7 +656,9 @@ def accept_publication(request, bookid):
     book = get_object_or_404(Book, pk=bookid)
     if request.user.authorization_level == 4 and book.status == 0:
         book.status = 1
-        book.save()
+        with transaction.atomic():
+            book.save()
+            ModerationCounter.add(ModerationCounter.PUBLICATION_REQUESTS, -1)
     return HttpResponseRedirect(reverse('library:user_published_books', kwargs={'user':book.author.username}))
 
 @login_required(redirect_field_name=None)
@@ -466,27 +666,28 @@ def reject_publication(request, bookid):
     book = get_object_or_404(Book, pk=bookid)
     if request.user.authorization_level == 4 and book.status == 0:
         book.status = 2
-        book.save()
+        with transaction.atomic():
+            book.save()
+            ModerationCounter.add(ModerationCounter.PUBLICATION_REQUESTS, -1)
     return HttpResponseRedirect(reverse('library:user_published_books', kwargs={'user':book.author.username}))
 
 @login_required(redirect_field_name=None)
 def delete_book(request, bookid):
     book = get_object_or_404(Book, pk=bookid)
     if request.user.authorization_level == 4:
+        was_waiting = (book.status == 0)
         book.status = 2
-        book.save()
+        with transaction.atomic():
+            book.save()
+            if was_waiting:
+                ModerationCounter.add(ModerationCounter.PUBLICATION_REQUESTS, -1)
     return HttpResponseRedirect(reverse('library:index'))
 
 @login_required(redirect_field_name=None)
 def vote_review(request, reviewid, bookid, vote):
     rev = get_object_or_404(Review, pk=reviewid)
-    if request.user.authorization_level >= 1 and not rev.voters.filter(username=request.user.username).exists():
-        if vote == "up":
-            rev.nb_likes += 1
-        else:
-            rev.nb_likes -= 1
-        rev.voters.add(request.user)
-        rev.save()
+    if request.user.authorization_level >= 1:
+        ReviewVote.vote(rev, request.user, 1 if vote == "up" else -1)
     return HttpResponseRedirect(reverse('library:review_details', kwargs={'reviewid':reviewid,'bookid':bookid}))
 
 @login_required(redirect_field_name=None)
@@ -552,7 +753,9 @@ def delete_review(request, bookid, reviewid):
     rev = get_object_or_404(Review, pk=reviewid)
     author = rev.associated_rating.user
     if usr.authorization_level == 4 or usr == author:
-        rev.delete()
+        with transaction.atomic():
+            ReportedReview.resolve(rev)
+            rev.delete()
     return HttpResponseRedirect(reverse('library:bookdetails', kwargs={'bookid':bookid}))
 
 @login_required(redirect_field_name=None)
@@ -561,11 +764,35 @@ def report_review(request, bookid, reviewid):
     rev = get_object_or_404(Review, pk=reviewid)
     author = rev.associated_rating.user
     if usr.authorization_level < 4 and usr != author:
-        rev.nb_reports += 1
-        rev.save()
+        ReviewReport.report(rev, usr)
     return HttpResponseRedirect(reverse('library:bookdetails', kwargs={'bookid':bookid}))
 
-def review_details(request, bookid, reviewid):
+@login_required(redirect_field_name=None)
+def keep_review(request, bookid, reviewid):
     rev = get_object_or_404(Review, pk=reviewid)
-    context = { 'review': rev, 'bookid': bookid }
+    if request.user.authorization_level == 4:
+        with transaction.atomic():
+            # Only the reports made after this decision can queue it again
+            if ReportedReview.resolve(rev):
+                Review.objects.filter(pk=rev.pk).update(nb_reports=0)
+    return HttpResponseRedirect(reverse('library:review_reports'))
+
+def review_details(request, bookid, reviewid, comment_per_page=20):
+    rev = get_object_or_404(Review.objects.for_listing(), pk=reviewid)
+    try:
+        comments = keyset_page(
+            Comment.objects.filter(parent_review=rev).select_related('user'),
+            Comment.THREAD_ORDERING,
+            cursor=request.GET.get('cursor'),
+            per_page=comment_per_page,
+        )
+    except ValueError:
+        raise Http404
+    context = {
+        'review': rev,
+        'bookid': bookid,
+        'comments': comments.items,
+        'next_cursor': comments.next_cursor,
+        'prev_cursor': comments.prev_cursor,
+    }
     return render(request, 'library/review_details.html', context)
@@ -0,0 +1,106 @@
+"""
+Write-behind buffer of the like and dislike totals of the reviews.
+
+The votes themselves are written immediately in ReviewVote, the totals
+stored on Review are only added up in memory and written by a background
+thread every FLUSH_INTERVAL seconds, with one F() update per review
+whatever the number of votes it received meanwhile. Totals not flushed
+when a process dies, or which could not be written, are restored from the
+votes by rebuild_vote_totals. It only flushes the buffer of its own
+process, so it must run while the web processes are stopped: their
+buffered totals would be counted twice.
+"""
+
+import atexit
+import logging
+import threading
+
+from django.db import DataError, IntegrityError, close_old_connections, transaction
+from django.db.models import F
+
+from . import pagecache
+
+FLUSH_INTERVAL = 0.3
+
+logger = logging.getLogger(__name__)
+
+_pending = {}
+_lock = threading.Lock()
+_flusher = None
+
+
+def add(review_id, book_id, likes=0, dislikes=0):
+    """
+    Count votes for a review, written to the database by the next flush
+    """
+    with _lock:
+        totals = _pending.setdefault((review_id, book_id), [0, 0])
+        totals[0] += likes
+        totals[1] += dislikes
+        _start()
+
+
+def flush():
+    """
+    Write the buffered totals, return the number of reviews updated
+    """
+    from .models import Review
+
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending:
+        return 0
+    dropped = set()
+    try:
+        with transaction.atomic():
+            for (review_id, book_id), (likes, dislikes) in pending.items():
+                # A total which cannot be written must not hold back the
+                # others: it is dropped, rebuild_vote_totals restores it
+                try:
+                    with transaction.atomic():
+                        Review.objects.filter(pk=review_id).update(
+                            nb_likes=F('nb_likes') + likes,
+                            nb_dislikes=F('nb_dislikes') + dislikes,
+                        )
+                except (DataError, IntegrityError):
+                    logger.exception('Dropped the vote totals %+d/%+d of review %d', likes, dislikes, review_id)
+                    dropped.add((review_id, book_id))
+                    continue
+                pagecache.bump_book(book_id, catalog=False)
+    except Exception:
+        # Put the totals back, they are retried by the next flush
+        with _lock:
+            for key, (likes, dislikes) in pending.items():
+                if key in dropped:
+                    continue
+                totals = _pending.setdefault(key, [0, 0])
+                totals[0] += likes
+                totals[1] += dislikes
+        raise
+    return len(pending) - len(dropped)
+
+
+def _run():
+    stop = threading.Event()
+    while not stop.wait(FLUSH_INTERVAL):
+        close_old_connections()
+        try:
+            flush()
+        except Exception:
+            logger.exception('Could not write the vote totals')
+
+
+def _start():
+    global _flusher
+    if _flusher is None or not _flusher.is_alive():
+        _flusher = threading.Thread(target=_run, name='votebuffer', daemon=True)
+        _flusher.start()
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        flush()
+    except Exception:
+        logger.exception('Could not write the vote totals')
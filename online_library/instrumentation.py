@@ -0,0 +1,231 @@
+"""
+Per-request metrics: number of SQL queries, database time, template
+rendering time, view time and total time of every view, aggregated in
+histograms by URL name. The view time runs from the call of the view to the
+response, so it leaves out the request phase of the middleware (sessions,
+authentication) and includes the database and template time of the view.
+
+Enabled by the REQUEST_METRICS setting. Queries are counted by a database
+execute wrapper and grouped by their SQL text, which still contains the
+parameter placeholders: the same text run again and again in one request
+is an N+1 pattern, logged and counted. The histograms are kept in the
+memory of each process and exported by metrics() in the Prometheus text
+format and by metrics_json() for staff users.
+"""
+
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed, PermissionDenied
+from django.db import connections
+from django.http import HttpResponse, JsonResponse
+from django.template import base as template_base
+
+# Upper bounds of the histogram buckets
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# Number of runs of the same query in a request reported as N+1
+REPEATED_QUERY_THRESHOLD = 5
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_lock = threading.Lock()
+_views = {}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class ViewMetrics:
+    def __init__(self):
+        self.requests = 0
+        self.repeated_queries = 0
+        self.time = Histogram(TIME_BUCKETS)
+        self.view_time = Histogram(TIME_BUCKETS)
+        self.db_time = Histogram(TIME_BUCKETS)
+        self.template_time = Histogram(TIME_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+
+    def histograms(self):
+        return (
+            ('request_seconds', self.time),
+            ('view_seconds', self.view_time),
+            ('db_seconds', self.db_time),
+            ('template_seconds', self.template_time),
+            ('queries', self.queries),
+        )
+
+
+class RequestRecord:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.view_start = None
+        self.shapes = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            self.shapes[sql] = self.shapes.get(sql, 0) + 1
+
+    def repeated(self):
+        return [(sql, n) for sql, n in self.shapes.items() if n >= REPEATED_QUERY_THRESHOLD]
+
+
+_template_render = template_base.Template.render
+
+
+def _timed_render(self, context):
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return _template_render(self, context)
+    # Included templates are rendered inside their parent, only the
+    # outermost rendering is timed
+    record.template_depth += 1
+    start = time.perf_counter()
+    try:
+        return _template_render(self, context)
+    finally:
+        record.template_depth -= 1
+        if record.template_depth == 0:
+            record.template_time += time.perf_counter() - start
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_METRICS', False):
+            raise MiddlewareNotUsed
+        template_base.Template.render = _timed_render
+        self.get_response = get_response
+
+    def __call__(self, request):
+        record = RequestRecord()
+        _local.record = record
+        start = time.perf_counter()
+        try:
+            with _wrap_connections(record):
+                response = self.get_response(request)
+        finally:
+            _local.record = None
+        end = time.perf_counter()
+        elapsed = end - start
+
+        match = request.resolver_match
+        name = match.view_name if match else 'unresolved'
+        repeated = record.repeated()
+        for sql, n in repeated:
+            logger.warning('%s ran the same query %d times: %s', name, n, sql)
+        with _lock:
+            metrics = _views.get(name)
+            if metrics is None:
+                metrics = _views[name] = ViewMetrics()
+            metrics.requests += 1
+            metrics.repeated_queries += len(repeated)
+            metrics.time.observe(elapsed)
+            # Not reached by the requests not resolved to a view
+            if record.view_start is not None:
+                metrics.view_time.observe(end - record.view_start)
+            metrics.db_time.observe(record.db_time)
+            metrics.template_time.observe(record.template_time)
+            metrics.queries.observe(record.queries)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        record = getattr(_local, 'record', None)
+        if record is not None:
+            record.view_start = time.perf_counter()
+
+
+class _wrap_connections:
+    # One execute wrapper on every database connection of the thread
+    def __init__(self, record):
+        self.wrappers = [conn.execute_wrapper(record) for conn in connections.all()]
+
+    def __enter__(self):
+        for wrapper in self.wrappers:
+            wrapper.__enter__()
+
+    def __exit__(self, *exc):
+        for wrapper in reversed(self.wrappers):
+            wrapper.__exit__(*exc)
+
+
+def _check_access(request):
+    token = getattr(settings, 'REQUEST_METRICS_TOKEN', None)
+    if token and request.META.get('HTTP_AUTHORIZATION') == 'Bearer ' + token:
+        return
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+
+def _snapshot():
+    with _lock:
+        return sorted(
+            (name, m.requests, m.repeated_queries, [(h, list(hist.cumulative()), hist.sum) for h, hist in m.histograms()])
+            for name, m in _views.items()
+        )
+
+
+def metrics(request):
+    """
+    Histograms in the Prometheus text exposition format, for staff users
+    or scrapers sending the REQUEST_METRICS_TOKEN bearer token
+    """
+    _check_access(request)
+    # The lines of a metric family must follow its TYPE line
+    counters = {'requests_total': [], 'repeated_queries_total': []}
+    histograms = dict()
+    for name, requests, repeated, hists in _snapshot():
+        counters['requests_total'].append('library_requests_total{view="%s"} %d' % (name, requests))
+        counters['repeated_queries_total'].append('library_repeated_queries_total{view="%s"} %d' % (name, repeated))
+        for metric, buckets, total in hists:
+            rows = histograms.setdefault(metric, [])
+            for bound, count in buckets:
+                rows.append('library_%s_bucket{view="%s",le="%s"} %d' % (metric, name, bound, count))
+            rows.append('library_%s_sum{view="%s"} %s' % (metric, name, total))
+            rows.append('library_%s_count{view="%s"} %d' % (metric, name, buckets[-1][1]))
+    lines = []
+    for families, kind in ((counters, 'counter'), (histograms, 'histogram')):
+        for metric, rows in families.items():
+            lines.append('# TYPE library_%s %s' % (metric, kind))
+            lines.extend(rows)
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
+
+
+def metrics_json(request):
+    """
+    Same histograms as metrics(), as JSON
+    """
+    _check_access(request)
+    return JsonResponse({
+        name: {
+            'requests': requests,
+            'repeated_queries': repeated,
+            'histograms': {metric: {'buckets': buckets, 'sum': total} for metric, buckets, total in hists},
+        }
+        for name, requests, repeated, hists in _snapshot()
+    })
@@ -0,0 +1,144 @@
+"""
+Read replicas: the reads of safe requests go to the REPLICA_DATABASES
+aliases, everything else to the default database, the primary.
+
+ReplicaMiddleware decides per request. A request reads from the primary
+when its method is not safe, when it has written anything (many views of
+the library write on GET), when it is inside a transaction, and for
+REPLICA_STICKY_SECONDS after the same client wrote, so that users always
+see their own changes. The stickiness is kept in a cookie rather than in
+the session: the session itself may not have reached the replicas yet.
+Code running outside of a request, such as management commands and the
+background threads, always uses the primary.
+
+The lag of every replica is checked at most every REPLICA_LAG_CHECK_INTERVAL
+seconds, replicas more than REPLICA_MAX_LAG seconds behind or unreachable
+are left out until the next check. Without a healthy replica every query
+goes to the primary.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.db.utils import ConnectionDoesNotExist
+
+PRIMARY_COOKIE = 'primary_until'
+# Applications whose tables are always read from the primary: the session
+# of a user who just logged in must be found at the next request
+PRIMARY_APPS = {'sessions'}
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_lock = threading.Lock()
+_lags = {}
+
+
+def replica_lag(alias):
+    """
+    Return the replication lag of a database in seconds, 0 for a database
+    that is not a PostgreSQL standby
+    """
+    conn = connections[alias]
+    if conn.vendor != 'postgresql':
+        return 0
+    with conn.cursor() as cursor:
+        # A standby which replayed everything it received is up to date,
+        # even if the primary has not written anything for a while
+        cursor.execute(
+            "SELECT CASE "
+            "WHEN NOT pg_is_in_recovery() THEN 0 "
+            "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+        )
+        lag = cursor.fetchone()[0]
+    return float('inf') if lag is None else float(lag)
+
+
+def healthy_replicas():
+    """
+    Return the replica aliases behind the primary by less than REPLICA_MAX_LAG
+    """
+    max_lag = getattr(settings, 'REPLICA_MAX_LAG', 5)
+    interval = getattr(settings, 'REPLICA_LAG_CHECK_INTERVAL', 5)
+    now = time.monotonic()
+    healthy = []
+    for alias in getattr(settings, 'REPLICA_DATABASES', ()):
+        with _lock:
+            checked = _lags.get(alias)
+        if checked is None or now - checked[0] >= interval:
+            try:
+                lag = replica_lag(alias)
+            except (DatabaseError, ConnectionDoesNotExist):
+                logger.exception('Could not check the lag of the replica %s', alias)
+                lag = float('inf')
+            if lag > max_lag:
+                logger.warning('Replica %s is %.1fs behind, reading from the primary', alias, lag)
+            checked = (now, lag)
+            with _lock:
+                _lags[alias] = checked
+        if checked[1] <= max_lag:
+            healthy.append(alias)
+    return healthy
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = getattr(_local, 'state', None)
+        if state is None or state.primary or model._meta.app_label in PRIMARY_APPS \
+                or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        if state.replica is None:
+            replicas = healthy_replicas()
+            state.replica = random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = getattr(_local, 'state', None)
+        if state is not None:
+            # What this request reads next must include its own writes
+            state.primary = state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS}.union(getattr(settings, 'REPLICA_DATABASES', ()))
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+class RequestState:
+    def __init__(self, primary):
+        self.primary = primary
+        self.wrote = False
+        # Chosen at the first read, a request reads from a single replica
+        self.replica = None
+
+
+class ReplicaMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'REPLICA_DATABASES', ()):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            sticky = float(request.COOKIES.get(PRIMARY_COOKIE, 0)) > time.time()
+        except ValueError:
+            sticky = False
+        state = RequestState(primary=sticky or request.method not in ('GET', 'HEAD', 'OPTIONS'))
+        _local.state = state
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.state = None
+        if state.wrote or request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            window = getattr(settings, 'REPLICA_STICKY_SECONDS', 10)
+            response.set_cookie(PRIMARY_COOKIE, '%.3f' % (time.time() + window), max_age=window, httponly=True)
+        return response
@@ -41,6 +41,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'online_library.instrumentation.RequestMetricsMiddleware',
+    'online_library.replicas.ReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,9 +82,45 @@ DATABASES = {
         'NAME': 'dbproject',
         'USER': 'admin',
         'PASSWORD': 'admin',
-    }
+    },
+    # A streaming replica of the primary, listed in REPLICA_DATABASES below.
+    # The tests read the primary through it:
+    # 'replica': {
+    #     'ENGINE': 'django.db.backends.postgresql',
+    #     'NAME': 'dbproject',
+    #     'USER': 'admin',
+    #     'PASSWORD': 'admin',
+    #     'HOST': 'localhost',
+    #     'PORT': '5433',
+    #     'TEST': {'MIRROR': 'default'},
+    # },
 }
 
+# Reads of safe requests go to the replicas, see online_library/replicas.py
+DATABASE_ROUTERS = ['online_library.replicas.ReplicaRouter']
+REPLICA_DATABASES = []
+# Time a client keeps reading from the primary after writing, in seconds
+REPLICA_STICKY_SECONDS = 10
+# Replicas further behind, in seconds, are not read
+REPLICA_MAX_LAG = 5
+REPLICA_LAG_CHECK_INTERVAL = 5
+
+
+# Cache. The default one is local to every process: deployments running
+# several processes point it at a cache they all share, so that the cached
+# pages, facet counts and friend lists are invalidated by writes handled by
+# any of them. Memcached needs python-memcached:
+# CACHES = {
+#     'default': {
+#         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#         'LOCATION': '127.0.0.1:11211',
+#     },
+# }
+
+# The page cache is off when the cache is local to the process, True or
+# False forces it on or off, see library/pagecache.py
+PAGE_CACHE = None
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -122,7 +160,26 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
 STATIC_URL = '/static/'
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+# collectstatic hashes, precompresses and converts the fonts to WOFF2, see
+# online_library/staticfiles.py
+STATICFILES_STORAGE = 'online_library.staticfiles.CompressedManifestStorage'
+
+# Local copies and thumbnails of the book covers, see library/covers.py
+COVER_CACHE_DIR = os.path.join(BASE_DIR, 'covers')
+# Downloads of covers running at the same time in a process
+COVER_MAX_FETCHES = 4
+COVER_FETCH_TIMEOUT = 5
+# Covers are never downloaded from loopback, private or link-local addresses
+COVER_ALLOW_PRIVATE_ADDRESSES = False
 
 LOGIN_URL = 'library:login'
 LOGIN_REDIRECT_URL = 'library:index'
 LOGOUT_REDIRECT_URL = 'library:index'
+
+
+# Per-request SQL and timing metrics, exported at /metrics/ (Prometheus) and
+# /metrics/json/ for staff users or with the bearer token below
+
+REQUEST_METRICS = False
+REQUEST_METRICS_TOKEN = None
@@ -0,0 +1,204 @@
+"""
+Static files built for long-lived caching.
+
+CompressedManifestStorage is the storage of collectstatic. On top of the
+content hashes of ManifestStaticFilesStorage it:
+
+- converts the TrueType and OpenType fonts to WOFF2, subset to the Latin
+  characters, and lists them before the original fonts in the @font-face
+  rules of the collected CSS, so that browsers download the much smaller
+  WOFF2 and older ones still get the original. This needs fontTools with
+  Brotli, collectstatic keeps the original fonts only without them.
+- writes a gzip copy, and a Brotli copy when brotli is installed, of every
+  hashed text file and font, next to it with a .gz and .br suffix.
+
+serve() returns the collected files, with the precompressed copy matching
+the Accept-Encoding of the request. Hashed files never change and are
+cached for a year. A front web server serving STATIC_ROOT can do the same
+with its precompressed file support (gzip_static and brotli_static for
+nginx).
+"""
+
+import gzip
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+from io import BytesIO
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404
+from django.utils._os import safe_join
+from django.utils.cache import patch_cache_control, patch_vary_headers
+
+FONT_EXTENSIONS = ('.ttf', '.otf')
+COMPRESSED_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.ttf', '.otf')
+# Basic Latin, Latin-1, Latin Extended-A, and the dashes, quotes, ellipsis
+# and euro sign
+FONT_UNICODES = (
+    list(range(0x20, 0x7f)) + list(range(0xa0, 0x180)) +
+    [0x2013, 0x2014, 0x2018, 0x2019, 0x201c, 0x201d, 0x2026, 0x20ac]
+)
+FONT_URL = re.compile(r"""url\((['"]?)([^'")]+?\.(?:ttf|otf))\1\)""", re.IGNORECASE)
+# Encodings of the precompressed copies, by order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+MAX_AGE = 365 * 24 * 60 * 60
+
+mimetypes.add_type('font/woff2', '.woff2')
+mimetypes.add_type('font/ttf', '.ttf')
+mimetypes.add_type('font/otf', '.otf')
+
+logger = logging.getLogger(__name__)
+
+
+def woff2(font_file):
+    """
+    Return the WOFF2 subset of a TrueType or OpenType font file
+    """
+    from fontTools import subset
+
+    options = subset.Options()
+    options.flavor = 'woff2'
+    options.layout_features = ['*']
+    font = subset.load_font(font_file, options)
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=FONT_UNICODES)
+    subsetter.subset(font)
+    output = BytesIO()
+    subset.save_font(font, output, options)
+    return output.getvalue()
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+class CompressedManifestStorage(ManifestStaticFilesStorage):
+    def stored_name(self, name):
+        # Before collectstatic, as in the tests, files are not hashed
+        try:
+            return super(CompressedManifestStorage, self).stored_name(name)
+        except ValueError:
+            return name
+
+    def _replace(self, name, content):
+        if self.exists(name):
+            self.delete(name)
+        self._save(name, ContentFile(content))
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            self.convert_fonts(paths)
+        processed = super(CompressedManifestStorage, self).post_process(paths, dry_run, **options)
+        for name, hashed_name, result in processed:
+            yield name, hashed_name, result
+        if not dry_run:
+            self.compress(set(self.hashed_files.values()))
+
+    def convert_fonts(self, paths):
+        """
+        Add the WOFF2 version of the fonts to `paths` and to the @font-face
+        rules of the CSS files
+        """
+        try:
+            from fontTools import subset  # NOQA
+            import brotli  # NOQA
+        except ImportError:
+            logger.warning('fontTools and brotli are not installed, the fonts are not converted to WOFF2')
+            return
+        converted = set()
+        for path in list(paths):
+            if not path.lower().endswith(FONT_EXTENSIONS):
+                continue
+            storage, source = paths[path]
+            with storage.open(source) as f:
+                data = woff2(f)
+            name = os.path.splitext(path)[0] + '.woff2'
+            self._replace(name, data)
+            paths[name] = (self, name)
+            converted.add(path)
+
+        def add_woff2(css_path, match):
+            quote, url = match.groups()
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(css_path), url))
+            if target not in converted:
+                return match.group(0)
+            return "url({0}{1}.woff2{0}) format('woff2'), {2}".format(
+                quote, os.path.splitext(url)[0], match.group(0),
+            )
+
+        for path in list(paths):
+            if not path.endswith('.css'):
+                continue
+            storage, source = paths[path]
+            with storage.open(source) as f:
+                css = f.read().decode()
+            updated = FONT_URL.sub(lambda m: add_woff2(path, m), css)
+            if updated != css:
+                # The hashed CSS is made from the updated copy
+                self._replace(path, updated.encode())
+                paths[path] = (self, path)
+
+    def compress(self, names):
+        brotli = _brotli()
+        for name in sorted(names):
+            if not name.lower().endswith(COMPRESSED_EXTENSIONS):
+                continue
+            with self.open(name) as f:
+                data = f.read()
+            copies = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+            if brotli is not None:
+                copies.append(('.br', brotli.compress(data, quality=11)))
+            for suffix, compressed in copies:
+                # Not worth a request header check for a few bytes
+                if len(compressed) < len(data) * 0.95:
+                    self._replace(name + suffix, compressed)
+
+
+def _accepted(request):
+    encodings = set()
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = part.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            encodings.add(coding.strip().lower())
+    return encodings
+
+
+def serve(request, path):
+    """
+    Serve a collected static file, precompressed when the client accepts it
+    """
+    if not settings.STATIC_ROOT:
+        raise Http404
+    try:
+        fullpath = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(fullpath):
+        raise Http404
+    content_type, _ = mimetypes.guess_type(fullpath)
+    accepted = _accepted(request)
+    encoding = None
+    for coding, suffix in ENCODINGS:
+        if coding in accepted and os.path.isfile(fullpath + suffix):
+            encoding = coding
+            fullpath += suffix
+            break
+    response = FileResponse(open(fullpath, 'rb'), content_type=content_type or 'application/octet-stream')
+    if encoding:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ('Accept-Encoding',))
+    hashed_files = getattr(staticfiles_storage, 'hashed_files', {})
+    if path in hashed_files.values():
+        patch_cache_control(response, public=True, max_age=MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, max_age=60)
+    return response
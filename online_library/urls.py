@@ -1,9 +1,16 @@
+from django.conf import settings
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
+
+from . import instrumentation, staticfiles
 
 
 app_name = 'online_library'
 urlpatterns = [
     path('', include('library.urls')),
     path('admin/', admin.site.urls),
+    path('metrics/', instrumentation.metrics, name='metrics'),
+    path('metrics/json/', instrumentation.metrics_json, name='metrics_json'),
+    # Collected static files, when no front web server serves STATIC_ROOT
+    re_path(r'^%s(?P<path>.+)$' % settings.STATIC_URL.lstrip('/'), staticfiles.serve, name='static'),
 ]